@@ -0,0 +1,376 @@
+import copy
+import threading
+import numpy as np
+import pandas as pd
+
+
+def valid_values(values:np.ndarray, log_scale:bool=False) -> np.ndarray:
+    """Mask of the values which can be drawn (finite, and positive on a log
+    scale)"""
+    valid = np.isfinite(values)
+    if log_scale:
+        valid &= values > 0
+    return valid
+
+
+def bin_edges(values:np.ndarray, log_scale:bool=False, 
+              nbins:int=50) -> np.ndarray:
+    """nbins + 1 bin edges covering values (which must all be valid), 
+    evenly spaced in log space on a log scale"""
+    if not len(values):
+        return np.linspace(0.0, 1.0, nbins + 1)
+    low, high = values.min(), values.max()
+    if high == low:
+        high = low + 1 if not log_scale else low * 10
+    if log_scale:
+        return np.geomspace(low, high, nbins + 1)
+    return np.linspace(low, high, nbins + 1)
+
+
+def stratified_sample(scores:np.ndarray, 
+                      max_points:int,
+                      n_strata:int=10,
+                      extremes:float=0.02,
+                      seed:int=0) -> np.ndarray:
+    """Sorted positions of at most max_points customers.
+
+    The customers with the lowest and highest scores (extremes share of 
+    max_points on each side) are always kept, the others are sampled 
+    uniformly within n_strata score quantiles. The seed is fixed so that 
+    the same sample is drawn for every request.
+    """
+    return StratifiedSample(scores, max_points, n_strata, extremes, 
+                            seed).positions
+
+
+class StratifiedSample:
+    """Stratified sample of the customers (see stratified_sample), kept up
+    to date when scores change.
+
+    The score bounds of the strata are those of the first draw: when the
+    scores of some customers change or customers are appended, only the
+    strata holding their previous or new scores are drawn again, from the
+    customers whose scores are within the bounds of the stratum.
+    """
+    def __init__(self, scores:np.ndarray, 
+                 max_points:int,
+                 n_strata:int=10,
+                 extremes:float=0.02,
+                 seed:int=0) -> None:
+        self.max_points = max_points
+        self.n_strata = n_strata
+        self.extremes = extremes
+        self.seed = seed
+        # Lower score bound of each stratum but the first (the lowest 
+        # scores), number of customers drawn from each stratum and drawn
+        # positions, the extremes being the first and last strata
+        self.bounds = None
+        self.sizes = None
+        self.picks = [np.arange(len(scores))]
+
+        n = len(scores)
+        if n > max_points:
+            order = np.argsort(scores, kind="stable")
+            n_extremes = int(max_points * extremes)
+            middle = order[n_extremes:n - n_extremes]
+            remaining = max_points - 2 * n_extremes
+            strata = np.array_split(middle, n_strata)
+
+            # Sizes proportional to the strata, rounded down, the points 
+            # left going to the strata with the largest remainders
+            shares = remaining * np.array([len(s) for s in strata]) \
+                / len(middle)
+            sizes = np.floor(shares).astype(int)
+            left = remaining - sizes.sum()
+            sizes[np.argsort(sizes - shares, kind="stable")[:left]] += 1
+
+            rng = np.random.default_rng(seed)
+            self.picks = [order[:n_extremes]] \
+                + [rng.choice(stratum, min(size, len(stratum)), 
+                              replace=False)
+                   for stratum, size in zip(strata, sizes)] \
+                + [order[n - n_extremes:]]
+            starts = n_extremes + np.cumsum([0] + [len(s) for s in strata])
+            self.bounds = scores[order[np.minimum(starts, n - 1)]]
+            self.sizes = [n_extremes] + sizes.tolist() + [n_extremes]
+        self.positions = np.sort(np.concatenate(self.picks))
+
+    def _strata(self, scores:np.ndarray) -> np.ndarray:
+        return np.searchsorted(self.bounds, scores, side="right")
+
+    def updated(self, old_scores:np.ndarray, scores:np.ndarray,
+                positions:np.ndarray) -> "StratifiedSample":
+        """Sample of scores, the scores old_scores whose values at positions
+        were changed or appended (at the end)"""
+        if self.bounds is None or len(scores) <= self.max_points:
+            # Too few customers before (or now) to stratify them
+            return StratifiedSample(scores, self.max_points, self.n_strata,
+                                    self.extremes, self.seed)
+        positions = np.asarray(positions)
+        changed = positions[positions < len(old_scores)]
+        touched = np.union1d(self._strata(old_scores[changed]),
+                             self._strata(scores[positions]))
+        sample = copy.copy(self)
+        sample.picks = list(self.picks)
+        strata = self._strata(scores)
+        for stratum in touched:
+            members = np.flatnonzero(strata == stratum)
+            size = min(self.sizes[stratum], len(members))
+            if stratum in (0, len(self.sizes) - 1):
+                # The most extreme scores are always kept
+                order = np.argsort(scores[members], kind="stable")
+                order = order[:size] if stratum == 0 \
+                    else order[len(order) - size:]
+                sample.picks[stratum] = members[order]
+            else:
+                # The same draw in every worker applying the same updates
+                rng = np.random.default_rng([self.seed, stratum, 
+                                             len(scores)])
+                sample.picks[stratum] = rng.choice(members, size, 
+                                                   replace=False)
+        sample.positions = np.sort(np.concatenate(sample.picks))
+        return sample
+
+
+def density_grid(x:np.ndarray, y:np.ndarray,
+                 x_log:bool=False, y_log:bool=False,
+                 nbins:int=60) -> tuple:
+    """2D histogram of the customers: (x edges, y edges, counts) with
+    counts[i, j] the number of customers in the i-th y bin and the j-th x
+    bin"""
+    valid = valid_values(x, x_log) & valid_values(y, y_log)
+    x_edges = bin_edges(x[valid], x_log, nbins)
+    y_edges = bin_edges(y[valid], y_log, nbins)
+    counts, _, _ = np.histogram2d(x[valid], y[valid], 
+                                  bins=[x_edges, y_edges])
+    return x_edges, y_edges, counts.T
+
+
+class HistogramStore:
+    """Histograms of the continuous features for each value of TARGET.
+
+    The bins are computed server-side with NumPy the first time a
+    (feature, axis scale) is requested and then kept in memory, so that the
+    figures only carry the bin edges and counts instead of every customer.
+    On a log scale the bins are evenly spaced in log space and only the
+    positive values are counted.
+    """
+    def __init__(self, data:pd.core.frame.DataFrame,
+                 target_col:str="TARGET",
+                 nbins:int=50) -> None:
+        self.data = data
+        self.target = data[target_col].to_numpy()
+        self.target_col = target_col
+        self.nbins = nbins
+        self._cache = {}
+        # Smallest and largest valid values of each cached histogram (None 
+        # without any), which its bin edges are computed from
+        self._bounds = {}
+        self._lock = threading.Lock()
+
+    def _compute(self, feature:str, log_scale:bool) -> dict:
+        values = self.data[feature].to_numpy(dtype=float)
+        valid = valid_values(values, log_scale)
+        edges = bin_edges(values[valid], log_scale, self.nbins)
+        counts = self._counts(values, self.target, edges, log_scale)
+        self._bounds[(feature, log_scale)] = \
+            (values[valid].min(), values[valid].max()) if valid.any() else None
+        return {"edges": edges, "counts": counts}
+
+    def _counts(self, values:np.ndarray, target:np.ndarray, edges:np.ndarray,
+                log_scale:bool) -> dict:
+        valid = valid_values(values, log_scale)
+        return {t: np.histogram(values[valid & (target == t)], bins=edges)[0]
+                for t in (0, 1)}
+
+    def updated(self, data:pd.core.frame.DataFrame,
+                positions:np.ndarray) -> "HistogramStore":
+        """Store of data, the customers of this store whose rows at 
+        positions were changed or appended (at the end).
+
+        A cached histogram is updated by removing the previous values of
+        the changed customers and adding their new values when its bin 
+        edges stay the same: the new values are within the bounds of the
+        histogram and the previous ones strictly inside, so that neither
+        the smallest nor the largest value changes. The other histograms
+        are dropped and computed again on first use.
+        """
+        store = HistogramStore(data, self.target_col, self.nbins)
+        positions = np.asarray(positions)
+        changed = positions[positions < len(self.data)]
+        new_target = store.target[positions]
+        old_target = self.target[changed]
+        with self._lock:
+            cached = [(key, self._cache[key], self._bounds[key]) 
+                      for key in self._cache]
+        for (feature, log_scale), histogram, bounds in cached:
+            if bounds is None or bounds[0] == bounds[1]:
+                continue
+            low, high = bounds
+            old_values = self.data[feature].to_numpy()[changed].astype(float)
+            new_values = data[feature].to_numpy()[positions].astype(float)
+            old_valid = old_values[valid_values(old_values, log_scale)]
+            new_valid = new_values[valid_values(new_values, log_scale)]
+            if not (((old_valid > low) & (old_valid < high)).all()
+                    and ((new_valid >= low) & (new_valid <= high)).all()):
+                continue
+            edges = histogram["edges"]
+            removed = self._counts(old_values, old_target, edges, log_scale)
+            added = self._counts(new_values, new_target, edges, log_scale)
+            store._cache[(feature, log_scale)] = {
+                "edges": edges,
+                "counts": {t: histogram["counts"][t] - removed[t] + added[t]
+                           for t in (0, 1)}}
+            store._bounds[(feature, log_scale)] = bounds
+        return store
+
+    def get(self, feature:str, log_scale:bool=False) -> dict:
+        """Bin edges and counts per TARGET value ({"edges": ...,
+        "counts": {0: ..., 1: ...}}) of feature"""
+        key = (feature, log_scale)
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = self._compute(feature, log_scale)
+            return self._cache[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._bounds.clear()
+
+
+def category_summary(data:pd.core.frame.DataFrame,
+                     feature:str,
+                     score_col:str="SCORE",
+                     target_col:str="TARGET") -> pd.core.frame.DataFrame:
+    """Statistics of the customers for each level of a categorical feature:
+    number of customers, sum of the scores, percentage of defaulters and
+    box plot statistics of the scores (quartiles, and whiskers at the most
+    extreme scores within 1.5 IQR of the quartiles)"""
+    levels = data[feature]
+    scores = data[score_col]
+    groups = scores.groupby(levels)
+    quartiles = groups.quantile([0.25, 0.5, 0.75]).unstack()
+
+    summary = pd.DataFrame({
+        "count": groups.size(),
+        "score_sum": groups.sum(),
+        "defaulter_rate": data[target_col].groupby(levels).mean() * 100,
+        "q1": quartiles[0.25],
+        "median": quartiles[0.5],
+        "q3": quartiles[0.75],
+        })
+
+    iqr = summary["q3"] - summary["q1"]
+    inside = (scores >= levels.map(summary["q1"] - 1.5 * iqr)) \
+           & (scores <= levels.map(summary["q3"] + 1.5 * iqr))
+    summary["lowerfence"] = scores[inside].groupby(levels[inside]).min()
+    summary["upperfence"] = scores[inside].groupby(levels[inside]).max()
+    return summary
+
+
+# Box plot statistics of the levels of a categorical feature
+BOX_COLUMNS = ["q1", "median", "q3", "lowerfence", "upperfence"]
+
+
+def _level_totals(levels:np.ndarray, scores:np.ndarray,
+                  target:np.ndarray) -> pd.core.frame.DataFrame:
+    """Number of customers, sum of the scores and number of defaulters for
+    each level (the missing levels are left out)"""
+    return pd.DataFrame({"count": np.ones(len(levels), dtype=int),
+                         "score_sum": scores,
+                         "defaulters": target.astype(int)})\
+             .groupby(levels).sum()
+
+
+class CategoryStore:
+    """Summary tables (see category_summary) of the categorical features,
+    so that the box and pie plots are drawn without going through the 
+    customers. Each table is built the first time it is requested (or by
+    compute_all) and then kept in memory."""
+    def __init__(self, data:pd.core.frame.DataFrame, features:list) -> None:
+        self.data = data
+        self.features = list(features)
+        self.summaries = {}
+        # Updated summaries whose box plot statistics of some levels are
+        # to be computed again (see updated): feature -> (summary, levels)
+        self._stale = {}
+        self._lock = threading.Lock()
+
+    def _with_boxes(self, feature:str, summary:pd.core.frame.DataFrame,
+                    levels:np.ndarray) -> pd.core.frame.DataFrame:
+        if not len(levels):
+            return summary
+        values = self.data[feature].to_numpy()
+        selected = np.isin(values, levels)
+        boxes = category_summary(pd.DataFrame({
+            feature: values[selected],
+            "SCORE": self.data["SCORE"].to_numpy()[selected],
+            "TARGET": self.data["TARGET"].to_numpy()[selected],
+            }), feature)[BOX_COLUMNS]
+        summary = summary.copy()
+        summary.loc[boxes.index, BOX_COLUMNS] = boxes
+        return summary
+
+    def get(self, feature:str) -> pd.core.frame.DataFrame:
+        with self._lock:
+            if feature not in self.summaries:
+                if feature in self._stale:
+                    summary, levels = self._stale.pop(feature)
+                    self.summaries[feature] = self._with_boxes(
+                        feature, summary, levels)
+                else:
+                    self.summaries[feature] = category_summary(self.data, 
+                                                               feature)
+            return self.summaries[feature]
+
+    def compute_all(self) -> None:
+        for feature in self.features:
+            self.get(feature)
+
+    def updated(self, data:pd.core.frame.DataFrame,
+                positions:np.ndarray) -> "CategoryStore":
+        """Store of data, the customers of this store whose rows at 
+        positions were changed or appended (at the end).
+
+        The number of customers, the sum of the scores and the percentage
+        of defaulters of the cached summaries are updated by removing the
+        previous rows of the changed customers and adding their new rows.
+        The box plot statistics of the levels of these rows are computed
+        again on first use, from the customers of these levels only.
+        """
+        store = CategoryStore(data, self.features)
+        positions = np.asarray(positions)
+        changed = positions[positions < len(self.data)]
+        old_scores = self.data["SCORE"].to_numpy()[changed]
+        old_target = self.data["TARGET"].to_numpy()[changed]
+        new_scores = data["SCORE"].to_numpy()[positions]
+        new_target = data["TARGET"].to_numpy()[positions]
+        with self._lock:
+            cached = {feature: (summary, []) 
+                      for feature, summary in self.summaries.items()}
+            cached.update(self._stale)
+        for feature, (summary, stale) in cached.items():
+            removed = _level_totals(self.data[feature].to_numpy()[changed],
+                                    old_scores, old_target)
+            added = _level_totals(data[feature].to_numpy()[positions],
+                                  new_scores, new_target)
+            totals = pd.DataFrame({
+                "count": summary["count"],
+                "score_sum": summary["score_sum"],
+                "defaulters": np.round(summary["defaulter_rate"] 
+                                       * summary["count"] / 100),
+                }).sub(removed, fill_value=0).add(added, fill_value=0)
+            totals = totals[totals["count"] > 0]
+            touched = np.union1d(removed.index, added.index)
+            updated = pd.DataFrame({
+                "count": totals["count"].astype(int),
+                "score_sum": totals["score_sum"],
+                "defaulter_rate": totals["defaulters"] / totals["count"] 
+                                  * 100,
+                }).join(summary[BOX_COLUMNS].drop(touched, errors="ignore"))
+            levels = np.union1d(stale, touched)
+            store._stale[feature] = (
+                updated.rename_axis(summary.index.name),
+                levels[np.isin(levels, updated.index)])
+        return store
@@ -0,0 +1,75 @@
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dash import DiskcacheManager
+
+
+class WorkerPoolManager(DiskcacheManager):
+    """Manager of the background callbacks running the jobs in a pool of
+    max_workers threads of the worker which received them, instead of a
+    process forked for each job: the jobs use the caches of the worker
+    (customer contexts, explanations, figures) and their timing spans are
+    recorded in its metrics.
+
+    The results, the progress and the state of the jobs go through the
+    disk cache, so that any worker answers the polling of the browser. A
+    running thread cannot be stopped: a cancelled job is skipped if it has
+    not started yet, and its result is dropped otherwise. The state of the
+    jobs of a worker which died expires after job_ttl seconds.
+    """
+    def __init__(self, cache, max_workers:int=4,
+                 job_ttl:float=3600) -> None:
+        super().__init__(cache)
+        self.max_workers = max_workers
+        self.job_ttl = job_ttl
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _executor(self) -> ThreadPoolExecutor:
+        # One pool per process (threads do not survive a fork)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pool = ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix="background-job")
+            return self._pool
+
+    @staticmethod
+    def _job_key(job:str) -> str:
+        return f"job-{job}"
+
+    @staticmethod
+    def _latest_key(key:str) -> str:
+        return f"latest-job-{key}"
+
+    def call_job_fn(self, key, job_fn, args, context) -> str:
+        job = uuid.uuid4().hex
+        self.handle.set(self._job_key(job), key, expire=self.job_ttl)
+        self.handle.set(self._latest_key(key), job, expire=self.job_ttl)
+        self._executor().submit(self._run_job, job, key, job_fn, args,
+                                context)
+        return job
+
+    def _run_job(self, job:str, key:str, job_fn, args, context) -> None:
+        if not self.job_running(job):
+            # Cancelled before it started
+            return
+        job_fn(key, self._make_progress_key(key), args, context)
+        if not self.job_running(job) \
+                and self.handle.get(self._latest_key(key)) == job:
+            # Cancelled while running, and not requested again since
+            self.clear_cache_entry(key)
+            self.clear_cache_entry(self._make_progress_key(key))
+
+    def job_running(self, job) -> bool:
+        # Until its result is read (see get_result) or it is cancelled
+        return bool(job) and self.handle.get(self._job_key(job)) is not None
+
+    def terminate_job(self, job) -> None:
+        if job:
+            self.handle.delete(self._job_key(job))
+
+    def terminate_unhealthy_job(self, job) -> bool:
+        return False
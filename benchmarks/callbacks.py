@@ -0,0 +1,247 @@
+"""Latency (p50/p95), peak memory and size of the serialized outputs of each
+Dash callback of main.py, on synthetic customer tables of several sizes
+(with the features of model.pkl) and with the scoring API replaced by a
+local stub. Each size runs in its own process, main.py being loaded at
+import.
+
+The results are saved as a JSON baseline, and the next runs are compared
+with it: the script exits with status 1 if a callback got slower (p95
+above --tolerance times the baseline) or if its output got larger.
+
+    python benchmarks/callbacks.py [--customers 2000 20000] [--calls 30]
+        [--api-latency 0] [--baseline cache/benchmarks/callbacks.json]
+        [--save]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import numpy as np
+import pandas as pd
+
+
+def synthetic_customers(n:int, feature_names:list,
+                        seed:int=0) -> pd.core.frame.DataFrame:
+    """n customers with the features of the model: one feature out of ten
+    has a few levels (categorical), the others are skewed and continuous,
+    with 10% of missing values"""
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for i, feature in enumerate(feature_names):
+        if i % 10 == 0:
+            columns[feature] = rng.integers(0, 2 + i % 4, n).astype(float)
+        else:
+            values = rng.lognormal(rng.uniform(0, 10), 1, n)
+            values[rng.random(n) < 0.1] = np.nan
+            columns[feature] = values
+    data = pd.DataFrame(columns)
+    data.index = pd.Index(np.arange(100000, 100000 + n), name="SK_ID_CURR")
+    return data
+
+
+class StubAPIHandler(BaseHTTPRequestHandler):
+    """/predict endpoint of the scoring API returning a constant score after
+    latency seconds"""
+    latency = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+        body = json.dumps({"score": 0.42}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_api(latency:float) -> str:
+    """Start the stub API in a background thread and return its url"""
+    StubAPIHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubAPIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/predict"
+
+
+def payload_size(output) -> int:
+    """Size (in bytes) of the JSON sent by Dash for the output"""
+    from plotly.io.json import to_json_plotly
+    return len(to_json_plotly(output))
+
+
+def measure(func, calls:list) -> dict:
+    """p50 and p95 (in ms) of the calls of func, then peak memory (in MB)
+    and output size (in bytes) of one more call with the first arguments"""
+    timings = []
+    for args in calls:
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    output = func(*calls[0])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    p50, p95 = np.percentile(timings, [50, 95]) * 1e3
+    return {"p50_ms": round(p50, 3),
+            "p95_ms": round(p95, 3),
+            "peak_mb": round(peak / 1e6, 3),
+            "payload_bytes": payload_size(output)}
+
+
+def run_callbacks(n_calls:int) -> dict:
+    """Measures of each callback of main.py (already configured by the
+    environment), each call with a new customer so that the per-customer
+    caches are cold"""
+    import main
+
+    # Without the figure cache (FIGURE_CACHE=none) the callbacks are the
+    # plain functions
+    ids = main.df.index.to_numpy()
+    customers = [int(ids[i]) for i in np.linspace(0, len(ids) - 1,
+                                                  n_calls + 1, dtype=int)]
+    continuous = [f for f in main.continuous_feat if f in main.df.columns]
+    categorical = [f for f in main.categorical_feat if f in main.df.columns]
+    feature1, feature2 = continuous[0], continuous[1]
+    feature3 = categorical[0]
+
+    # One untimed call per callback loads the model and the explainer and
+    # warms plotly up
+    cases = {
+        "set_value_gauge": (main.set_value_gauge,
+                            [(i,) for i in customers]),
+        "plot_feature_importance_local": (
+            main.plot_feature_importance_local,
+            [(i, 10) for i in customers]),
+        "plot_feature_importance_global": (
+            main.plot_feature_importance_global,
+            [(10,) for _ in customers]),
+        "plot_continuous_features": (
+            main.plot_continuous_features,
+            [(i, feature1, feature2, "Linear", "Linear") for i in customers]),
+        "plot_box": (main.plot_box, [(i, feature3) for i in customers]),
+        "plot_pie": (main.plot_pie, [(i, feature3) for i in customers]),
+    }
+    results = {}
+    for name, (func, calls) in cases.items():
+        func(*calls[-1])
+        results[name] = measure(func, calls[:-1])
+    return results
+
+
+def run_size(n:int, args) -> dict:
+    """Measures for n customers, in a new process"""
+    from shap_plots import ShapExplainer
+    from data_store import write_arrow
+
+    model = ShapExplainer(os.path.join(root, "model.pkl")).model
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_path = os.path.join(tmp_dir, "customers.arrow")
+        write_arrow(synthetic_customers(n, model.booster_.feature_name()),
+                    data_path)
+        env = {**os.environ,
+               "DATA_PATH": data_path,
+               "DATA_MODE": "memory",
+               "SCORING_BACKEND": "remote",
+               "FIGURE_CACHE": "none",
+               "WARM_UP": "0",
+               "BACKGROUND_CALLBACKS": "0"}
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker",
+             "--calls", str(args.calls),
+             "--api-latency", str(args.api_latency)],
+            cwd=root, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(f"Benchmark failed for {n} customers:\n{result.stderr}")
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def compare(results:dict, baseline:dict, tolerance:float) -> list:
+    """Regressions of results against baseline"""
+    regressions = []
+    for n, callbacks in results.items():
+        for name, current in callbacks.items():
+            previous = baseline.get(n, {}).get(name)
+            if previous is None:
+                continue
+            if current["p95_ms"] > tolerance * previous["p95_ms"]:
+                regressions.append(
+                    f"{name} ({n} customers): p95 {previous['p95_ms']:.1f}"
+                    f" -> {current['p95_ms']:.1f} ms")
+            if current["payload_bytes"] > previous["payload_bytes"] * 1.01:
+                regressions.append(
+                    f"{name} ({n} customers): payload "
+                    f"{previous['payload_bytes']} -> "
+                    f"{current['payload_bytes']} bytes")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--customers", type=int, nargs="+",
+                        default=[2000, 20000])
+    parser.add_argument("--calls", type=int, default=30,
+                        help="timed calls per callback")
+    parser.add_argument("--api-latency", type=float, default=0.0,
+                        help="response time of the stub API (in s)")
+    parser.add_argument("--baseline",
+                        default=os.path.join(root, "cache", "benchmarks",
+                                             "callbacks.json"))
+    parser.add_argument("--save", action="store_true",
+                        help="save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="allowed p95 ratio against the baseline")
+    parser.add_argument("--worker", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        os.environ["API_URL"] = start_stub_api(args.api_latency)
+        print(json.dumps(run_callbacks(args.calls)))
+        sys.exit()
+
+    results = {}
+    print(f"{'customers':>10} {'callback':<32}{'p50 (ms)':>10}{'p95 (ms)':>10}"
+          f"{'peak (MB)':>11}{'payload (B)':>13}")
+    for n in args.customers:
+        results[str(n)] = run_size(n, args)
+        for name, m in results[str(n)].items():
+            print(f"{n:>10} {name:<32}{m['p50_ms']:>10.1f}{m['p95_ms']:>10.1f}"
+                  f"{m['peak_mb']:>11.2f}{m['payload_bytes']:>13}")
+
+    status = 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if not regressions:
+            print(f"No regression against {args.baseline}")
+        status = 1 if regressions else 0
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "machine": platform.machine(),
+                       "calls": args.calls,
+                       "api_latency": args.api_latency,
+                       "results": results}, f, indent=2)
+        print(f"Baseline saved in {args.baseline}")
+    sys.exit(status)
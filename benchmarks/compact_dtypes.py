@@ -0,0 +1,72 @@
+"""Memory of the customers table and of the features matrix with the float64
+and the compact dtypes (DATA_DTYPES=compact), and differences of the scores,
+decisions and shap values computed from the compact features.
+
+    python benchmarks/compact_dtypes.py [data file] [--rows 5000]
+        [--customers 100000]
+
+Without data file, synthetic customers with the features of model.pkl are
+used (--customers).
+"""
+import argparse
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import numpy as np
+from callbacks import synthetic_customers
+from data_store import load_customers, compact_customers, features_view
+from shap_plots import ShapExplainer, check_dtypes
+
+threshold = 0.658
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("data", nargs="?",
+                        help="Arrow, Parquet or csv file of the customers")
+    parser.add_argument("--customers", type=int, default=100000)
+    parser.add_argument("--rows", type=int, default=5000,
+                        help="customers scored and explained both ways")
+    args = parser.parse_args()
+
+    explainer = ShapExplainer(os.path.join(root, "model.pkl"),
+                              backend="native")
+    if args.data:
+        data = load_customers(args.data).drop(columns=["SCORE", "TARGET"],
+                                              errors="ignore")
+    else:
+        data = synthetic_customers(args.customers,
+                                   explainer.model.booster_.feature_name())
+    data = data.astype(np.float64)
+
+    features = features_view(data)
+    compact = compact_customers(data)
+    compact_features = features_view(compact, np.float32)
+
+    print(f"{len(data)} customers, {data.shape[1]} features "
+          f"({(compact.dtypes == np.int8).sum()} stored as int8)")
+    print(f"{'':<20}{'float64 (MB)':>14}{'compact (MB)':>14}{'saved':>8}")
+    total, total_compact = 0, 0
+    for name, before, after in (
+            ("customers table", data.memory_usage(deep=True).sum(),
+             compact.memory_usage(deep=True).sum()),
+            ("features matrix", features.memory_usage(deep=True).sum(),
+             compact_features.memory_usage(deep=True).sum())):
+        total, total_compact = total + before, total_compact + after
+        print(f"{name:<20}{before / 1e6:>14.1f}{after / 1e6:>14.1f}"
+              f"{1 - after / before:>8.0%}")
+    print(f"{'total':<20}{total / 1e6:>14.1f}{total_compact / 1e6:>14.1f}"
+          f"{1 - total_compact / total:>8.0%}")
+
+    n_rows = min(args.rows, len(data))
+    differences = check_dtypes(features, n_rows=n_rows)
+    scores = explainer.model.predict_proba(features.iloc[:n_rows])[:, 1]
+    compact_scores = explainer.model.predict_proba(
+        compact_features.iloc[:n_rows])[:, 1]
+    flips = ((scores >= threshold) != (compact_scores >= threshold)).sum()
+    print(f"On {n_rows} customers: max score difference "
+          f"{differences['score']:.2e}, max shap value difference "
+          f"{differences['shap']:.2e}, {flips} decisions changed")
@@ -0,0 +1,70 @@
+"""Cold start of main.py: time to import it (until the app can serve
+requests), time until the warm-up thread has loaded the model, and the
+modules which take the longest to import (python -X importtime).
+
+    python benchmarks/import_time.py [--top 15] [--json report.json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(code:str, **env) -> tuple:
+    """Wall time (in s) and stderr of python -X importtime -c code"""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            cwd=root, env={**os.environ, **env},
+                            capture_output=True, text=True, check=True)
+    return time.perf_counter() - start, result.stderr
+
+
+def parse_importtime(stderr:str) -> list:
+    """Module, nesting level, self time and cumulative time (in seconds) 
+    of each import"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            continue
+        # The indentation gives the nesting level of the import
+        level = (len(module) - len(module.lstrip()) - 1) // 2
+        imports.append({"module": module.strip(),
+                        "level": level,
+                        "self": int(self_us) / 1e6,
+                        "cumulative": int(cumulative_us) / 1e6})
+    return imports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--json", help="Also write the report in this file")
+    args = parser.parse_args()
+
+    import_wall, stderr = run("import main", WARM_UP="0")
+    ready_wall, _ = run("import main; main.app_ready.wait()", WARM_UP="1")
+    imports = parse_importtime(stderr)
+    # main.py and the modules it imports directly
+    top_level = [i for i in imports if i["level"] <= 1]
+    top_level.sort(key=lambda i: i["cumulative"], reverse=True)
+
+    report = {"import_main": import_wall, 
+              "ready": ready_wall,
+              "modules": top_level[:args.top]}
+
+    print(f"python -c 'import main': {import_wall:.2f} s")
+    print(f"until the warm-up is done: {ready_wall:.2f} s")
+    print(f"{'module':<40}{'self (s)':>10}{'cumulative (s)':>16}")
+    for i in report["modules"]:
+        print(f"{i['module']:<40}{i['self']:>10.3f}{i['cumulative']:>16.3f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,299 @@
+"""Load test of the app served by gunicorn: concurrent advisors replay the
+Dash requests (_dash-update-component) of realistic sessions (search and
+select a customer, move the sliders, pick features) against a server
+started locally, with the scoring API replaced by a local stub. The
+throughput and the latencies are reported for each number of workers and
+worker class (sync, gthread, gevent).
+
+    python benchmarks/load_test.py [--workers 1 2 4]
+        [--worker-class sync gthread gevent] [--threads 4] [--users 8]
+        [--duration 30] [--warmup 5] [--think-time 0] [--api-latency 0.05]
+        [--customers 20000] [--json report.json]
+
+The load generator runs on the same machine as the server: on a small
+machine it takes part of the CPU the workers would otherwise have.
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import numpy as np
+import requests
+from callbacks import start_stub_api, synthetic_customers
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def effective_threads(worker_class:str, threads:int) -> int:
+    """Threads per worker: gunicorn runs the sync workers as gthread as 
+    soon as threads > 1, so only the gthread workers get threads"""
+    return threads if worker_class == "gthread" else 1
+
+
+def start_server(port:int, workers:int, worker_class:str, threads:int,
+                 env:dict, log, timeout:float=300) -> subprocess.Popen:
+    """Start gunicorn with the configuration of the app and wait until
+    the workers are ready. The logs of gunicorn are written in the file
+    log (never in a pipe, which would block the server once full)."""
+    command = [sys.executable, "-m", "gunicorn",
+               "--config", "gunicorn.conf.py",
+               "--bind", f"127.0.0.1:{port}",
+               "--workers", str(workers),
+               "--worker-class", worker_class,
+               "--threads", str(effective_threads(worker_class, threads)),
+               "--timeout", "120",
+               "main:server"]
+    process = subprocess.Popen(command, cwd=root, env=env,
+                               stdout=subprocess.DEVNULL, stderr=log)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            log.seek(0)
+            raise RuntimeError(f"gunicorn exited:\n{log.read()}")
+        try:
+            response = requests.get(f"http://127.0.0.1:{port}/ready",
+                                    timeout=5)
+            if response.status_code == 200:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    process.kill()
+    raise RuntimeError("gunicorn did not get ready in time")
+
+
+def stop_server(process:subprocess.Popen) -> None:
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def layout_props(node, props:dict) -> None:
+    """Initial (id, property) -> value of the components of the layout"""
+    if isinstance(node, list):
+        for child in node:
+            layout_props(child, props)
+    elif isinstance(node, dict):
+        component_props = node.get("props", {})
+        if "id" in component_props:
+            for name, value in component_props.items():
+                if name not in ("id", "children"):
+                    props[(component_props["id"], name)] = value
+        for value in component_props.values():
+            layout_props(value, props)
+
+
+def output_spec(output:str):
+    """outputs field of a request for the output string of a callback"""
+    if not output.startswith(".."):
+        component_id, prop = output.rsplit(".", 1)
+        return {"id": component_id, "property": prop}
+    return [dict(zip(("id", "property"), o.rsplit(".", 1)))
+            for o in output.strip(".").split("...")]
+
+
+class Advisor:
+    """Session of an advisor: the dashboard state and the requests the
+    Dash renderer sends when an input changes"""
+    def __init__(self, base_url:str, dependencies:list, props:dict,
+                 customers:list, continuous:list, categorical:list,
+                 seed:int) -> None:
+        self.base_url = base_url
+        self.dependencies = dependencies
+        self.props = dict(props)
+        self.customers = customers
+        self.continuous = continuous
+        self.categorical = categorical
+        self.rng = random.Random(seed)
+        self.session = requests.Session()
+
+    def _body(self, dependency:dict, changed:list) -> dict:
+        value = lambda d: {**d, "value": self.props.get((d["id"],
+                                                         d["property"]))}
+        return {"output": dependency["output"],
+                "outputs": output_spec(dependency["output"]),
+                "inputs": [value(d) for d in dependency["inputs"]],
+                "state": [value(d) for d in dependency["state"]],
+                "changedPropIds": [f"{i}.{p}" for i, p in changed]}
+
+    def change(self, changes:dict, record) -> None:
+        """Apply the changes to the inputs and send the request of every
+        callback depending on them (all the callbacks if changes is
+        empty, as on page load)"""
+        self.props.update(changes)
+        for dependency in self.dependencies:
+            inputs = [(d["id"], d["property"]) for d in dependency["inputs"]]
+            changed = [key for key in inputs if key in changes]
+            if changes and not changed:
+                continue
+            if not changes and ("id_client", "search_value") in inputs:
+                continue
+            start = time.perf_counter()
+            try:
+                response = self.session.post(
+                    f"{self.base_url}/_dash-update-component",
+                    json=self._body(dependency, changed), timeout=120)
+                ok = response.status_code in (200, 204)
+            except requests.RequestException:
+                ok = False
+            record(dependency["output"], time.perf_counter() - start, ok)
+
+    def steps(self):
+        """Input changes of one session"""
+        customer = self.rng.choice(self.customers)
+        yield {}
+        yield {("id_client", "search_value"): str(customer)[:4]}
+        yield {("id_client", "value"): customer}
+        yield {("nb_features_local", "value"): self.rng.randint(5, 15)}
+        yield {("nb_features_global", "value"): self.rng.randint(5, 15)}
+        yield {("feature_1", "value"): self.rng.choice(self.continuous)}
+        yield {("feature_2", "value"): self.rng.choice(self.continuous)}
+        yield {("crossfilter-xaxis-type", "value"):
+               self.rng.choice(["Linear", "Log"])}
+        yield {("feature_3", "value"): self.rng.choice(self.categorical)}
+
+
+def run_load(base_url:str, users:int, duration:float, warmup:float,
+             think_time:float) -> dict:
+    """Sessions of users concurrent advisors during warmup + duration
+    seconds; the requests of the warm-up are not counted"""
+    dependencies = requests.get(f"{base_url}/_dash-dependencies").json()
+    props = {}
+    layout_props(requests.get(f"{base_url}/_dash-layout").json(), props)
+    customers = requests.get(f"{base_url}/customers/search",
+                             params={"q": "1", "limit": 100}).json()
+    continuous = props[("feature_1", "options")]
+    categorical = props[("feature_3", "options")]
+
+    start = time.perf_counter()
+    measure_from = start + warmup
+    deadline = measure_from + duration
+    results = []
+    lock = threading.Lock()
+
+    def record(output, latency, ok):
+        if time.perf_counter() >= measure_from:
+            with lock:
+                results.append((output, latency, ok))
+
+    def advisor_loop(seed):
+        advisor = Advisor(base_url, dependencies, props, customers,
+                          continuous, categorical, seed)
+        while time.perf_counter() < deadline:
+            for changes in advisor.steps():
+                if time.perf_counter() >= deadline:
+                    return
+                advisor.change(changes, record)
+                time.sleep(think_time)
+
+    threads = [threading.Thread(target=advisor_loop, args=(seed,))
+               for seed in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies = np.array([latency for _, latency, _ in results])
+    errors = sum(not ok for _, _, ok in results)
+    report = {"requests": len(results),
+              "errors": errors,
+              "throughput": len(results) / duration}
+    if len(latencies):
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1e3
+        report.update({"p50_ms": p50, "p95_ms": p95, "p99_ms": p99})
+        report["p95_ms_by_output"] = {
+            output: float(np.percentile(
+                [l for o, l, _ in results if o == output], 95) * 1e3)
+            for output in sorted({o for o, _, _ in results})}
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--worker-class", nargs="+",
+                        default=["sync", "gthread", "gevent"])
+    parser.add_argument("--threads", type=int, default=4,
+                        help="threads per gthread worker")
+    parser.add_argument("--users", type=int, default=8,
+                        help="concurrent advisors")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=5)
+    parser.add_argument("--think-time", type=float, default=0.0,
+                        help="pause of an advisor between two actions (s)")
+    parser.add_argument("--api-latency", type=float, default=0.05,
+                        help="response time of the stub API (in s)")
+    parser.add_argument("--customers", type=int, default=None,
+                        help="synthetic customers instead of DATA_PATH")
+    parser.add_argument("--json", help="write the results in this file")
+    args = parser.parse_args()
+
+    env = {**os.environ,
+           "API_URL": start_stub_api(args.api_latency),
+           "SCORING_BACKEND": "remote"}
+    tmp_dir = tempfile.TemporaryDirectory()
+    if args.customers:
+        from shap_plots import ShapExplainer
+        from data_store import write_arrow
+        model = ShapExplainer(os.path.join(root, "model.pkl")).model
+        env["DATA_PATH"] = os.path.join(tmp_dir.name, "customers.arrow")
+        write_arrow(synthetic_customers(args.customers,
+                                        model.booster_.feature_name()),
+                    env["DATA_PATH"])
+
+    rows = []
+    print(f"{'class':>8}{'workers':>9}{'threads':>9}{'requests':>10}"
+          f"{'errors':>8}{'req/s':>8}{'p50 (ms)':>10}{'p95 (ms)':>10}"
+          f"{'p99 (ms)':>10}")
+    for worker_class in args.worker_class:
+        if worker_class == "gevent":
+            try:
+                import gevent
+            except ImportError:
+                print("gevent is not installed (pip install gevent), "
+                      "skipping the gevent workers")
+                continue
+        for workers in args.workers:
+            port = free_port()
+            with tempfile.TemporaryFile("w+") as log:
+                server = start_server(port, workers, worker_class, 
+                                      args.threads, env, log)
+                try:
+                    report = run_load(f"http://127.0.0.1:{port}", args.users,
+                                      args.duration, args.warmup,
+                                      args.think_time)
+                finally:
+                    stop_server(server)
+            rows.append({"worker_class": worker_class, "workers": workers,
+                         "threads": effective_threads(worker_class, 
+                                                      args.threads),
+                         "users": args.users, **report})
+            print(f"{worker_class:>8}{workers:>9}{rows[-1]['threads']:>9}"
+                  f"{report['requests']:>10}{report['errors']:>8}"
+                  f"{report['throughput']:>8.1f}"
+                  f"{report.get('p50_ms', np.nan):>10.1f}"
+                  f"{report.get('p95_ms', np.nan):>10.1f}"
+                  f"{report.get('p99_ms', np.nan):>10.1f}")
+    tmp_dir.cleanup()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"users": args.users, "duration": args.duration,
+                       "api_latency": args.api_latency, "results": rows},
+                      f, indent=2)
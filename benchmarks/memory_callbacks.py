@@ -0,0 +1,85 @@
+"""Peak memory allocated by the Dash callbacks of main.py, compared with the
+whole-DataFrame copies they used to make.
+
+    python benchmarks/memory_callbacks.py [customer id]
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import plotly.express as px
+import main
+
+
+def peak_allocation(func, *args) -> int:
+    """Peak of the memory allocated (in bytes) while func(*args) runs"""
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+# Previous implementations, kept here as reference points
+def legacy_gauge_input(unique_id):
+    return main.df.copy().loc[unique_id, :].fillna("_").to_dict()
+
+
+def legacy_feature_importance_local(customer_id, nb_features):
+    background_data = main.df.copy().drop(columns=["SCORE", "TARGET"])
+    return main.shap_explainer.plot_local(background_data,
+                                          customer_id,
+                                          nb_features)
+
+
+def legacy_scatter(unique_id, feature1, feature2):
+    data = main.df.copy().drop(index=unique_id)
+    return px.scatter(data, x=feature1, y=feature2, color=data["SCORE"],
+                      hover_name=data.index.to_numpy())
+
+
+def current_gauge_input(unique_id):
+    return main.features_data.loc[unique_id, :]
+
+
+# Current implementations, called without the figure cache
+def current_feature_importance_local(customer_id, nb_features):
+    return main.plot_feature_importance_local.__wrapped__(customer_id,
+                                                          nb_features)
+
+
+def current_scatter(unique_id, feature1, feature2):
+    return main.plot_continuous_features.__wrapped__(unique_id, feature1,
+                                                     feature2, "Linear",
+                                                     "Linear")
+
+
+if __name__ == "__main__":
+    customer_id = int(sys.argv[1]) if len(sys.argv) > 1 else main.df.index[0]
+    feature1, feature2 = "AMT_INCOME_TOTAL", "AMT_CREDIT"
+
+    # Warm-up (SHAP explanation cache, plotly templates)
+    current_feature_importance_local(customer_id, 10)
+    current_scatter(customer_id, feature1, feature2)
+
+    cases = [
+        ("gauge input",
+         (legacy_gauge_input, customer_id),
+         (current_gauge_input, customer_id)),
+        ("feature importance local",
+         (legacy_feature_importance_local, customer_id, 10),
+         (current_feature_importance_local, customer_id, 10)),
+        ("bivariate scatter",
+         (legacy_scatter, customer_id, feature1, feature2),
+         (current_scatter, customer_id, feature1, feature2)),
+    ]
+
+    print(f"{len(main.df)} customers, {main.df.shape[1]} columns, "
+          f"DataFrame size {main.df.memory_usage().sum() / 1e6:.1f} MB")
+    print(f"{'callback':<26}{'legacy (MB)':>14}{'current (MB)':>14}")
+    for name, legacy, current in cases:
+        legacy_peak = peak_allocation(*legacy) / 1e6
+        current_peak = peak_allocation(*current) / 1e6
+        print(f"{name:<26}{legacy_peak:>14.2f}{current_peak:>14.2f}")
@@ -0,0 +1,52 @@
+"""Size of the JSON payload and time needed to build the bivariate graph for
+each rendering mode, against the number of customers (synthetic data).
+
+    python benchmarks/scatter_payload.py [n customers ...]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from aggregations import stratified_sample
+from scatter_plots import plot_bivariate
+
+max_points = 5000
+modes = ("points", "webgl", "sample", "density")
+
+
+def synthetic_customers(n:int, seed:int=0) -> tuple:
+    rng = np.random.default_rng(seed)
+    x = rng.lognormal(12, 0.5, n)
+    y = x * rng.lognormal(1, 0.4, n)
+    scores = rng.beta(2, 5, n)
+    ids = np.arange(100000, 100000 + n)
+    return x, y, scores, ids
+
+
+def measure(mode:str, x, y, scores, ids, sample) -> tuple:
+    """Callback time (figure + JSON serialization, in ms) and payload
+    size (in KB)"""
+    start = time.perf_counter()
+    fig = plot_bivariate(x, y, scores, ids, 0, "x", "y", "Linear", "Log",
+                         mode=mode, max_points=max_points, sample=sample)
+    payload = fig.to_json()
+    elapsed = time.perf_counter() - start
+    return elapsed * 1e3, len(payload) / 1e3
+
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or [1000, 10000, 100000]
+
+    # Warm-up (plotly templates and validators)
+    measure("points", *synthetic_customers(100), None)
+
+    print(f"{'customers':>10}{'mode':>10}{'time (ms)':>12}{'payload (KB)':>15}")
+    for n in sizes:
+        x, y, scores, ids = synthetic_customers(n)
+        sample = stratified_sample(scores, max_points)
+        for mode in modes:
+            elapsed, size = measure(mode, x, y, scores, ids, sample)
+            print(f"{n:>10}{mode:>10}{elapsed:>12.1f}{size:>15.1f}")
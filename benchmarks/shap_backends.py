@@ -0,0 +1,66 @@
+"""Latency of the explanation of a single customer and throughput on the
+whole table for each explainer backend of shap_plots.py (synthetic data
+with the features of model.pkl).
+
+    python benchmarks/shap_backends.py [n customers]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+from shap_plots import ShapExplainer, EXPLAINER_BACKENDS
+
+model_path = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "model.pkl")
+
+
+def synthetic_features(model, n:int, seed:int=0) -> pd.core.frame.DataFrame:
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n, model.n_features_in_))
+    # Missing values go through the default branches of the trees
+    X[rng.random(X.shape) < 0.1] = np.nan
+    return pd.DataFrame(X, columns=model.booster_.feature_name())
+
+
+def single_row_latency(explainer, X, n_calls:int=200) -> tuple:
+    """p50 and p95 (in ms) of the explanation of one row"""
+    timings = []
+    for i in range(n_calls):
+        row = X.iloc[[i % len(X)]]
+        start = time.perf_counter()
+        explainer.shap_values(row)
+        timings.append(time.perf_counter() - start)
+    return tuple(np.percentile(timings, [50, 95]) * 1e3)
+
+
+def throughput(explainer, X) -> float:
+    """Rows explained per second on the whole table"""
+    start = time.perf_counter()
+    explainer.shap_values(X)
+    return len(X) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    print(f"{'backend':>8}{'init (ms)':>12}{'p50 (ms)':>11}{'p95 (ms)':>11}"
+          f"{'rows/s':>11}")
+    for backend in EXPLAINER_BACKENDS:
+        start = time.perf_counter()
+        explainer = ShapExplainer(model_path, backend=backend)
+        # The model and the explainer are loaded on first use: the base 
+        # value forces their loading within the timed section
+        explainer.base_value
+        init = (time.perf_counter() - start) * 1e3
+        X = synthetic_features(explainer.model, n)
+
+        # Warm-up
+        explainer.shap_values(X.iloc[:10])
+        p50, p95 = single_row_latency(explainer, X)
+        rows_per_s = throughput(explainer, X)
+        print(f"{backend:>8}{init:>12.0f}{p50:>11.2f}{p95:>11.2f}"
+              f"{rows_per_s:>11.0f}")
@@ -0,0 +1,182 @@
+import io
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from data_store import index_col
+
+# Output formats of the bulk endpoint and their content types
+FORMATS = {"ndjson": "application/x-ndjson",
+           "arrow": "application/vnd.apache.arrow.stream"}
+
+# Decisions, the same as those displayed by the dashboard
+GRANTED = "Crédit accordé"
+REFUSED = "Crédit refusé"
+UNKNOWN = "Identifiant incorrect"
+
+# Schema of the Arrow stream
+SCHEMA = pa.schema([
+    (index_col, pa.int64()),
+    ("SCORE", pa.float64()),
+    ("decision", pa.string()),
+    ("contributions", pa.list_(pa.struct([("feature", pa.string()),
+                                          ("shap_value", pa.float64())]))),
+    ])
+
+
+def top_contributions(shap_values:np.ndarray,
+                      feature_names:list,
+                      top_k:int) -> list:
+    """For each row of shap_values (n_samples x n_features), the top_k
+    features with the largest absolute shap values, in decreasing order,
+    as lists of {"feature": ..., "shap_value": ...}"""
+    n_samples, n_features = shap_values.shape
+    top_k = min(top_k, n_features)
+    if top_k <= 0:
+        return [[] for _ in range(n_samples)]
+
+    abs_values = np.abs(shap_values)
+    # Unordered top_k of each row in O(n_features), then sorted
+    top = np.argpartition(-abs_values, top_k - 1, axis=1)[:, :top_k]
+    order = np.argsort(-np.take_along_axis(abs_values, top, axis=1),
+                       axis=1, kind="stable")
+    top = np.take_along_axis(top, order, axis=1)
+    top_values = np.take_along_axis(shap_values, top, axis=1)
+
+    feature_names = np.asarray(feature_names, dtype=object)
+    return [[{"feature": feature, "shap_value": float(value)}
+             for feature, value in zip(feature_names[row], values)]
+            for row, values in zip(top, top_values)]
+
+
+def bulk_results(ids:np.ndarray,
+                 positions:np.ndarray,
+                 score_fn,
+                 shap_fn,
+                 feature_names:list,
+                 threshold:float,
+                 top_k:int=5,
+                 chunk_size:int=1000):
+    """Scores, decisions and top_k shap contributions of the customers,
+    yielded by chunks of chunk_size customers as dicts of columns.
+
+    positions are the rows of the customers in the data read by
+    score_fn(positions) -> scores and shap_fn(positions) -> shap values,
+    -1 for the unknown customers (no score, decision UNKNOWN).
+    """
+    for start in range(0, len(positions), chunk_size):
+        chunk_ids = ids[start:start + chunk_size]
+        chunk_positions = positions[start:start + chunk_size]
+        known = chunk_positions >= 0
+
+        scores = np.full(len(chunk_positions), np.nan)
+        contributions = [[] for _ in range(len(chunk_positions))]
+        if known.any():
+            scores[known] = score_fn(chunk_positions[known])
+            if top_k > 0:
+                known_contributions = top_contributions(
+                    shap_fn(chunk_positions[known]), feature_names, top_k)
+                for i, row in zip(np.flatnonzero(known), known_contributions):
+                    contributions[i] = row
+
+        decisions = np.where(scores < threshold, GRANTED, REFUSED)\
+                      .astype(object)
+        decisions[~known] = UNKNOWN
+        yield {index_col: chunk_ids,
+               "SCORE": scores,
+               "decision": decisions,
+               "contributions": contributions}
+
+
+def _python_ids(ids) -> list:
+    return [None if pd.isna(i) else int(i) for i in ids]
+
+
+def to_ndjson(chunks):
+    """One JSON line per customer (unknown scores are null)"""
+    for chunk in chunks:
+        lines = []
+        for unique_id, score, decision, contributions in zip(
+                _python_ids(chunk[index_col]), chunk["SCORE"],
+                chunk["decision"], chunk["contributions"]):
+            lines.append(json.dumps({
+                index_col: unique_id,
+                "SCORE": None if np.isnan(score) else float(score),
+                "decision": str(decision),
+                "contributions": contributions,
+                }, ensure_ascii=False))
+        yield "\n".join(lines) + "\n"
+
+
+def to_arrow_stream(chunks):
+    """Arrow IPC stream with one record batch per chunk (see SCHEMA)"""
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, SCHEMA) as writer:
+        for chunk in chunks:
+            writer.write_batch(pa.record_batch([
+                pa.array(_python_ids(chunk[index_col]), pa.int64()),
+                pa.array(chunk["SCORE"], pa.float64(),
+                         mask=np.isnan(chunk["SCORE"])),
+                pa.array(chunk["decision"].tolist(), pa.string()),
+                pa.array(chunk["contributions"],
+                         SCHEMA.field("contributions").type),
+                ], schema=SCHEMA))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
+
+
+def read_rows(stream, filename:str) -> pd.core.frame.DataFrame:
+    """Customers uploaded as a csv, Arrow/Feather or Parquet file"""
+    if filename.endswith((".arrow", ".feather")):
+        return feather.read_table(stream).to_pandas()
+    if filename.endswith(".parquet"):
+        return pd.read_parquet(stream)
+    return pd.read_csv(stream)
+
+
+def parse_ids(ids) -> np.ndarray:
+    """Ids of a JSON body as floats (NaN for the ids which are not numbers,
+    unknown to the index). Raises ValueError if ids is not a list of
+    scalars."""
+    if not isinstance(ids, list) or not all(
+            i is None or isinstance(i, (int, float, str)) for i in ids):
+        raise ValueError("ids must be a list of customer ids")
+    return pd.to_numeric(pd.Series(ids, dtype=object),
+                         errors="coerce").to_numpy(dtype=float)
+
+
+def parse_rows(rows) -> pd.core.frame.DataFrame:
+    """Customers of a JSON body (a list of objects feature -> value).
+    Raises ValueError otherwise."""
+    if not isinstance(rows, list) or not all(isinstance(row, dict)
+                                             for row in rows):
+        raise ValueError("rows must be a list of objects")
+    return pd.DataFrame(rows)
+
+
+def rows_features(rows:pd.core.frame.DataFrame,
+                  feature_names:list) -> tuple:
+    """Ids (missing if the rows have no SK_ID_CURR column) and float64
+    features of uploaded rows, in the column order of the model, with the
+    columns of the rows unknown to the model and the features missing from
+    the rows (NaN). Raises ValueError if the rows have none of the
+    features."""
+    if index_col in rows.columns:
+        ids = rows[index_col].to_numpy()
+    elif rows.index.name == index_col:
+        ids = rows.index.to_numpy()
+    else:
+        ids = np.full(len(rows), np.nan)
+    columns = [str(col) for col in rows.columns if col != index_col]
+    known_features, known_columns = set(feature_names), set(columns)
+    unknown = [col for col in columns if col not in known_features]
+    missing = [col for col in feature_names if col not in known_columns]
+    if len(missing) == len(feature_names):
+        raise ValueError("the rows have none of the features of the model")
+    features = rows.reindex(columns=feature_names)
+    matrix = np.ascontiguousarray(features.to_numpy(dtype=float))
+    return ids, pd.DataFrame(matrix, columns=feature_names, copy=False), \
+        unknown, missing
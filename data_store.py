@@ -0,0 +1,194 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# Name of the column identifying the customers
+index_col = "SK_ID_CURR"
+
+# Columns which are not features of the model
+non_feature_cols = ["SCORE", "TARGET"]
+
+
+def read_csv(filepath:str) -> pd.core.frame.DataFrame:
+    """Read the csv file of customers (local path or url)"""
+    return pd.read_csv(filepath).set_index(index_col).sort_index()
+
+
+def write_arrow(data:pd.core.frame.DataFrame, filepath:str) -> None:
+    """Save the customers in an uncompressed Arrow (feather v2) file.
+
+    The NaN are kept as float values instead of Arrow nulls so that the
+    columns can be read back without any conversion (see read_arrow).
+    """
+    data = data.sort_index()
+    arrays = [pa.array(data.index.to_numpy(), from_pandas=False)] \
+           + [pa.array(data[col].to_numpy(), from_pandas=False)
+              for col in data.columns]
+    table = pa.Table.from_arrays(arrays,
+                                 names=[index_col] + data.columns.tolist())
+
+    # Write in a temporary file so that a worker never reads a partially
+    # written file
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+    tmp_filepath = filepath + ".tmp"
+    feather.write_feather(table, tmp_filepath, compression="uncompressed")
+    os.replace(tmp_filepath, filepath)
+
+
+def read_arrow(filepath:str) -> pd.core.frame.DataFrame:
+    """Read the customers from an Arrow file written by write_arrow.
+
+    The file is memory-mapped: the columns are not parsed and their pages
+    are shared between the processes through the OS cache.
+    """
+    with pa.memory_map(filepath, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+    index = pd.Index(table.column(index_col).to_numpy(), name=index_col)
+    data = table.drop([index_col]).to_pandas(split_blocks=True)
+    data.index = index
+    return data
+
+
+def load_customers(filepath:str) -> pd.core.frame.DataFrame:
+    """Load the customers from an Arrow, Parquet or csv file, indexed and
+    sorted by SK_ID_CURR"""
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension in (".arrow", ".feather"):
+        return read_arrow(filepath)
+    if extension == ".parquet":
+        data = pd.read_parquet(filepath, memory_map=True)
+        if index_col in data.columns:
+            data = data.set_index(index_col)
+        return data.sort_index()
+    return read_csv(filepath)
+
+
+class CustomerIndex:
+    """Hashed index of the customer ids.
+
+    Checking an id and finding its row position are O(1) lookups in the
+    hash table of a pandas Index. The ids are also kept sorted as strings
+    so that the ids starting with a given prefix are found by binary search
+    (O(log n)) for the customer dropdown.
+    """
+    def __init__(self, ids:pd.Index) -> None:
+        self.ids = pd.Index(ids)
+        str_ids = self.ids.astype(str).to_numpy().astype(str)
+        order = np.argsort(str_ids, kind="stable")
+        self._sorted_str_ids = str_ids[order]
+        self._sorted_ids = self.ids.to_numpy()[order]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, unique_id) -> bool:
+        return self.position(unique_id) is not None
+
+    def position(self, unique_id):
+        """Row position of the customer unique_id, None if it is unknown"""
+        try:
+            position = self.ids.get_loc(unique_id)
+        except (KeyError, TypeError, pd.errors.InvalidIndexError):
+            return None
+        return position if isinstance(position, (int, np.integer)) else None
+
+    def positions(self, ids) -> np.ndarray:
+        """Row positions of several customers at once, -1 for the unknown
+        ids"""
+        return self.ids.get_indexer(pd.Index(ids))
+
+    def appended(self, ids) -> "CustomerIndex":
+        """Index with the new customers ids appended (at the row positions
+        len(self), len(self) + 1, ...). The sorted ids are merged with the
+        new ones instead of being sorted again."""
+        new_ids = pd.Index(ids, name=self.ids.name)
+        str_ids = new_ids.astype(str).to_numpy().astype(str)
+        order = np.argsort(str_ids, kind="stable")
+        where = np.searchsorted(self._sorted_str_ids, str_ids[order], 
+                                side="right")
+        index = CustomerIndex.__new__(CustomerIndex)
+        index.ids = self.ids.append(new_ids)
+        # np.insert casts the values to the dtype of the array: the longer
+        # string ids must not be truncated
+        str_dtype = np.result_type(self._sorted_str_ids, str_ids)
+        index._sorted_str_ids = np.insert(
+            self._sorted_str_ids.astype(str_dtype), where, str_ids[order])
+        index._sorted_ids = np.insert(self._sorted_ids, where,
+                                      new_ids.to_numpy()[order])
+        return index
+
+    def search(self, prefix:str, limit:int=20) -> list:
+        """At most limit ids starting with prefix, in lexicographic order"""
+        prefix = str(prefix).strip()
+        start = np.searchsorted(self._sorted_str_ids, prefix, side="left")
+        end = np.searchsorted(self._sorted_str_ids, prefix + "\uffff", 
+                              side="left")
+        return self._sorted_ids[start:min(end, start + limit)].tolist()
+
+
+def compact_customers(data:pd.core.frame.DataFrame,
+                      categorical_feat:list=None) -> pd.core.frame.DataFrame:
+    """Copy of the customers with compact dtypes: int8 for the categorical
+    features whose levels are integers between -128 and 127 without
+    missing values, float32 for the other features. SCORE and TARGET are
+    kept as is.
+
+    categorical_feat defaults to the features with at most 10 distinct
+    values.
+    """
+    if categorical_feat is None:
+        n_unique = data.nunique()
+        categorical_feat = n_unique[n_unique <= 10].index
+    categorical_feat = set(categorical_feat)
+
+    columns = {}
+    for col in data.columns:
+        values = data[col].to_numpy()
+        if col in non_feature_cols:
+            columns[col] = values
+        elif (col in categorical_feat
+              and not np.isnan(values).any()
+              and (values == np.round(values)).all()
+              and (len(values) == 0
+                   or (values.min() >= -128 and values.max() <= 127))):
+            columns[col] = values.astype(np.int8)
+        else:
+            columns[col] = values.astype(np.float32)
+    return pd.DataFrame(columns, index=data.index)
+
+
+def features_view(data:pd.core.frame.DataFrame,
+                  dtype=np.float64) -> pd.core.frame.DataFrame:
+    """Features of the customers (every column except SCORE and TARGET) 
+    as a DataFrame of dtype (float64 by default, float32 with compact 
+    dtypes) backed by a single read-only C-contiguous array.
+
+    Reading a row of this frame costs O(features) and never copies the
+    whole table.
+    """
+    feature_names = data.columns.drop(non_feature_cols, errors="ignore")
+    if not feature_names.equals(data.columns):
+        data = data[feature_names]
+    # No copy if data is already a single block of dtype (e.g. the memory-
+    # mapped matrix of a CustomerStore)
+    matrix = np.ascontiguousarray(data.to_numpy(dtype=dtype))
+    matrix.flags.writeable = False
+    return pd.DataFrame(matrix, index=data.index, columns=feature_names, 
+                        copy=False)
+
+
+if __name__ == "__main__":
+    # One-time conversion of the csv file of customers:
+    # python data_store.py <csv file or url> data/customers_data.arrow
+    parser = argparse.ArgumentParser(
+        description="Convert the csv file of customers to an Arrow file")
+    parser.add_argument("source", help="csv file (local path or url)")
+    parser.add_argument("destination", nargs="?",
+                        default="data/customers_data.arrow")
+    args = parser.parse_args()
+
+    write_arrow(load_customers(args.source), args.destination)
+    print(args.destination)
@@ -0,0 +1,260 @@
+import argparse
+import os
+import threading
+import numpy as np
+import pandas as pd
+from data_store import index_col, non_feature_cols
+from aggregations import bin_edges
+
+
+def _quote(name:str) -> str:
+    """SQL identifier"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _literal(value:str) -> str:
+    """SQL string literal"""
+    return "'" + value.replace("'", "''") + "'"
+
+
+class DuckDBStore:
+    """SQL view of the customers stored in a local Parquet or DuckDB file
+    (table customers), joined with their scores.
+
+    The queries run in DuckDB (multithreaded) on the file, which can be
+    shared by all the workers of the machine. Each process opens its own
+    in-memory connection on first use (DuckDB connections must not cross
+    a fork) and each thread its own cursor. The view data has the columns
+    of the file plus pos (row position of the customer in scores), SCORE
+    and TARGET.
+    """
+    def __init__(self, source:str,
+                 scores:pd.core.series.Series,
+                 threshold:float) -> None:
+        try:
+            import duckdb
+        except ImportError as e:
+            raise ImportError("The duckdb aggregations backend requires the "
+                              "duckdb package (pip install duckdb)") from e
+        self.duckdb = duckdb
+        self.source = source
+        self.scores = pd.DataFrame({
+            index_col: scores.index.to_numpy(),
+            "pos": np.arange(len(scores)),
+            "SCORE": scores.to_numpy(),
+            "TARGET": (scores.to_numpy() >= threshold).astype(int),
+            })
+        self._pid = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _connect(self) -> None:
+        con = self.duckdb.connect()
+        if self.source.endswith(".duckdb"):
+            con.execute(f"ATTACH {_literal(self.source)} AS store "
+                        "(READ_ONLY)")
+            con.execute("CREATE VIEW customers AS "
+                        "SELECT * FROM store.customers")
+        else:
+            con.execute("CREATE VIEW customers AS SELECT * FROM "
+                        f"read_parquet({_literal(self.source)})")
+        con.register("scores_frame", self.scores)
+        con.execute("CREATE TABLE scores AS SELECT * FROM scores_frame")
+        con.unregister("scores_frame")
+
+        # The scores of the file (if any) are replaced by those of the app
+        columns = [row[0] for row in
+                   con.execute("DESCRIBE customers").fetchall()]
+        features = ", ".join(f"c.{_quote(name)}" for name in columns
+                             if name not in non_feature_cols)
+        con.execute(f"CREATE VIEW data AS SELECT {features}, s.pos, "
+                    "s.SCORE, s.TARGET FROM customers c JOIN scores s "
+                    f"USING ({_quote(index_col)})")
+
+        # Every customer of the app must be in the file exactly once, 
+        # otherwise the columns would not line up with the scores and ids
+        n_rows, n_positions = con.execute(
+            "SELECT count(*), count(DISTINCT pos) FROM data").fetchone()
+        if n_rows != len(self.scores) or n_positions != len(self.scores):
+            con.close()
+            raise ValueError(
+                f"{self.source} does not hold the customers of the app: "
+                f"{n_positions} of the {len(self.scores)} customers found "
+                f"({n_rows} rows)")
+        self._con = con
+        self._pid = os.getpid()
+
+    def cursor(self):
+        """Cursor of the current thread"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._connect()
+        if getattr(self._local, "pid", None) != self._pid:
+            self._local.cursor = self._con.cursor()
+            self._local.pid = self._pid
+        return self._local.cursor
+
+    def query(self, sql:str, parameters:list=None) -> pd.core.frame.DataFrame:
+        return self.cursor().execute(sql, parameters or []).df()
+
+    def columns(self, names:list, positions:np.ndarray=None) -> dict:
+        """Arrays of the columns names of the customers ordered by row
+        position, only for the given positions (sorted) if any"""
+        names = list(dict.fromkeys(names))
+        where = ""
+        parameters = []
+        if positions is not None:
+            where = "WHERE pos IN (SELECT UNNEST(?::BIGINT[]))"
+            parameters = [np.asarray(positions).tolist()]
+        result = self.query(
+            f"SELECT {', '.join(_quote(name) for name in names)} FROM data "
+            f"{where} ORDER BY pos", parameters)
+        return {name: result[name].to_numpy(dtype=float, na_value=np.nan)
+                for name in names}
+
+
+class DuckDBHistograms:
+    """Histograms of the continuous features for each value of TARGET,
+    computed in SQL with the same bins as aggregations.HistogramStore"""
+    def __init__(self, store:DuckDBStore, nbins:int=50) -> None:
+        self.store = store
+        self.nbins = nbins
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _compute(self, feature:str, log_scale:bool) -> dict:
+        x = _quote(feature)
+        valid = f"abs({x}) < 'infinity'::DOUBLE"
+        if log_scale:
+            valid += f" AND {x} > 0"
+        low, high = self.store.cursor().execute(
+            f"SELECT min({x}), max({x}) FROM data WHERE {valid}").fetchone()
+        values = np.empty(0) if low is None else np.array([low, high])
+        edges = bin_edges(values, log_scale, self.nbins)
+
+        # First guess of the bin from the bounds, then corrected against
+        # the bin edges (right edge included in the last bin, as numpy)
+        if log_scale:
+            guess = f"ln({x} / e[1]) / ln(e[{self.nbins + 1}] / e[1])"
+        else:
+            guess = f"({x} - e[1]) / (e[{self.nbins + 1}] - e[1])"
+        counts = self.store.query(f"""
+            SELECT target, bin, count(*) AS n FROM (
+                SELECT target, CASE
+                    WHEN x < e[i + 1] THEN i - 1
+                    WHEN i < {self.nbins - 1} AND x >= e[i + 2] THEN i + 1
+                    ELSE i END AS bin
+                FROM (
+                    SELECT TARGET AS target, {x} AS x, e,
+                           least(greatest(floor({guess} * {self.nbins}), 0),
+                                 {self.nbins - 1})::INTEGER AS i
+                    FROM data, (SELECT ?::DOUBLE[] AS e)
+                    WHERE {valid}
+                    )
+                )
+            GROUP BY target, bin""", [edges.tolist()])
+
+        result = {target: np.zeros(self.nbins, dtype=np.int64)
+                  for target in (0, 1)}
+        for target, bin_, n in counts.itertuples(index=False):
+            result[int(target)][int(bin_)] = n
+        return {"edges": edges, "counts": result}
+
+    def get(self, feature:str, log_scale:bool=False) -> dict:
+        key = (feature, log_scale)
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = self._compute(feature, log_scale)
+            return self._cache[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+
+class DuckDBCategories:
+    """Statistics of the score for each level of the categorical features
+    (see aggregations.category_summary), computed in SQL on first use"""
+    def __init__(self, store:DuckDBStore, features:list) -> None:
+        self.store = store
+        self.features = list(features)
+        self.summaries = {}
+        self._lock = threading.Lock()
+
+    def _compute(self, feature:str) -> pd.core.frame.DataFrame:
+        level = _quote(feature)
+        summary = self.store.query(f"""
+            WITH s AS (
+                SELECT {level} AS level, SCORE, TARGET FROM data
+                WHERE {level} IS NOT NULL AND NOT isnan({level})
+                ),
+            q AS (
+                SELECT level,
+                       count(*) AS "count",
+                       sum(SCORE) AS score_sum,
+                       avg(TARGET) * 100 AS defaulter_rate,
+                       quantile_cont(SCORE, 0.25) AS q1,
+                       quantile_cont(SCORE, 0.5) AS "median",
+                       quantile_cont(SCORE, 0.75) AS q3
+                FROM s GROUP BY level
+                )
+            SELECT q.*,
+                   min(s.SCORE) AS lowerfence,
+                   max(s.SCORE) AS upperfence
+            FROM q JOIN s USING (level)
+            WHERE s.SCORE >= q.q1 - 1.5 * (q.q3 - q.q1)
+              AND s.SCORE <= q.q3 + 1.5 * (q.q3 - q.q1)
+            GROUP BY q.level, q."count", q.score_sum, q.defaulter_rate,
+                     q.q1, q."median", q.q3
+            ORDER BY level""")
+        return summary.set_index("level").rename_axis(feature)
+
+    def get(self, feature:str) -> pd.core.frame.DataFrame:
+        with self._lock:
+            if feature not in self.summaries:
+                self.summaries[feature] = self._compute(feature)
+            return self.summaries[feature]
+
+    def compute_all(self) -> None:
+        for feature in self.features:
+            self.get(feature)
+
+
+def write_parquet(source:str, destination:str) -> None:
+    """Convert a csv, Arrow or Parquet file of customers to the Parquet
+    (or, with a .duckdb extension, DuckDB) file read by DuckDBStore"""
+    import duckdb
+    extension = os.path.splitext(source)[1].lower()
+    if extension == ".parquet":
+        relation = f"read_parquet({_literal(source)})"
+    elif extension in (".arrow", ".feather"):
+        import pyarrow.feather as feather
+        arrow_table = feather.read_table(source, memory_map=True)
+        relation = "arrow_table"
+    else:
+        relation = f"read_csv_auto({_literal(source)}, sample_size=-1)"
+
+    con = duckdb.connect(destination if destination.endswith(".duckdb")
+                         else ":memory:")
+    if relation == "arrow_table":
+        con.register("arrow_table", arrow_table)
+    if destination.endswith(".duckdb"):
+        con.execute("CREATE OR REPLACE TABLE customers AS "
+                    f"SELECT * FROM {relation}")
+    else:
+        con.execute(f"COPY (SELECT * FROM {relation}) "
+                    f"TO {_literal(destination)} (FORMAT PARQUET)")
+    con.close()
+
+
+if __name__ == "__main__":
+    # python duckdb_store.py <csv file> data/customers_data.parquet
+    parser = argparse.ArgumentParser(
+        description="Write the Parquet or DuckDB file of the customers")
+    parser.add_argument("source", help="csv, Arrow or Parquet file")
+    parser.add_argument("destination", nargs="?",
+                        default="data/customers_data.parquet")
+    args = parser.parse_args()
+
+    write_parquet(args.source, args.destination)
+    print(args.destination)
@@ -0,0 +1,287 @@
+import functools
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from plotly.io.json import to_json_plotly
+
+# Available cache backends
+BACKENDS = ("memory", "file", "redis", "none")
+
+
+class MemoryBackend:
+    """In-process LRU cache (one per worker). The values are stored as is."""
+    def __init__(self, maxsize:int=512) -> None:
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key:str):
+        with self._lock:
+            if key not in self._data:
+                return None
+            expires_at, value = self._data[key]
+            if expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key:str, value, ttl:float) -> None:
+        with self._lock:
+            self._data[key] = (time.time() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def use_version(self, version:str) -> None:
+        # The least recently used entries, those of the previous versions
+        # included, are evicted above maxsize
+        pass
+
+
+class FileBackend:
+    """Cache shared by all the workers of the machine through a directory.
+    The values are stored as JSON files along with their expiry time, in a
+    subdirectory per version of the cache (see use_version).
+
+    The expired files are deleted when they are read, and every 
+    check_every writes the files of every version which are expired or the
+    oldest above max_files are deleted, along with the directories of the
+    versions left empty. The previous versions are not deleted at once: 
+    the workers change versions at different times, and a worker still on
+    a previous version (or restarted on the startup version) keeps using 
+    its directory.
+    """
+    def __init__(self, directory:str="cache/figures", 
+                 max_files:int=10000,
+                 check_every:int=100) -> None:
+        self.directory = directory
+        self.max_files = max_files
+        self.check_every = check_every
+        self.version_dir = directory
+        self._writes = 0
+        # Longest ttl of the files written by this process, after which the
+        # files are expired whatever their ttl (None before any write)
+        self._max_ttl = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def use_version(self, version:str) -> None:
+        """Store the entries in the subdirectory of version"""
+        name = hashlib.sha256(version.encode()).hexdigest()[:16]
+        self.version_dir = os.path.join(self.directory, name)
+        os.makedirs(self.version_dir, exist_ok=True)
+
+    def _path(self, key:str) -> str:
+        filename = hashlib.sha256(key.encode()).hexdigest() + ".json"
+        return os.path.join(self.version_dir, filename)
+
+    def get(self, key:str):
+        filepath = self._path(key)
+        try:
+            with open(filepath) as f:
+                expires_at, value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if expires_at < time.time():
+            _remove(filepath)
+            return None
+        return value
+
+    def set(self, key:str, value, ttl:float) -> None:
+        filepath = self._path(key)
+        tmp_filepath = f"{filepath}.{os.getpid()}.tmp"
+        try:
+            # The directory of the version may have been deleted by the 
+            # trim of another worker once empty
+            os.makedirs(self.version_dir, exist_ok=True)
+            with open(tmp_filepath, "w") as f:
+                f.write(f"[{time.time() + ttl}, {to_json_plotly(value)}]")
+            os.replace(tmp_filepath, filepath)
+        except OSError:
+            # The figure is not cached (e.g. disk full)
+            _remove(tmp_filepath)
+            return
+        with self._lock:
+            self._max_ttl = ttl if self._max_ttl is None \
+                else max(self._max_ttl, ttl)
+            self._writes += 1
+            check = self._writes % self.check_every == 0
+        if check:
+            self.trim()
+
+    def trim(self) -> None:
+        """Delete the files of every version which are expired or the 
+        oldest above max_files, and the empty directories of the other
+        versions"""
+        entries = []
+        try:
+            version_dirs = [entry.path for entry in os.scandir(self.directory)
+                            if entry.is_dir()]
+        except OSError:
+            return
+        for version_dir in version_dirs:
+            try:
+                entries.extend(entry for entry in os.scandir(version_dir)
+                               if entry.name.endswith(".json"))
+            except OSError:
+                pass
+        entries = sorted((_mtime(entry), entry.path) for entry in entries)
+        expired_before = float("-inf") if self._max_ttl is None \
+            else time.time() - self._max_ttl
+        n_removed = max(len(entries) - self.max_files, 0)
+        for i, (mtime, path) in enumerate(entries):
+            if i >= n_removed and mtime >= expired_before:
+                break
+            _remove(path)
+        for version_dir in version_dirs:
+            if version_dir != self.version_dir:
+                try:
+                    # Only deleted if empty
+                    os.rmdir(version_dir)
+                except OSError:
+                    pass
+
+    def clear(self) -> None:
+        for entry in os.listdir(self.directory):
+            _remove(os.path.join(self.directory, entry))
+        os.makedirs(self.version_dir, exist_ok=True)
+
+
+def _mtime(entry) -> float:
+    try:
+        return entry.stat().st_mtime
+    except OSError:
+        return 0.0
+
+
+def _remove(path:str) -> None:
+    """Delete a file or a directory, ignoring the files already deleted
+    (e.g. by another worker)"""
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class RedisBackend:
+    """Cache shared through a Redis-compatible server (requires the redis
+    package). The values are stored as JSON with a Redis TTL."""
+    def __init__(self, url:str="redis://localhost:6379/0",
+                 prefix:str="figures:") -> None:
+        try:
+            import redis
+        except ImportError as e:
+            raise ImportError("The redis figure cache backend requires the "
+                              "redis package (pip install redis)") from e
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key:str):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key:str, value, ttl:float) -> None:
+        self.client.set(self.prefix + key, to_json_plotly(value),
+                        ex=max(1, int(ttl)))
+
+    def clear(self) -> None:
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+    def use_version(self, version:str) -> None:
+        # The entries of the previous versions expire with their Redis TTL
+        pass
+
+
+class FigureCache:
+    """Cache of the outputs of the callbacks, keyed by their inputs.
+
+    The keys are prefixed by a version (e.g. the model and dataset
+    fingerprints): changing it (directly or with invalidate) makes every
+    previous entry unreachable, and the backend lets them expire (memory
+    LRU, file trim, redis TTL). With the file and redis backends the 
+    cached figures are returned as plain JSON structures (dicts), which 
+    Dash renders like the original figures.
+    """
+    def __init__(self, backend=None, version:str="", ttl:float=3600) -> None:
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.version = version
+
+    @property
+    def version(self) -> str:
+        return self._version
+
+    @version.setter
+    def version(self, version:str) -> None:
+        """Change the version of the entries, the previous ones being left
+        to expire by the backend"""
+        self._version = version
+        if self.backend is not None:
+            self.backend.use_version(version)
+
+    def invalidate(self, version:str=None) -> None:
+        if version is not None:
+            self.version = version
+        if self.backend is not None:
+            self.backend.clear()
+
+    def memoize(self, func):
+        """Cache the results of func keyed by its positional arguments. The
+        keyword arguments are passed to func but are not part of the key:
+        the positional arguments must identify them (e.g. a data version
+        for the data passed as keyword argument)."""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if self.backend is None:
+                return func(*args, **kwargs)
+            key = json.dumps([self.version, func.__name__, args], default=str)
+            entry = self.backend.get(key)
+            if entry is not None:
+                with self._lock:
+                    self.hits += 1
+                # Multiple outputs come back as lists from JSON
+                if entry["tuple"]:
+                    return tuple(entry["value"])
+                return entry["value"]
+            with self._lock:
+                self.misses += 1
+            value = func(*args, **kwargs)
+            self.backend.set(key, 
+                             {"tuple": isinstance(value, tuple), 
+                              "value": value}, 
+                             self.ttl)
+            return value
+        return wrapper
+
+
+def get_backend(name:str, directory:str="cache/figures",
+                redis_url:str="redis://localhost:6379/0",
+                maxsize:int=512,
+                max_files:int=10000):
+    """Build the cache backend name ("memory", "file", "redis" or "none")"""
+    if name == "memory":
+        return MemoryBackend(maxsize)
+    if name == "file":
+        return FileBackend(directory, max_files)
+    if name == "redis":
+        return RedisBackend(redis_url)
+    if name == "none":
+        return None
+    raise ValueError(f"Unknown figure cache backend {name!r}, "
+                     f"expected one of {BACKENDS}")
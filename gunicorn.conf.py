@@ -0,0 +1,29 @@
+import gc
+import os
+import sys
+
+# Import main.py (customers table, model, SHAP explainer, scores and layout)
+# once in the master process. The workers are forked afterwards and share
+# these read-only objects copy-on-write instead of each building its own
+# copy. Set PRELOAD_APP=0 to build them in every worker.
+preload_app = os.environ.get("PRELOAD_APP", "1") == "1"
+
+# The number of workers is read from WEB_CONCURRENCY by gunicorn (Heroku
+# sets it according to the dyno size)
+
+
+def when_ready(server):
+    # Move every object built by the preload in the permanent generation
+    # of the garbage collector: the collections run by the workers would
+    # otherwise write in the header of these objects and un-share their
+    # memory pages
+    if preload_app:
+        # Wait for the warm-up thread of main.py before the workers are 
+        # forked: they then share what it loaded, and none of them is 
+        # forked while the thread holds a lock it would wait for forever
+        main = sys.modules.get("main")
+        if main is not None and main.warm_up:
+            main.app_ready.wait()
+        gc.freeze()
+        server.log.info("Preloaded app, %d objects frozen",
+                        gc.get_freeze_count())
@@ -1,43 +1,472 @@
-from dash import Dash, html, dcc, Output, Input
+import functools
+import json
+import os
+import threading
+import time
+import numpy as np
+import flask
+from dash import Dash, html, dcc, Output, Input, State
+from dash.exceptions import PreventUpdate
 import pandas as pd
 import dash_bootstrap_components as dbc
 import dash_daq as daq
-import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-import requests
 from shap_plots import ShapExplainer
+from scoring import get_scorer, load_or_batch_score, batch_score
+from data_store import (load_customers, compact_customers, features_view, 
+                        CustomerIndex)
+from aggregations import HistogramStore, CategoryStore, StratifiedSample
+from scatter_plots import plot_bivariate, resolve_mode
+from figure_cache import FigureCache, get_backend
+from metrics import Metrics, SamplingProfiler, cache_samples
+from streaming import CustomerStore
+from duckdb_store import DuckDBStore, DuckDBHistograms, DuckDBCategories
+from refresh import Snapshot, DataRefresher, apply_updates, next_version
+from utils import data_hash
+from background import WorkerPoolManager
+import bulk
 
-# Loading the dataset of customers
+# Data mode: "memory" (the customers are loaded in a DataFrame) or 
+# "streaming" (the customers are read from the on-disk store built by 
+# python streaming.py <file> STORE_DIR, for files larger than memory)
+data_mode = os.environ.get("DATA_MODE", "memory")
+
+# Dtypes of the customers in memory mode: "float64" (as read) or "compact"
+# (float32 features, int8 categorical features and bool TARGET, see 
+# data_store.compact_customers; python benchmarks/compact_dtypes.py reports
+# the memory saved and the differences of the scores and shap values)
+data_dtypes = os.environ.get("DATA_DTYPES", "float64")
+if data_dtypes not in ("float64", "compact"):
+    raise ValueError(f"Unknown data dtypes {data_dtypes!r}, "
+                     "expected 'float64' or 'compact'")
+compact_dtypes = data_mode != "streaming" and data_dtypes == "compact"
+
+# Loading the dataset of customers: from the local Arrow file if it exists
+# (python data_store.py <csv> data/customers_data.arrow), otherwise from 
+# the csv file on GitHub
 filepath1 = "https://raw.githubusercontent.com/tcgilles/oc_projet7_dashboard/main/data/customers_data_1.csv"
-df = pd.read_csv(filepath1).set_index("SK_ID_CURR").sort_index()
+data_path = os.environ.get("DATA_PATH", "data/customers_data.arrow")
+if data_mode == "streaming":
+    # Memory-mapped features, types of features, histograms and category
+    # statistics precomputed by the ingestion
+    customer_store = CustomerStore(os.environ.get("STORE_DIR", "data/store"))
+    df = customer_store.frame()
+    continuous_feat = customer_store.continuous_feat
+    categorical_feat = customer_store.categorical_feat
+else:
+    customer_store = None
+    df = load_customers(data_path if os.path.exists(data_path) else filepath1)
 
-# Types of features
-continuous_feat = df.nunique()[df.nunique()>10].index.tolist()
-categorical_feat = df.nunique()[df.nunique()<=10].index.tolist()
+    # Types of features
+    n_unique = df.nunique()
+    continuous_feat = n_unique[n_unique>10].index.tolist()
+    categorical_feat = n_unique[n_unique<=10].index.tolist()
+    if compact_dtypes:
+        df = compact_customers(df, categorical_feat)
 
-# List of customers
-customers_list = df.index.tolist()
+# Hashed index of the customers (validation, row positions and search)
+customer_index = CustomerIndex(df.index)
 
 # Threshold
 threshold = 0.658
 
-# Adding a column TARGET
-df["TARGET"] = df["SCORE"].apply(lambda x: 0 if x < threshold else 1)
-
 # API url
-api_url = 'https://api-home-credit-risk.herokuapp.com/predict'
+api_url = os.environ.get("API_URL", 
+                         'https://api-home-credit-risk.herokuapp.com/predict')
+
+# Scoring backend: "precomputed" (scores of all the customers computed at 
+# startup), "local" (in-process model), "remote" (API) or "checked" 
+# (in-process model checked against the API)
+scoring_backend = os.environ.get("SCORING_BACKEND", "precomputed")
+
+# Number of processes used to score all the customers at startup
+scoring_n_jobs = int(os.environ.get("SCORING_N_JOBS", 1))
+
+# Timeouts (in seconds) and number of retries of the calls to the API
+api_connect_timeout = float(os.environ.get("API_CONNECT_TIMEOUT", 3.05))
+api_read_timeout = float(os.environ.get("API_READ_TIMEOUT", 10))
+api_retries = int(os.environ.get("API_RETRIES", 2))
+
+# Explainer backend: "native" (contributions of the LightGBM booster) or
+# "shap" (shap.TreeExplainer)
+explainer_backend = os.environ.get("EXPLAINER_BACKEND", "native")
+
+# Load the model, the explainer and the statistics of the categorical 
+# features in a background thread at startup (WARM_UP=1), otherwise on the
+# first request which needs them
+warm_up = os.environ.get("WARM_UP", "1") == "1"
+
+# Read-only float matrix of the features of the customers, shared by the
+# callbacks (they must never copy the whole DataFrame)
+features_data = features_view(df, 
+                              np.float32 if compact_dtypes else np.float64)
+
+# Fingerprint of the features versioning the caches of the scores, shap
+# values and figures: computed once, or read from the store in streaming 
+# mode instead of going through the memory-mapped matrix
+if customer_store is not None and customer_store.data_version is not None:
+    data_version = customer_store.data_version
+else:
+    data_version = data_hash(features_data)
+
+# Initializing the SHAP explainer, computing the global feature
+# importances once for all and mapping the precomputed local shap values 
+# if they exist (python shap_plots.py --data ...). When these are cached,
+# the model is not needed to start the app and is loaded lazily
+shap_explainer = ShapExplainer(backend=explainer_backend)
+shap_explainer.fit_global(features_data, data_version=data_version)
+shap_explainer.load_local(features_data, data_version)
+
+# The scores and aggregates of the store are used if it was built with the
+# same model and threshold
+use_store_aggregates = customer_store is not None \
+    and customer_store.model_version == shap_explainer.model_version \
+    and customer_store.meta["threshold"] == threshold
+
+# Scoring all the customers at once with the model, so that the SCORE 
+# column and the gauge always agree, and adding a column TARGET
+if use_store_aggregates:
+    df["SCORE"] = customer_store.scores
+else:
+    df["SCORE"] = load_or_batch_score(lambda: shap_explainer.model, 
+                                      shap_explainer.model_version,
+                                      features_data,
+                                      data_version=data_version,
+                                      n_jobs=scoring_n_jobs)
+if compact_dtypes:
+    df["TARGET"] = df["SCORE"] >= threshold
+else:
+    df["TARGET"] = (df["SCORE"] >= threshold).astype(int)
+
+# Memory used by the customers table and the features matrix, and what
+# they would use with float64 columns (see DATA_DTYPES)
+data_memory = {
+    "customers": (int(df.memory_usage(deep=True).sum()),
+                  int(df.index.memory_usage() + df.size * 8)),
+    "features": (int(features_data.memory_usage(deep=True).sum()),
+                 int(features_data.index.memory_usage() 
+                     + features_data.size * 8)),
+    }
+
+class CustomerContext:
+    """Data of a selected customer shared by all the per-customer outputs:
+    snapshot of the data it was read from, row position, features, score 
+    and shap values. The score (except from the API, see score) and the 
+    shap values are only computed the first time they are needed."""
+    def __init__(self, data:Snapshot, unique_id:int, position:int) -> None:
+        self.data = data
+        self.unique_id = unique_id
+        self.position = position
+        self._score = None
+
+    @property
+    def features(self) -> pd.core.series.Series:
+        return self.data.features_data.iloc[self.position]
+
+    @property
+    def score(self) -> float:
+        if self._score is not None:
+            return self._score
+        with metrics.span(score_span):
+            score = self.data.scorer.score(self.features)
+        # The remote backend returns the precomputed score while the API is
+        # failing: it is asked again next time instead of being kept once 
+        # the API is back
+        if scoring_backend != "remote":
+            self._score = score
+        return score
+
+    @functools.cached_property
+    def shap_values(self) -> np.ndarray:
+        with metrics.span("shap_values"):
+            return self.data.explainer.local_shap_values(
+                self.data.features_data, self.unique_id)
+
+
+@functools.lru_cache(maxsize=1024)
+def customer_context(data:Snapshot, unique_id):
+    """Context of the customer unique_id in the snapshot data, built once 
+    per customer, or None if the id is unknown"""
+    position = data.customer_index.position(unique_id)
+    if position is None:
+        return None
+    return CustomerContext(data, unique_id, position)
+
+
+def get_customer_context(unique_id):
+    """Context of the customer unique_id in the current snapshot"""
+    return customer_context(snapshot, unique_id)
+
+
+# Aggregations backend of the exploration plots: "pandas" (in-process) or
+# "duckdb" (SQL queries on the Parquet or DuckDB file DUCKDB_SOURCE, built
+# by python duckdb_store.py <file> DUCKDB_SOURCE and shared by the workers)
+aggregations_backend = os.environ.get("AGGREGATIONS_BACKEND", "pandas")
+if aggregations_backend == "duckdb":
+    duckdb_store = DuckDBStore(
+        os.environ.get("DUCKDB_SOURCE", "data/customers_data.parquet"),
+        df["SCORE"], threshold)
+elif aggregations_backend == "pandas":
+    duckdb_store = None
+else:
+    raise ValueError(f"Unknown aggregations backend {aggregations_backend!r}"
+                     ", expected 'pandas' or 'duckdb'")
+
+# Histograms of the continuous features, binned server-side on first use,
+# and statistics of each level of the categorical features (precomputed
+# by the ingestion in streaming mode)
+if duckdb_store is not None:
+    histograms = DuckDBHistograms(duckdb_store)
+    category_stats = DuckDBCategories(duckdb_store, categorical_feat)
+elif use_store_aggregates:
+    histograms = customer_store.histograms
+    category_stats = customer_store.category_stats
+else:
+    histograms = HistogramStore(df)
+    category_stats = CategoryStore(df, categorical_feat)
+
+# Set once the warm-up is done (see WARM_UP)
+app_ready = threading.Event()
+
+
+def warm_up_app() -> None:
+    # Accessing the model loads it along with the explainer
+    shap_explainer.model
+    category_stats.compute_all()
+    app_ready.set()
+
+
+if warm_up:
+    threading.Thread(target=warm_up_app, name="warm-up", daemon=True).start()
+else:
+    app_ready.set()
 
-# Initializing the SHAP explainer
-shap_explainer = ShapExplainer()
+# Rendering mode of the bivariate graph ("auto", "points", "webgl", 
+# "sample" or "density", see scatter_plots.py) and number of customers 
+# above which "auto" draws a stratified sample of them
+scatter_mode = os.environ.get("SCATTER_MODE", "auto")
+scatter_max_points = int(os.environ.get("SCATTER_MAX_POINTS", 5000))
+scatter_sample = StratifiedSample(df["SCORE"].to_numpy(), scatter_max_points)
+
+# Initializing the scorer with the model of the explainer (only loaded here
+# by the backends which score in-process)
+scoring_model = shap_explainer.model \
+    if scoring_backend in ("local", "checked") else None
+scorer = get_scorer(scoring_backend, scoring_model, api_url, 
+                    scores=df["SCORE"],
+                    connect_timeout=api_connect_timeout,
+                    read_timeout=api_read_timeout,
+                    retries=api_retries)
+
+
+# Cache of the figures keyed by the inputs of the callbacks: "memory" 
+# (per worker, default), "file" (shared by the workers through 
+# FIGURE_CACHE_DIR, at most FIGURE_CACHE_MAX_FILES files), "redis" (shared
+# through REDIS_URL) or "none". The entries are versioned by the model and
+# dataset fingerprints
+figure_cache = FigureCache(
+    get_backend(os.environ.get("FIGURE_CACHE", "memory"),
+                directory=os.environ.get("FIGURE_CACHE_DIR", "cache/figures"),
+                redis_url=os.environ.get("REDIS_URL", 
+                                         "redis://localhost:6379/0"),
+                max_files=int(os.environ.get("FIGURE_CACHE_MAX_FILES", 
+                                             10000))),
+    version=f"{shap_explainer.model_version}-{data_version}",
+    ttl=float(os.environ.get("FIGURE_CACHE_TTL", 3600)),
+    )
+
+# Data read by the callbacks, replaced as a whole when customers are added
+# or updated (see REFRESH_DIR). Each request reads it once; df, 
+# features_data, customer_index, ... remain the data loaded at startup
+snapshot = Snapshot(df=df,
+                    features_data=features_data,
+                    customer_index=customer_index,
+                    scorer=scorer,
+                    explainer=shap_explainer,
+                    histograms=histograms,
+                    category_stats=category_stats,
+                    scatter_sample=scatter_sample,
+                    version=data_version)
+
+# Directory polled every REFRESH_INTERVAL seconds (10 by default) by each
+# worker for csv, Arrow or Parquet files of new or updated customers (see 
+# refresh.py): only the changed customers are scored and explained and the
+# new snapshot replaces the current one without restarting the workers.
+# Their scores and shap values are computed by the first worker and read
+# back from the cache directory by the others; each worker still reads the
+# files and updates its own copy of the data and of the aggregates.
+# Not set by default, memory data mode and pandas aggregations only
+refresh_dir = os.environ.get("REFRESH_DIR")
+refresh_interval = float(os.environ.get("REFRESH_INTERVAL", 10))
+if refresh_dir and (customer_store is not None or duckdb_store is not None):
+    raise ValueError("REFRESH_DIR requires DATA_MODE=memory and "
+                     "AGGREGATIONS_BACKEND=pandas")
+
+
+def refresh_data(files:dict, rows:pd.core.frame.DataFrame) -> bool:
+    """Apply the rows read from files to the current snapshot and swap the
+    new snapshot in. Returns False if no customer changed."""
+    global snapshot
+    new_snapshot = apply_updates(snapshot, rows, threshold,
+                                 next_version(snapshot.version, files),
+                                 cache_dir=shap_explainer.cache_dir)
+    if new_snapshot is None:
+        return False
+    snapshot = new_snapshot
+    customer_context.cache_clear()
+    # The figures of the previous data are no longer reachable. The version
+    # changes after the snapshot so that no figure of the previous data is
+    # cached under the new version
+    figure_cache.version = f"{shap_explainer.model_version}-" \
+                           f"{new_snapshot.version}"
+    data_memory["customers"] = (
+        int(new_snapshot.df.memory_usage(deep=True).sum()),
+        int(new_snapshot.df.index.memory_usage() + new_snapshot.df.size * 8))
+    data_memory["features"] = (
+        int(new_snapshot.features_data.memory_usage(deep=True).sum()),
+        int(new_snapshot.features_data.index.memory_usage() 
+            + new_snapshot.features_data.size * 8))
+    return True
+
+
+refresher = DataRefresher(refresh_dir, refresh_data, refresh_interval) \
+    if refresh_dir else None
+
+
+# Timing spans of the callbacks and of their steps (api_call or scoring, 
+# shap_values, plot_local, plot_global, aggregation, figure), durations of
+# the requests and cache hit ratios, exposed on /metrics in the Prometheus
+# text format (one set of metrics per worker)
+metrics = Metrics()
+score_span = "api_call" if scoring_backend in ("remote", "checked") \
+    else "scoring"
+
+# Requests slower than PROFILE_SLOW_REQUESTS seconds (0, the default, to 
+# disable the profiler) are sampled and their stacks written in PROFILE_DIR
+# in the folded format of flamegraph.pl and speedscope
+profile_threshold = float(os.environ.get("PROFILE_SLOW_REQUESTS", 0))
+profiler = SamplingProfiler(profile_threshold, 
+                            os.environ.get("PROFILE_DIR", "cache/profiles")) \
+    if profile_threshold > 0 else None
+
+
+# Run the slow callbacks (scoring, SHAP explanation) as background jobs 
+# (BACKGROUND_CALLBACKS=1): each job runs in a pool of BACKGROUND_THREADS
+# threads (4 by default) of the worker, with its caches and metrics, and
+# its result goes through a disk cache in JOBS_DIR, the browser polling it
+# every BACKGROUND_INTERVAL ms. The job of a customer is cancelled when 
+# another customer is selected before it ends (see background.py)
+background_callbacks = os.environ.get("BACKGROUND_CALLBACKS", "0") == "1"
+background_interval = int(os.environ.get("BACKGROUND_INTERVAL", 500))
+background_manager = None
+if background_callbacks:
+    try:
+        import diskcache
+    except ImportError as e:
+        raise ImportError("BACKGROUND_CALLBACKS=1 requires the diskcache, "
+                          "multiprocess and psutil packages "
+                          "(pip install \"dash[diskcache]\")") from e
+    background_manager = WorkerPoolManager(
+        diskcache.Cache(os.environ.get("JOBS_DIR", "cache/jobs")),
+        max_workers=int(os.environ.get("BACKGROUND_THREADS", 4)),
+        )
 
 
 # Initialize the app - incorporate css
 external_stylesheets=[dbc.themes.CYBORG]
-app = Dash(__name__, external_stylesheets=external_stylesheets)
+app = Dash(__name__, external_stylesheets=external_stylesheets,
+           background_callback_manager=background_manager)
 server = app.server
 
 
+def request_name() -> str:
+    """Outputs of a Dash update, route of the other requests"""
+    if flask.request.path.endswith("_dash-update-component"):
+        body = flask.request.get_json(silent=True)
+        output = body.get("output") if isinstance(body, dict) else None
+        # Only the outputs of the app, to bound the number of series
+        if isinstance(output, str) and output in app.callback_map:
+            return output
+        return "unknown"
+    rule = flask.request.url_rule
+    return rule.rule if rule is not None else "unmatched"
+
+
+@server.before_request
+def start_request_timer():
+    flask.g.request_start = time.perf_counter()
+    if profiler is not None:
+        profiler.start()
+    if refresher is not None:
+        refresher.ensure_started()
+
+
+@server.teardown_request
+def record_request_time(exception):
+    if "request_start" not in flask.g:
+        return
+    duration = time.perf_counter() - flask.g.request_start
+    name = request_name()
+    metrics.observe("request_seconds", (("endpoint", name),), duration)
+    if profiler is not None:
+        profiler.stop(name, duration)
+
+
+def collect_caches() -> list:
+    context_info = customer_context.cache_info()
+    local_cache = snapshot.explainer.local_cache
+    return cache_samples({
+        "figures": (figure_cache.hits, figure_cache.misses),
+        "customer_context": (context_info.hits, context_info.misses),
+        "explanations": (local_cache.hits, local_cache.misses),
+        })
+
+
+def collect_api() -> list:
+    # Calls of the scoring API (remote and checked backends)
+    remote = getattr(snapshot.scorer, "remote", snapshot.scorer)
+    if not hasattr(remote, "stats"):
+        return []
+    summary = remote.stats.summary()
+    return [("api_calls_total", "counter", "Calls of the scoring API",
+             [({}, summary["calls"])]),
+            ("api_errors_total", "counter", "Failed calls of the scoring API",
+             [({}, summary["errors"])])]
+
+
+def collect_data_memory() -> list:
+    labels = lambda table: {"table": table, "dtypes": data_dtypes}
+    return [("data_bytes", "gauge", 
+             "Memory used by the customers table and the features matrix",
+             [(labels(table), used) 
+              for table, (used, _) in data_memory.items()]),
+            ("data_float64_bytes", "gauge",
+             "Memory the customers table and the features matrix would use "
+             "with float64 columns",
+             [(labels(table), float64) 
+              for table, (_, float64) in data_memory.items()])]
+
+
+def collect_refresh() -> list:
+    if refresher is None:
+        return []
+    return [("customers", "gauge", "Customers of the current snapshot",
+             [({}, len(snapshot.customer_index))]),
+            ("data_refreshes_total", "counter", 
+             "Refreshes of the customers applied by the worker",
+             [({}, refresher.refreshes)]),
+            ("data_refresh_errors_total", "counter", 
+             "Refreshes of the customers which failed",
+             [({}, refresher.errors)])]
+
+
+metrics.add_collector(collect_caches)
+metrics.add_collector(collect_data_memory)
+metrics.add_collector(collect_api)
+metrics.add_collector(collect_refresh)
+
+
 header = dbc.Row(
             dbc.Col(
                 html.H1(
@@ -65,7 +494,7 @@ scoring = dbc.Row([
                 html.Div(
                     dcc.Dropdown(
                         id="id_client",
-                        options=df.index.tolist(), 
+                        options=customer_index.search("", limit=20), 
                         placeholder="select a customer", 
                         style={"textAlign": "center"}
                         ),
@@ -73,6 +502,10 @@ scoring = dbc.Row([
                     ),
                 html.Br(),
                 html.Div(html.H4(id="statut_credit")),
+                # Shown while the score is computed in the background
+                dbc.Progress(id="scoring_progress", value=100, striped=True,
+                             animated=True, label="Calcul du score...",
+                             style={"display": "none"}),
                 html.Br(),
                 html.Div(
                     daq.Gauge(
@@ -111,6 +544,11 @@ scoring = dbc.Row([
 
             dbc.Col([
                 dcc.Slider(5, 15, 1, value=10, id="nb_features_local"),
+                # Shown while the explanation is computed in the background
+                dbc.Progress(id="explanation_progress", value=100, 
+                             striped=True, animated=True, 
+                             label="Explication en cours...",
+                             style={"display": "none"}),
                 dcc.Graph(id="feature_importance_local"),
             ], 
                 width=6, 
@@ -242,31 +680,139 @@ app.layout = html.Div([
 
 
 
-def api_call(input_values):
-    response = requests.post(api_url, json=input_values).json()
-    return response["score"]
-
 @app.callback(
-    Output("jauge", "value"),
-    Input("id_client", "value"))
+    Output("id_client", "options"),
+    Input("id_client", "search_value"),
+    State("id_client", "value"))
+def update_customer_options(search_value, value):
+    # The ids matching what the user types are loaded on demand instead of
+    # sending every customer id with the page
+    if not search_value:
+        raise PreventUpdate
+    options = snapshot.customer_index.search(search_value, limit=20)
+    if value is not None and value not in options:
+        options.append(value)
+    return options
+
+
+@server.route("/customers/search")
+def search_customers():
+    """Ids of the customers starting with the q parameter (at most 
+    limit, 100 maximum)"""
+    prefix = flask.request.args.get("q", "")
+    limit = min(flask.request.args.get("limit", 20, type=int), 100)
+    return flask.jsonify(snapshot.customer_index.search(prefix, limit))
+
+
+@server.route("/metrics")
+def metrics_endpoint():
+    """Metrics of the worker in the Prometheus text format"""
+    return flask.Response(metrics.render(), 
+                          mimetype="text/plain; version=0.0.4")
+
+
+@server.route("/ready")
+def readiness():
+    """Readiness of the worker: 200 once the warm-up is done, 503 before"""
+    is_ready = app_ready.is_set()
+    return flask.jsonify({"ready": is_ready}), 200 if is_ready else 503
+
+
+def bad_request(message:str):
+    """400 response of the API with the error as JSON"""
+    return flask.jsonify({"error": message}), 400
+
+
+@server.route("/bulk/score", methods=["POST"])
+def bulk_score():
+    """Scores, decisions and top_k shap contributions of many customers,
+    streamed as NDJSON (default) or as an Arrow stream (format=arrow).
+
+    The customers are given either by their ids (JSON {"ids": [...]}) or as
+    rows of features (JSON {"rows": [{...}, ...]} or a csv, Arrow or 
+    Parquet file uploaded as "file"). top_k (5 by default) and chunk_size
+    (1000 by default) are read from the JSON body or the query string.
+
+    Invalid requests get a 400 with the error as JSON. The columns of the
+    rows unknown to the model (X-Unknown-Columns, a JSON list) and the
+    number of features missing from them (X-Missing-Features, scored as
+    NaN) are returned as headers.
+    """
+    body = flask.request.get_json(silent=True)
+    if body is None:
+        body = {}
+    elif not isinstance(body, dict):
+        return bad_request("the JSON body must be an object")
+    output_format = flask.request.args.get("format", "ndjson")
+    try:
+        top_k = int(body.get("top_k", flask.request.args.get("top_k", 5)))
+        chunk_size = int(body.get("chunk_size", 
+                                  flask.request.args.get("chunk_size", 1000)))
+    except (TypeError, ValueError):
+        return bad_request("top_k and chunk_size must be integers")
+    if output_format not in bulk.FORMATS or chunk_size <= 0:
+        return bad_request("unknown format or chunk_size not positive")
+    data = snapshot
+    headers = {}
+
+    if "ids" in body:
+        # Known customers: precomputed scores and shap values
+        try:
+            ids = bulk.parse_ids(body["ids"])
+        except ValueError as error:
+            return bad_request(str(error))
+        positions = data.customer_index.positions(ids)
+        all_scores = data.df["SCORE"].to_numpy()
+        score_fn = lambda pos: all_scores[pos]
+        shap_fn = lambda pos: data.explainer.local_shap_values_at(
+            data.features_data, pos)
+    else:
+        # New customers: scored and explained with the model
+        try:
+            if "file" in flask.request.files:
+                upload = flask.request.files["file"]
+                try:
+                    rows = bulk.read_rows(upload.stream, 
+                                          upload.filename or "")
+                except Exception:
+                    # Unreadable file (corrupt, wrong format or encoding)
+                    raise ValueError("unreadable file")
+            elif "rows" in body:
+                rows = bulk.parse_rows(body["rows"])
+            else:
+                raise ValueError("no ids, rows or file")
+            ids, rows_data, unknown, missing = bulk.rows_features(
+                rows, data.features_data.columns)
+        except ValueError as error:
+            return bad_request(str(error))
+        # The columns ignored and the features missing (NaN) are reported
+        headers["X-Unknown-Columns"] = json.dumps(unknown)
+        headers["X-Missing-Features"] = str(len(missing))
+        positions = np.arange(len(rows_data))
+        score_fn = lambda pos: batch_score(data.explainer.model, 
+                                           rows_data.iloc[pos])
+        shap_fn = lambda pos: data.explainer.shap_values(rows_data.iloc[pos])
+
+    chunks = bulk.bulk_results(ids, positions, score_fn, shap_fn,
+                               data.features_data.columns, threshold,
+                               top_k=top_k, chunk_size=chunk_size)
+    serialize = bulk.to_arrow_stream if output_format == "arrow" \
+        else bulk.to_ndjson
+    return flask.Response(serialize(chunks), 
+                          mimetype=bulk.FORMATS[output_format],
+                          headers=headers)
+
+
 def set_value_gauge(unique_id):
     score = 0
-    if unique_id in customers_list:
-        data = df.copy().loc[unique_id, :]\
-                        .fillna("_")\
-                        .drop(columns=["SCORE", "TARGET"])\
-                        .to_dict()
-        score = api_call(data)
+    context = get_customer_context(unique_id)
+    if context is not None:
+        score = context.score
     return score
 
 
-@app.callback(
-    Output("statut_credit", "children"),
-    Output("statut_credit", "style"),
-    Input("id_client", "value"),
-    Input("jauge", "value"))
 def update_credit_status(unique_id, score):
-    if unique_id in customers_list:
+    if get_customer_context(unique_id) is not None:
         if score < threshold:
             result = "Crédit accordé"
             style = {"color": "green", "textAlign": "center"}
@@ -282,15 +828,10 @@ def update_credit_status(unique_id, score):
     return result, style
 
 
-@app.callback(
-        Output("score_text", "children"),
-        Output("score_text", "style"),
-        Input("id_client", "value"),
-        Input("jauge", "value"))
 def display_score_text(customer_id, score):
     text = "" 
     style = {}
-    if customer_id in customers_list:
+    if get_customer_context(customer_id) is not None:
         text = f"Score client : {score:.3f}"
         if score < threshold - 0.3:
             style = {"fontWeight": "bold", 
@@ -309,18 +850,50 @@ def display_score_text(customer_id, score):
                      "textAlign": "center", 
                      "color": "red"}       
     return text, style
+
+
+@app.callback(
+    Output("jauge", "value"),
+    Output("statut_credit", "children"),
+    Output("statut_credit", "style"),
+    Output("score_text", "children"),
+    Output("score_text", "style"),
+    Input("id_client", "value"),
+    background=background_callbacks,
+    interval=background_interval,
+    running=[(Output("scoring_progress", "style"), 
+              {"display": "flex"}, {"display": "none"})])
+@metrics.timed
+def update_scoring(unique_id):
+    # The gauge, the status and the score text are computed in a single 
+    # request from the same score, instead of the status and the text 
+    # waiting for the gauge value to come back from the browser
+    score = set_value_gauge(unique_id)
+    return (score, 
+            *update_credit_status(unique_id, score), 
+            *display_score_text(unique_id, score))
     
 
 @app.callback(
         Output("feature_importance_local", "figure"),
         Input("id_client", "value"),
-        Input("nb_features_local", "value"))
+        Input("nb_features_local", "value"),
+        background=background_callbacks,
+        interval=background_interval,
+        running=[(Output("explanation_progress", "style"), 
+                  {"display": "flex"}, {"display": "none"})])
+@figure_cache.memoize
+@metrics.timed
 def plot_feature_importance_local(customer_id, nb_features):
-    if customer_id in customers_list:
-        background_data = df.copy().drop(columns=["SCORE", "TARGET"])
-        fig = shap_explainer.plot_local(background_data, 
-                                        customer_id, 
-                                        nb_features)
+    context = get_customer_context(customer_id)
+    if context is not None:
+        shap_values = context.shap_values
+        with metrics.span("plot_local"):
+            fig = context.data.explainer.plot_local(
+                context.data.features_data, 
+                customer_id, 
+                nb_features,
+                shap_values=shap_values)
         return fig
     else:
         return {}
@@ -329,10 +902,11 @@ def plot_feature_importance_local(customer_id, nb_features):
 @app.callback(
         Output("feature_importance_global", "figure"),
         Input("nb_features_global", "value"))
+@figure_cache.memoize
+@metrics.timed
 def plot_feature_importance_global(nb_features):
-    background_data = df.copy().drop(columns=["SCORE", "TARGET"])
-    fig = shap_explainer.plot_global(background_data, 
-                                         nb_features)
+    with metrics.span("plot_global"):
+        fig = snapshot.explainer.plot_global(nb_features)
     return fig
 
     
@@ -341,6 +915,7 @@ def plot_feature_importance_global(nb_features):
     Output("feature_2", "options"),
     Output("feature_2", "disabled"),
     Input("feature_1", "value"))
+@figure_cache.memoize
 def set_options_feature_2(feature_1):
     if feature_1 in continuous_feat:
         result = continuous_feat.copy()
@@ -350,22 +925,45 @@ def set_options_feature_2(feature_1):
         return continuous_feat, True
     
 
-def plot_dist(value, feature, xaxis_type):
-    fig = px.histogram(data_frame=df, 
-                       x=feature, 
-                       color="TARGET",
-                       color_discrete_map={0:"blue", 1:"red"},
-                       barmode="overlay"
-                        )
-    fig.add_trace(
-        go.Scatter(
-                   x=[value, value],
-                   y=[0, 100],
-                   mode="lines",
-                   line=go.scatter.Line(color="yellow"),
-                   showlegend=False)
+@figure_cache.memoize
+def plot_dist(value, feature, xaxis_type, version, *, data:Snapshot):
+    # Pre-binned histograms (one per TARGET value) drawn as filled steps,
+    # which stay aligned with the bin edges on both linear and log axes.
+    # data is the snapshot of the request, identified in the cache key by
+    # its version
+    with metrics.span("aggregation"):
+        histogram = data.histograms.get(feature, 
+                                        log_scale=xaxis_type == 'Log')
+    with metrics.span("figure"):
+        edges = histogram["edges"]
+        fig = go.Figure()
+        for target, color in ((0, "0, 0, 255"), (1, "255, 0, 0")):
+            counts = histogram["counts"][target]
+            fig.add_trace(
+                go.Scatter(
+                    x=edges,
+                    y=np.append(counts, counts[-1]),
+                    mode="lines",
+                    line=dict(color=f"rgb({color})", shape="hv", width=1),
+                    fill="tozeroy",
+                    fillcolor=f"rgba({color}, 0.4)",
+                    name=str(target),
                 )
-    fig.update_xaxes(type='linear' if xaxis_type == 'Linear' else 'log')
+            )
+        max_count = max(histogram["counts"][0].max(), 
+                        histogram["counts"][1].max())
+        fig.add_trace(
+            go.Scatter(
+                       x=[value, value],
+                       y=[0, max_count],
+                       mode="lines",
+                       line=go.scatter.Line(color="yellow"),
+                       showlegend=False)
+                    )
+        fig.update_xaxes(title=feature, 
+                         type='linear' if xaxis_type == 'Linear' else 'log')
+        fig.update_yaxes(title="count")
+        fig.update_layout(legend_title_text="TARGET")
     return fig
 
 @app.callback(
@@ -377,53 +975,62 @@ def plot_dist(value, feature, xaxis_type):
     Input("feature_2", "value"),
     Input("crossfilter-xaxis-type", "value"),
     Input("crossfilter-yaxis-type", "value"))
+@figure_cache.memoize
+@metrics.timed
 def plot_continuous_features(unique_id, feature1, feature2, 
                              xaxis_type, yaxis_type):
     
     fig1, fig2, fig3 = {}, {}, {}
 
-    if unique_id in customers_list:
+    context = get_customer_context(unique_id)
+    if context is not None:
+        df = context.data.df
         if feature1:
-            value1 = df.loc[unique_id, feature1]
-            fig1 = plot_dist(value1, feature1, xaxis_type)
+            value1 = df[feature1].iat[context.position]
+            fig1 = plot_dist(value1, feature1, xaxis_type, 
+                             context.data.version, data=context.data)
 
         if feature2:
-            value2 = df.loc[unique_id, feature2]
-            fig2 = plot_dist(value2, feature2, yaxis_type)
-
-        if feature1 and feature2:        
-            data = df.copy().drop(index=unique_id)
-            fig3 = px.scatter(
-                data, x=feature1, y=feature2, 
-                color=data["SCORE"],
-                color_continuous_scale="jet",
-                range_color=[0, 1],
-                hover_name=data.index.to_numpy(),
-            ) 
-            fig3.add_trace(
-                go.Scatter(
-                        x=[df.loc[unique_id, feature1]],
-                        y=[df.loc[unique_id, feature2]],
-                        mode="markers",
-                        marker=go.scatter.Marker(color="green", 
-                                                 size=15, 
-                                                 symbol="x"),
-                        name=f"client n° {unique_id}",
-                        showlegend=True
-                ),
-            )
-            fig3.update_xaxes(
-                title=feature1,
-                type='linear' if xaxis_type == 'Linear' else 'log'
-            )
-            fig3.update_yaxes(
-                title=feature2, 
-                type='linear' if yaxis_type == 'Linear' else 'log'
-            )
-            fig3.update_layout(legend=dict(orientation="h"))
+            value2 = df[feature2].iat[context.position]
+            fig2 = plot_dist(value2, feature2, yaxis_type,
+                             context.data.version, data=context.data)
 
-            # Re-order the data:
-            fig3.data = (fig3.data[1], fig3.data[0])
+        with metrics.span("figure"):
+            if feature1 and feature2 and duckdb_store is not None and \
+                    resolve_mode(scatter_mode, len(df), 
+                                 scatter_max_points) == "sample":
+                # Only the sampled customers and the selected one are read
+                positions = np.union1d(context.data.scatter_sample.positions, 
+                                       [context.position])
+                columns = duckdb_store.columns([feature1, feature2], positions)
+                fig3 = plot_bivariate(
+                    columns[feature1],
+                    columns[feature2],
+                    df["SCORE"].to_numpy()[positions],
+                    df.index.to_numpy()[positions],
+                    int(np.searchsorted(positions, context.position)),
+                    feature1, 
+                    feature2,
+                    xaxis_type,
+                    yaxis_type,
+                    mode="sample",
+                    sample=np.arange(len(positions)),
+                )
+            elif feature1 and feature2:
+                fig3 = plot_bivariate(
+                    df[feature1].to_numpy(),
+                    df[feature2].to_numpy(),
+                    df["SCORE"].to_numpy(),
+                    df.index.to_numpy(),
+                    context.position,
+                    feature1, 
+                    feature2,
+                    xaxis_type,
+                    yaxis_type,
+                    mode=scatter_mode,
+                    max_points=scatter_max_points,
+                    sample=context.data.scatter_sample.positions,
+                )
 
     return fig1, fig2, fig3
 
@@ -432,70 +1039,99 @@ def plot_continuous_features(unique_id, feature1, feature2,
     Output("box_feature_3", "figure"),
     Input("id_client", "value"),
     Input("feature_3", "value"))
+@figure_cache.memoize
+@metrics.timed
 def plot_box(customer_id, feature):
     fig = {}
-    if customer_id in customers_list and feature :
-        value = df.loc[customer_id, feature]
-        fig = px.box(
-            df,
-            x="SCORE", 
-            y=feature, 
-            orientation="h",
-            color = df[feature].apply(lambda x: f"{value:.1f}" 
-                                             if x==value else "other"),
-            color_discrete_map = {f"{value:.1f}":"blue", "other":"black"}
-        )
+    context = get_customer_context(customer_id)
+    if context is not None and feature :
+        value = context.data.df[feature].iat[context.position]
+        with metrics.span("aggregation"):
+            summary = context.data.category_stats.get(feature)
+
+        # Box plots drawn from the precomputed quartiles of each level, the
+        # level of the customer in blue and the other ones in black
+        with metrics.span("figure"):
+            selected = summary.index == value
+            fig = go.Figure()
+            for mask, name, color in ((selected, f"{value:.1f}", "blue"), 
+                                      (~selected, "other", "black")):
+                if mask.any():
+                    levels = summary[mask]
+                    fig.add_trace(
+                        go.Box(
+                            y=levels.index,
+                            q1=levels["q1"],
+                            median=levels["median"],
+                            q3=levels["q3"],
+                            lowerfence=levels["lowerfence"],
+                            upperfence=levels["upperfence"],
+                            orientation="h",
+                            name=name,
+                            marker_color=color,
+                        )
+                    )
+            fig.update_xaxes(title="SCORE")
+            fig.update_yaxes(title=feature)
+            fig.update_layout(boxmode="overlay", legend_title_text="color")
     return fig
 
 @app.callback(
     Output("pie_feature_3", "figure"),
     Input("id_client", "value"),
     Input("feature_3", "value"))
+@figure_cache.memoize
+@metrics.timed
 def plot_pie(customer_id, feature):
     fig = {}
 
-    if customer_id in customers_list and feature:
-        specs = [[{'type' : 'domain'}], [{'type' : 'domain'}]]
-        titles = ['Tous les clients', 
-                  'Pourcentage de clients défectueux par catégorie']
-        fig = make_subplots(rows = 2, cols = 1, specs = specs, 
-                            subplot_titles = titles)
-
-        # plotting overall distribution of the category
-        fig.add_trace( 
-            go.Pie(
-                values = df["SCORE"], 
-                labels = df[feature], 
-                hole = 0.3, 
-                textinfo = 'label+percent', 
-                textposition = 'inside'
-            ), 
-            row = 1, 
-            col = 1
-        )
+    context = get_customer_context(customer_id)
+    if context is not None and feature:
+        with metrics.span("aggregation"):
+            summary = context.data.category_stats.get(feature)
+        with metrics.span("figure"):
+            specs = [[{'type' : 'domain'}], [{'type' : 'domain'}]]
+            titles = ['Tous les clients', 
+                      'Pourcentage de clients défectueux par catégorie']
+            fig = make_subplots(rows = 2, cols = 1, specs = specs, 
+                                subplot_titles = titles)
 
-        percentage_defaulter_per_category = \
-            df[feature][df.TARGET == 1].value_counts() * 100 \
-                                            / df[feature].value_counts()
-        percentage_defaulter_per_category = \
-                percentage_defaulter_per_category.dropna().round(2)
-
-        fig.add_trace( 
-            go.Pie(
-                values=percentage_defaulter_per_category, 
-                labels=percentage_defaulter_per_category.index, 
-                hole=0.3, 
-                textinfo='label+value', 
-                hoverinfo='label+value'
-            ), 
-            row=2, 
-            col=1
-        )
+            # plotting overall distribution of the category (sum of the scores
+            # of each category)
+            fig.add_trace( 
+                go.Pie(
+                    values = summary["score_sum"], 
+                    labels = summary.index, 
+                    hole = 0.3, 
+                    textinfo = 'label+percent', 
+                    textposition = 'inside'
+                ), 
+                row = 1, 
+                col = 1
+            )
 
-        fig.update_layout(
-            title = f'Distribution de {feature}', 
-            showlegend = False
-        )
+            # the categories without any defaulter are not displayed
+            percentage_defaulter_per_category = \
+                    summary["defaulter_rate"].round(2)
+            percentage_defaulter_per_category = percentage_defaulter_per_category[
+                    percentage_defaulter_per_category > 0]
+
+            fig.add_trace( 
+                go.Pie(
+                    values=percentage_defaulter_per_category, 
+                    labels=percentage_defaulter_per_category.index, 
+                    hole=0.3, 
+                    textinfo='label+value', 
+                    hoverinfo='label+value'
+                ), 
+                row=2, 
+                col=1
+            )
+
+            fig.update_layout(
+                title = f'Distribution de {feature}', 
+                showlegend = False
+            )
     return fig
 
 
@@ -0,0 +1,235 @@
+import bisect
+import contextlib
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Upper bounds (in seconds) of the buckets of the duration histograms
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Cumulative histogram of durations (Prometheus semantics)"""
+    def __init__(self, buckets:tuple=BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value:float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> list:
+        """(upper bound, number of observations <= upper bound)"""
+        bounds = [str(b) for b in self.buckets] + ["+Inf"]
+        total = 0
+        result = []
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+# Descriptions of the duration histograms
+HELP = {
+    "span_seconds": "Duration of the callbacks (span=\"total\") and of "
+                    "their steps",
+    "request_seconds": "Duration of the HTTP requests, Dash serialization "
+                       "included",
+    }
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')\
+                     .replace("\n", "\\n")
+
+
+def _labels(labels:dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"'
+                          for k, v in labels.items()) + "}"
+
+
+class Metrics:
+    """Timing spans of the callbacks and counters of the process, rendered
+    in the Prometheus text format.
+
+    A callback decorated with timed records a root span named "total";
+    the spans opened while it runs (in the same thread) are recorded
+    under the name of the callback. Collectors registered with
+    add_collector are called at each rendering and return samples
+    (name, type, help, [(labels, value), ...]), e.g. for the cache hit
+    counters kept by other objects. Each worker has its own metrics.
+    """
+    def __init__(self, prefix:str="dashboard", buckets:tuple=BUCKETS) -> None:
+        self.prefix = prefix
+        self.buckets = buckets
+        self.spans = {}
+        self.collectors = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def observe(self, name:str, labels:tuple, value:float) -> None:
+        key = (name, labels)
+        with self._lock:
+            if key not in self.spans:
+                self.spans[key] = Histogram(self.buckets)
+            self.spans[key].observe(value)
+
+    @contextlib.contextmanager
+    def span(self, name:str):
+        """Time the block as the step name of the current callback (or of
+        "none" outside of a callback)"""
+        callback = getattr(self._local, "callback", None) or "none"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("span_seconds",
+                         (("callback", callback), ("span", name)),
+                         time.perf_counter() - start)
+
+    def timed(self, func):
+        """Decorator recording the duration of the callback func"""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            parent = getattr(self._local, "callback", None)
+            self._local.callback = func.__name__
+            try:
+                with self.span("total"):
+                    return func(*args, **kwargs)
+            finally:
+                self._local.callback = parent
+        return wrapper
+
+    def add_collector(self, collector) -> None:
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            spans = {key: (histogram.cumulative_counts(), histogram.sum,
+                           histogram.count)
+                     for key, histogram in self.spans.items()}
+        for name in sorted({name for name, _ in spans}):
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {metric} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {metric} histogram")
+            for (span_name, labels), (counts, total, count) in \
+                    sorted(spans.items()):
+                if span_name != name:
+                    continue
+                labels = dict(labels)
+                for bound, cumulative in counts:
+                    lines.append(f"{metric}_bucket"
+                                 f"{_labels({**labels, 'le': bound})} "
+                                 f"{cumulative}")
+                lines.append(f"{metric}_sum{_labels(labels)} {total}")
+                lines.append(f"{metric}_count{_labels(labels)} {count}")
+
+        for collector in self.collectors:
+            for name, metric_type, help_text, samples in collector():
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{metric}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def cache_samples(caches:dict) -> list:
+    """Samples of the hits, misses and hit ratio of caches, a dict of
+    cache name -> (hits, misses)"""
+    hits, misses, ratios = [], [], []
+    for name, (n_hits, n_misses) in caches.items():
+        labels = {"cache": name}
+        hits.append((labels, n_hits))
+        misses.append((labels, n_misses))
+        total = n_hits + n_misses
+        ratios.append((labels, n_hits / total if total else 0.0))
+    return [("cache_hits_total", "counter", "Cache hits", hits),
+            ("cache_misses_total", "counter", "Cache misses", misses),
+            ("cache_hit_ratio", "gauge", "Hits over lookups of the caches",
+             ratios)]
+
+
+class SamplingProfiler:
+    """Samples the stacks of the threads serving requests every interval
+    seconds, and writes those of the requests slower than threshold seconds
+    in directory, in the folded format of flamegraph.pl and speedscope
+    (one "frame;frame;... count" line per distinct stack).
+    """
+    def __init__(self, threshold:float, directory:str="cache/profiles",
+                 interval:float=0.005) -> None:
+        self.threshold = threshold
+        self.directory = directory
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._sampling = threading.Event()
+        self._pid = None
+
+    def _ensure_sampler(self) -> None:
+        # One sampling thread per process (threads do not survive a fork)
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="sampling-profiler",
+                             daemon=True).start()
+
+    def _run(self) -> None:
+        while True:
+            # Idle until a request starts
+            self._sampling.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, stacks in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[_folded_stack(frame)] += 1
+                if not self._active:
+                    self._sampling.clear()
+
+    def start(self) -> None:
+        """Start sampling the current thread"""
+        with self._lock:
+            self._ensure_sampler()
+            self._active[threading.get_ident()] = Counter()
+            self._sampling.set()
+
+    def stop(self, name:str, duration:float) -> str:
+        """Stop sampling the current thread and write its stacks if the
+        request took more than threshold seconds. Returns the file path
+        (None if nothing was written)."""
+        with self._lock:
+            stacks = self._active.pop(threading.get_ident(), None)
+        if not stacks or duration < self.threshold:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        safe_name = "".join(c if c.isalnum() or c in "-_." else "_"
+                            for c in name)[:100]
+        filepath = os.path.join(
+            self.directory,
+            f"{int(time.time() * 1000)}-{os.getpid()}-{safe_name}-"
+            f"{int(duration * 1000)}ms.folded")
+        with open(filepath, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return filepath
+
+
+def _folded_stack(frame) -> str:
+    """Frames from the outermost to frame, separated by semicolons"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                     f":{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
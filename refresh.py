@@ -0,0 +1,358 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+import zipfile
+import numpy as np
+import pandas as pd
+from data_store import load_customers
+from scoring import batch_score, with_scores
+try:
+    import fcntl
+except ImportError:
+    # No lock on Windows: each process computes the updates
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Files of customers read in the refresh directory
+EXTENSIONS = (".csv", ".arrow", ".feather", ".parquet")
+
+# Spare rows allocated when a column or the features matrix is copied, as
+# a share of its rows, so that the next customers are appended in place
+GROWTH = 0.125
+
+# Files of the scores and shap values shared by the processes (see
+# shared_updates) and their lifetime in seconds
+SHARED_PREFIX = "refresh_"
+SHARED_TTL = 3600
+
+
+class Snapshot:
+    """Everything the callbacks read about the customers: the customers
+    table (features, SCORE and TARGET), the features matrix, the index of
+    the ids, the scorer, the explainer and the aggregates, all of the same
+    version of the data.
+
+    A refresh builds a new snapshot from the previous one (see
+    apply_updates) and the app replaces its reference to the snapshot in a
+    single assignment: a request reading the snapshot once always sees
+    consistent data, old or new.
+    """
+    def __init__(self, df:pd.core.frame.DataFrame,
+                 features_data:pd.core.frame.DataFrame,
+                 customer_index, scorer, explainer, histograms,
+                 category_stats, scatter_sample,
+                 version:str, buffers:dict=None) -> None:
+        self.df = df
+        self.features_data = features_data
+        self.customer_index = customer_index
+        self.scorer = scorer
+        self.explainer = explainer
+        self.histograms = histograms
+        self.category_stats = category_stats
+        self.scatter_sample = scatter_sample
+        self.version = version
+        # Arrays of the columns and of the features matrix with room for
+        # the next customers, shared by the following snapshots (see 
+        # _write_rows)
+        self.buffers = {} if buffers is None else buffers
+
+
+def scan_directory(directory:str, seen:dict) -> dict:
+    """(mtime_ns, size) of the files of customers of directory which are
+    new or changed since seen (a dict file path -> (mtime_ns, size))"""
+    changed = {}
+    try:
+        filenames = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return changed
+    for filename in filenames:
+        if not filename.lower().endswith(EXTENSIONS):
+            continue
+        filepath = os.path.join(directory, filename)
+        try:
+            stat = os.stat(filepath)
+        except FileNotFoundError:
+            continue
+        state = (stat.st_mtime_ns, stat.st_size)
+        if seen.get(filepath) != state:
+            changed[filepath] = state
+    return changed
+
+
+def read_updates(filepaths:list) -> pd.core.frame.DataFrame:
+    """Rows of the customers of the files (csv, Arrow or Parquet with a
+    SK_ID_CURR column), read in the order of filepaths: when a customer
+    appears several times, its last row is kept"""
+    rows = pd.concat([load_customers(filepath) for filepath in filepaths])
+    return rows[~rows.index.duplicated(keep="last")]
+
+
+def _same_rows(a:np.ndarray, b:np.ndarray) -> np.ndarray:
+    """Mask of the rows of a equal to the rows of b, NaN included"""
+    return ((a == b) | (np.isnan(a) & np.isnan(b))).all(axis=1)
+
+
+def _column_dtype(dtype, values:np.ndarray, float_dtype):
+    """dtype of a column of the customers table receiving values:
+    unchanged if they fit in it, float_dtype otherwise (e.g. NaN or
+    decimals in an integer column)"""
+    if dtype.kind not in "iub":
+        return dtype
+    if dtype.kind == "b":
+        fits = np.isin(values, (0, 1)).all()
+    else:
+        info = np.iinfo(dtype)
+        fits = np.isfinite(values).all() \
+            and (values == np.round(values)).all() \
+            and (len(values) == 0
+                 or (values.min() >= info.min and values.max() <= info.max))
+    return dtype if fits else np.dtype(float_dtype)
+
+
+def _same_values(a:np.ndarray, b:np.ndarray) -> bool:
+    """True if a and b (1D) are equal, NaN included"""
+    a, b = a.astype(float), b.astype(float)
+    return bool(((a == b) | (np.isnan(a) & np.isnan(b))).all())
+
+
+class _Rows:
+    """Array of a column or of the features matrix with room for more rows
+    than the length rows used by the last snapshot"""
+    def __init__(self, values:np.ndarray, length:int) -> None:
+        self.values = values
+        self.length = length
+
+
+def _write_rows(buffers:dict, key, old:np.ndarray, positions:np.ndarray,
+                values:np.ndarray, dtype) -> np.ndarray:
+    """old (the rows of the current snapshot) with values written at the
+    sorted positions, those from len(old) on being appended.
+
+    When the rows at positions below len(old) keep their values, the new
+    rows are written after the last rows of the buffer of old (kept in 
+    buffers[key]), which the previous snapshots do not read, and old is 
+    not copied. Otherwise (or if the buffer is full) the rows are copied
+    to a new buffer with GROWTH spare rows.
+    """
+    n_old = len(old)
+    appended = positions >= n_old
+    n = n_old + int(appended.sum())
+    buffer = buffers.get(key)
+    if (buffer is not None
+            and buffer.length == n_old
+            and len(buffer.values) >= n
+            and buffer.values.dtype == dtype
+            and old.__array_interface__["data"][0] 
+                == buffer.values.__array_interface__["data"][0]
+            and _same_values(old[positions[~appended]].ravel(),
+                             values[~appended].ravel())):
+        buffer.values[n_old:n] = values[appended]
+        buffer.length = n
+        return buffer.values[:n]
+    array = np.empty((n + int(n * GROWTH),) + old.shape[1:], dtype=dtype)
+    array[:n_old] = old
+    array[positions] = values
+    buffers[key] = _Rows(array, n)
+    return array[:n]
+
+
+def shared_updates(cache_dir:str, key:str, positions:np.ndarray,
+                   compute) -> dict:
+    """Arrays computed by compute() for the rows at positions, computed by
+    a single process: the first one writes them to cache_dir/key.npz while
+    holding a lock and the processes applying the same update (same key 
+    and positions) read them back. The files older than SHARED_TTL 
+    seconds are deleted. Without cache_dir, compute() is called."""
+    if cache_dir is None:
+        return compute()
+    os.makedirs(cache_dir, exist_ok=True)
+    filepath = os.path.join(cache_dir, f"{key}.npz")
+    with open(os.path.join(cache_dir, f"{key}.lock"), "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with np.load(filepath) as cached:
+                if np.array_equal(cached["positions"], positions):
+                    return {name: cached[name] for name in cached.files
+                            if name != "positions"}
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # Not computed yet (or by another update)
+            pass
+        arrays = compute()
+        tmp_filepath = filepath + ".tmp.npz"
+        np.savez(tmp_filepath, positions=positions, **arrays)
+        os.replace(tmp_filepath, filepath)
+    for filename in os.listdir(cache_dir):
+        if filename.startswith(SHARED_PREFIX):
+            try:
+                if os.path.getmtime(os.path.join(cache_dir, filename)) \
+                        < time.time() - SHARED_TTL:
+                    os.remove(os.path.join(cache_dir, filename))
+            except OSError:
+                pass
+    return arrays
+
+
+def apply_updates(snapshot:Snapshot,
+                  rows:pd.core.frame.DataFrame,
+                  threshold:float,
+                  version:str,
+                  cache_dir:str=None) -> Snapshot:
+    """New snapshot with the rows of the customers changed or added (ids
+    unknown to snapshot), or None if no row differs from snapshot.
+
+    The features missing from the rows are NaN, SCORE, TARGET and the
+    other columns are ignored. The changed customers keep their row
+    position and the new ones are appended, so that only their rows are
+    read again:
+    - their scores and shap values are computed (once for all the 
+      processes sharing cache_dir, see shared_updates),
+    - the histograms, the statistics of the categorical features and the
+      scatter sample are updated with their rows (see the updated methods
+      of HistogramStore, CategoryStore and StratifiedSample),
+    - their ids are merged in the index,
+    - the new rows are appended in place to the columns and to the 
+      features matrix, which are only copied when the values of their 
+      previous rows change (see _write_rows).
+    """
+    old_df = snapshot.df
+    old_features = snapshot.features_data
+    feature_names = old_features.columns
+    n_old = len(old_features)
+
+    values = rows.reindex(columns=feature_names)\
+                 .to_numpy(dtype=old_features.to_numpy().dtype)
+    positions = snapshot.customer_index.positions(rows.index)
+    known = positions >= 0
+    # Rows identical to the current ones are skipped
+    unchanged = np.zeros(len(rows), dtype=bool)
+    unchanged[known] = _same_rows(old_features.to_numpy()[positions[known]],
+                                  values[known])
+    values, positions, known = values[~unchanged], positions[~unchanged], \
+        known[~unchanged]
+    if not len(values):
+        return None
+
+    new_ids = rows.index[~unchanged][~known]
+    positions[~known] = n_old + np.arange(len(new_ids))
+    order = np.argsort(positions)
+    values, positions = values[order], positions[order]
+    customer_index = snapshot.customer_index.appended(new_ids) \
+        if len(new_ids) else snapshot.customer_index
+    buffers = snapshot.buffers
+
+    # Features matrix (buffer None)
+    matrix = _write_rows(buffers, None, old_features.to_numpy(), positions,
+                         values, values.dtype)
+    matrix.flags.writeable = False
+    features_data = pd.DataFrame(matrix, index=customer_index.ids,
+                                 columns=feature_names, copy=False)
+
+    # Scores and shap values of the changed and new customers only
+    explainer = snapshot.explainer
+    def compute() -> dict:
+        changed_rows = features_data.iloc[positions]
+        return {"scores": batch_score(explainer.model, changed_rows),
+                "shap_values": explainer.shap_values(changed_rows)}
+    updates = shared_updates(
+        cache_dir, f"{SHARED_PREFIX}{explainer.model_version}_{version}",
+        positions, compute)
+
+    # Customers table, with the dtypes of the previous one as long as the
+    # new values fit in them
+    columns = {}
+    for j, col in enumerate(feature_names):
+        old_values = old_df[col].to_numpy()
+        columns[col] = _write_rows(
+            buffers, col, old_values, positions, values[:, j],
+            _column_dtype(old_values.dtype, values[:, j], values.dtype))
+    old_scores = old_df["SCORE"].to_numpy()
+    columns["SCORE"] = _write_rows(buffers, "SCORE", old_scores, positions,
+                                   updates["scores"], old_scores.dtype)
+    target = old_df["TARGET"].to_numpy()
+    columns["TARGET"] = _write_rows(
+        buffers, "TARGET", target, positions,
+        (updates["scores"] >= threshold).astype(target.dtype), target.dtype)
+    df = pd.DataFrame(columns, index=customer_index.ids, copy=False)
+
+    return Snapshot(
+        df=df,
+        features_data=features_data,
+        customer_index=customer_index,
+        scorer=with_scores(snapshot.scorer, df["SCORE"]),
+        explainer=explainer.updated(old_features, features_data, positions,
+                                    updates["shap_values"]),
+        histograms=snapshot.histograms.updated(df, positions),
+        category_stats=snapshot.category_stats.updated(df, positions),
+        scatter_sample=snapshot.scatter_sample.updated(
+            old_scores, columns["SCORE"], positions),
+        version=version,
+        buffers=buffers,
+        )
+
+
+def next_version(version:str, files:dict) -> str:
+    """Version of the data once the files (path -> (mtime_ns, size)) are
+    applied to the data of version, the same in every worker which applied
+    the same files"""
+    sha = hashlib.sha256(version.encode())
+    for filepath, (mtime_ns, size) in sorted(files.items()):
+        sha.update(f"{os.path.basename(filepath)}:{mtime_ns}:{size}".encode())
+    return sha.hexdigest()[:16]
+
+
+class DataRefresher:
+    """Polls directory every interval seconds and calls
+    refresh(files, rows) with the files of customers added or changed
+    since the last poll (path -> (mtime_ns, size)) and their rows (see
+    read_updates).
+
+    Each process (gunicorn worker) runs its own polling thread, started by
+    ensure_started. The files which cannot be read are logged and retried
+    once changed again.
+    """
+    def __init__(self, directory:str, refresh, interval:float=10.0) -> None:
+        self.directory = directory
+        self.refresh = refresh
+        self.interval = interval
+        self.seen = {}
+        self.refreshes = 0
+        self.errors = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self) -> None:
+        # One polling thread per process (threads do not survive a fork)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="data-refresh",
+                                 daemon=True).start()
+
+    def _run(self) -> None:
+        while True:
+            self.poll()
+            time.sleep(self.interval)
+
+    def poll(self) -> bool:
+        """Apply the new and changed files once. Returns True if the data
+        was refreshed."""
+        files = scan_directory(self.directory, self.seen)
+        if not files:
+            return False
+        self.seen.update(files)
+        try:
+            refreshed = self.refresh(files, read_updates(list(files)))
+        except Exception:
+            self.errors += 1
+            logger.exception("Data refresh failed for %s",
+                             ", ".join(files))
+            return False
+        if refreshed:
+            self.refreshes += 1
+        return bool(refreshed)
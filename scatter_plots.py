@@ -0,0 +1,102 @@
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+from aggregations import density_grid
+
+# Rendering modes of the bivariate graph:
+# - "points": every customer, plotly chooses between SVG and WebGL
+# - "webgl": every customer, always drawn with WebGL (Scattergl)
+# - "sample": stratified sample of the customers keeping the extreme
+#   scores, drawn with WebGL
+# - "density": 2D histogram of the customers computed server-side
+# - "auto": "points" up to max_points customers, "sample" above
+SCATTER_MODES = ("auto", "points", "webgl", "sample", "density")
+
+
+def resolve_mode(mode:str, n_points:int, max_points:int) -> str:
+    if mode not in SCATTER_MODES:
+        raise ValueError(f"Unknown scatter mode {mode!r}, "
+                         f"expected one of {SCATTER_MODES}")
+    if mode == "auto":
+        return "points" if n_points <= max_points else "sample"
+    return mode
+
+
+def plot_bivariate(x:np.ndarray,
+                   y:np.ndarray,
+                   scores:np.ndarray,
+                   ids:np.ndarray,
+                   selected:int,
+                   feature1:str,
+                   feature2:str,
+                   xaxis_type:str,
+                   yaxis_type:str,
+                   mode:str="auto",
+                   max_points:int=5000,
+                   sample:np.ndarray=None):
+    """Bivariate graph of feature1 (x) and feature2 (y) for all the
+    customers, with the customer at position selected highlighted.
+
+    x, y, scores and ids are arrays over all the customers. sample holds
+    the positions used in "sample" mode (see aggregations.stratified_sample).
+    """
+    mode = resolve_mode(mode, len(x), max_points)
+    x_log, y_log = xaxis_type == 'Log', yaxis_type == 'Log'
+
+    if mode == "density":
+        x_edges, y_edges, counts = density_grid(x, y, x_log, y_log)
+        fig = go.Figure(
+            go.Heatmap(
+                x=x_edges,
+                y=y_edges,
+                z=np.where(counts > 0, counts, np.nan),
+                colorscale="jet",
+                colorbar=dict(title="clients"),
+                hovertemplate=f"{feature1}=%{{x}}<br>{feature2}=%{{y}}"
+                              "<br>clients=%{z}<extra></extra>",
+            )
+        )
+    else:
+        # All the customers (or the sampled ones) except the selected one
+        if mode == "sample":
+            positions = sample[sample != selected]
+        else:
+            positions = np.delete(np.arange(len(x)), selected)
+        fig = px.scatter(
+            x=x[positions],
+            y=y[positions],
+            color=scores[positions],
+            color_continuous_scale="jet",
+            range_color=[0, 1],
+            hover_name=ids[positions],
+            labels={"x": feature1, "y": feature2, "color": "SCORE"},
+            render_mode="auto" if mode == "points" else "webgl",
+        )
+
+    fig.add_trace(
+        go.Scatter(
+                x=[x[selected]],
+                y=[y[selected]],
+                mode="markers",
+                marker=go.scatter.Marker(color="green",
+                                         size=15,
+                                         symbol="x"),
+                name=f"client n° {ids[selected]}",
+                showlegend=True
+        ),
+    )
+    fig.update_xaxes(
+        title=feature1,
+        type='linear' if xaxis_type == 'Linear' else 'log'
+    )
+    fig.update_yaxes(
+        title=feature2,
+        type='linear' if yaxis_type == 'Linear' else 'log'
+    )
+    fig.update_layout(legend=dict(orientation="h"))
+
+    if mode != "density":
+        # Re-order the data:
+        fig.data = (fig.data[1], fig.data[0])
+
+    return fig
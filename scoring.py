@@ -0,0 +1,289 @@
+import copy
+import logging
+import os
+import threading
+import time
+from collections import deque
+import joblib
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from utils import data_hash
+
+logger = logging.getLogger(__name__)
+
+# Available scoring backends
+BACKENDS = ("precomputed", "local", "remote", "checked")
+
+
+def _predict_chunk(model, X:np.ndarray) -> np.ndarray:
+    return model.predict_proba(X)[:, 1]
+
+
+def batch_score(model, 
+                features_data:pd.core.frame.DataFrame,
+                chunk_size:int=50000,
+                n_jobs:int=1) -> np.ndarray:
+    """Score all the customers of features_data by chunks.
+
+    With n_jobs != 1 the chunks are dispatched on a pool of processes 
+    (joblib), otherwise they are scored one after the other (LightGBM 
+    already uses all the cores of the machine for each chunk).
+    """
+    X = features_data.to_numpy(dtype=float)
+    chunks = [X[start:start + chunk_size] 
+              for start in range(0, len(X), chunk_size)]
+    if not chunks:
+        return np.empty(0)
+    if n_jobs == 1 or len(chunks) == 1:
+        scores = [_predict_chunk(model, chunk) for chunk in chunks]
+    else:
+        scores = joblib.Parallel(n_jobs=n_jobs)(
+            joblib.delayed(_predict_chunk)(model, chunk) for chunk in chunks
+            )
+    return np.concatenate(scores)
+
+
+def load_or_batch_score(model, 
+                        model_version:str,
+                        features_data:pd.core.frame.DataFrame,
+                        cache_dir:str="cache",
+                        data_version:str=None,
+                        **kwargs) -> np.ndarray:
+    """Scores of all the customers, read from cache_dir if they have already
+    been computed with the same model and dataset (see batch_score).
+
+    model can also be a function returning the model, which is then only
+    called (and the model only loaded) when the scores are not cached.
+    data_version is the fingerprint of features_data (see utils.data_hash),
+    computed if not given.
+    """
+    if data_version is None:
+        data_version = data_hash(features_data)
+    filename = f"scores_{model_version}_{data_version}.npy"
+    filepath = os.path.join(cache_dir, filename)
+    if os.path.exists(filepath):
+        return np.load(filepath)
+
+    if callable(model):
+        model = model()
+    scores = batch_score(model, features_data, **kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(filepath, scores)
+    return scores
+
+
+class PrecomputedScorer:
+    """Scores a customer by reading the scores computed by batch_score"""
+    def __init__(self, scores:pd.core.series.Series) -> None:
+        self.index = scores.index
+        self.values = scores.to_numpy()
+
+    def score(self, features:pd.core.series.Series) -> float:
+        return float(self.values[self.index.get_loc(features.name)])
+
+
+class CircuitBreaker:
+    """Stops calling a failing service for reset_timeout seconds once 
+    max_failures consecutive calls have failed. After that delay a single
+    trial call is let through (half-open state)."""
+    def __init__(self, max_failures:int=5, reset_timeout:float=30.0) -> None:
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        # True while the trial call is running: the other calls are still
+        # refused until it succeeds or fails
+        self.half_open = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.half_open \
+                    or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.half_open = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.half_open = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            # A failed trial call opens the circuit again
+            if self.half_open or self.failures >= self.max_failures:
+                self.opened_at = time.monotonic()
+            self.half_open = False
+
+
+class LatencyStats:
+    """Number of calls, errors and latencies of the last calls"""
+    def __init__(self, size:int=1000) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, latency:float, error:bool=False) -> None:
+        with self._lock:
+            self.calls += 1
+            self.errors += int(error)
+            self.latencies.append(latency)
+
+    def summary(self) -> dict:
+        with self._lock:
+            latencies = np.array(self.latencies)
+            calls, errors = self.calls, self.errors
+        result = {"calls": calls, "errors": errors}
+        if len(latencies):
+            result.update({
+                "p50": float(np.percentile(latencies, 50)),
+                "p95": float(np.percentile(latencies, 95)),
+                "max": float(latencies.max()),
+                })
+        return result
+
+
+class RemoteScorer:
+    """Scores a customer with the /predict endpoint of the API.
+
+    The calls go through a keep-alive connection pool, are bounded by 
+    connect/read timeouts and retried with an exponential backoff. When the
+    API keeps failing, the circuit breaker opens and the scores are taken
+    from the fallback scorer (if any) without calling the API.
+    """
+    def __init__(self, api_url:str,
+                 connect_timeout:float=3.05,
+                 read_timeout:float=10.0,
+                 retries:int=2,
+                 backoff_factor:float=0.3,
+                 pool_maxsize:int=10,
+                 fallback=None,
+                 circuit_breaker:CircuitBreaker=None) -> None:
+        self.api_url = api_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.fallback = fallback
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.stats = LatencyStats()
+
+        retry = Retry(total=retries, 
+                      backoff_factor=backoff_factor,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(["POST"]),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, 
+                              pool_maxsize=pool_maxsize,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _fallback(self, features:pd.core.series.Series, reason) -> float:
+        if self.fallback is None:
+            raise requests.RequestException(
+                f"Scoring API unavailable: {reason}")
+        logger.warning("Scoring API unavailable for %s (%s), "
+                       "using the fallback score", features.name, reason)
+        return self.fallback.score(features)
+
+    def score(self, features:pd.core.series.Series) -> float:
+        if not self.circuit_breaker.allow():
+            return self._fallback(features, "circuit open")
+
+        # The API expects the missing values to be replaced by "_"
+        input_values = features.fillna("_").to_dict()
+        start = time.perf_counter()
+        try:
+            response = self.session.post(self.api_url, 
+                                         json=input_values,
+                                         timeout=self.timeout)
+            response.raise_for_status()
+            score = response.json()["score"]
+        except (requests.RequestException, ValueError, KeyError) as e:
+            self.stats.record(time.perf_counter() - start, error=True)
+            self.circuit_breaker.record_failure()
+            return self._fallback(features, e)
+
+        self.stats.record(time.perf_counter() - start)
+        self.circuit_breaker.record_success()
+        return score
+
+
+class LocalScorer:
+    """Scores a customer in-process with the model loaded by the app"""
+    def __init__(self, model) -> None:
+        self.model = model
+
+    def score(self, features:pd.core.series.Series) -> float:
+        X = features.to_numpy(dtype=float).reshape(1, -1)
+        return float(self.model.predict_proba(X)[0, 1])
+
+
+class CheckedScorer:
+    """Scores a customer in-process and checks the result against the API.
+
+    The local score is always returned, the API is only used to log the
+    discrepancies (or its failures).
+    """
+    def __init__(self, local:LocalScorer, remote:RemoteScorer,
+                 tolerance:float=1e-3) -> None:
+        self.local = local
+        self.remote = remote
+        self.tolerance = tolerance
+
+    def score(self, features:pd.core.series.Series) -> float:
+        score = self.local.score(features)
+        try:
+            remote_score = self.remote.score(features)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logger.warning("Remote scoring failed for %s: %s",
+                           features.name, e)
+            return score
+        if abs(score - remote_score) > self.tolerance:
+            logger.warning("Score mismatch for %s: local=%.4f, remote=%.4f",
+                           features.name, score, remote_score)
+        return score
+
+
+def get_scorer(backend:str, model, api_url:str, 
+               scores:pd.core.series.Series=None,
+               **remote_kwargs):
+    """Build the scorer of the given backend ("precomputed", "local", 
+    "remote" or "checked"). 
+    
+    remote_kwargs are passed to RemoteScorer. In "remote" mode, the 
+    precomputed scores (if given) are used as fallback when the API fails.
+    """
+    if backend == "precomputed":
+        return PrecomputedScorer(scores)
+    if backend == "local":
+        return LocalScorer(model)
+    if backend == "remote":
+        fallback = PrecomputedScorer(scores) if scores is not None else None
+        return RemoteScorer(api_url, fallback=fallback, **remote_kwargs)
+    if backend == "checked":
+        return CheckedScorer(LocalScorer(model), 
+                             RemoteScorer(api_url, **remote_kwargs))
+    raise ValueError(f"Unknown scoring backend {backend!r}, "
+                     f"expected one of {BACKENDS}")
+
+
+def with_scores(scorer, scores:pd.core.series.Series):
+    """Scorer answering like scorer with new precomputed scores (e.g. after
+    a data refresh): the precomputed scores and the fallback scores of the
+    API are replaced, the API session, circuit breaker and statistics are
+    shared. The other scorers do not depend on the scores."""
+    if isinstance(scorer, PrecomputedScorer):
+        return PrecomputedScorer(scores)
+    if isinstance(scorer, RemoteScorer) and scorer.fallback is not None:
+        scorer = copy.copy(scorer)
+        scorer.fallback = PrecomputedScorer(scores)
+    return scorer
@@ -1,40 +1,343 @@
+import argparse
+import copy
+import os
+import threading
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-import shap
 import joblib
+from utils import file_hash, data_hash
+from data_store import load_customers, features_view
 
 # Threshold
 threshold = 0.658
 
+# Explainer backends:
+# - "shap": generic shap.TreeExplainer
+# - "native": contributions computed by the LightGBM booster itself
+#   (predict with pred_contrib=True), without building the TreeExplainer
+EXPLAINER_BACKENDS = ("shap", "native")
+
+
+class ExplanationCache:
+    """Bounded LRU cache of local shap values.
+
+    Keys are (customer id, model version) tuples, values are the 1D arrays
+    of shap values of the customer.
+    """
+    def __init__(self, maxsize:int=1024) -> None:
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key:tuple):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key:tuple, values:np.ndarray) -> None:
+        with self._lock:
+            self._data[key] = values
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def without(self, ids) -> "ExplanationCache":
+        """Copy of the cache without the entries of the customers ids (the
+        hit and miss counters are carried over)"""
+        ids = set(ids)
+        cache = ExplanationCache(self.maxsize)
+        with self._lock:
+            cache._data = OrderedDict((key, values) 
+                                      for key, values in self._data.items()
+                                      if key[0] not in ids)
+            cache.hits, cache.misses = self.hits, self.misses
+        return cache
+
+
 class ShapExplainer:
-    def __init__(self) -> None:
-        self.model = joblib.load("model.pkl")
-        self.explainer = shap.TreeExplainer(self.model)
+    def __init__(self, model_path:str="model.pkl", 
+                 cache_dir:str="cache",
+                 local_cache_size:int=1024,
+                 backend:str="shap") -> None:
+        if backend not in EXPLAINER_BACKENDS:
+            raise ValueError(f"Unknown explainer backend {backend!r}, "
+                             f"expected one of {EXPLAINER_BACKENDS}")
+        self.model_path = model_path
+        self.backend = backend
+        # The model and the explainer are only loaded on first use (see 
+        # _load). ready is set once they are loaded
+        self._model = None
+        self._explainer = None
+        self._base_value = None
+        self._load_lock = threading.Lock()
+        self.ready = threading.Event()
+        self.model_version = file_hash(model_path)
+        self.cache_dir = cache_dir
+        self.global_importance = None
+        self.local_cache = ExplanationCache(local_cache_size)
+        self.local_store = None
+        # Shap values of the customers changed or added since the store was
+        # precomputed, by row position (see updated)
+        self.local_overrides = {}
 
-    
-    def plot_global(self, 
-                    background_data:pd.core.frame.DataFrame,
-                    max_display:int):
-        # Get the absolute values of the shap values
-        shap_values = self.explainer.shap_values(background_data)
-        shap_values = np.abs(shap_values[1])
+
+    def _load(self) -> None:
+        if self.ready.is_set():
+            return
+        with self._load_lock:
+            if self.ready.is_set():
+                return
+            self._model = joblib.load(self.model_path)
+            if self.backend == "native":
+                # The last column of the contributions is the base value, 
+                # the same for every row
+                n_features = self._model.booster_.num_feature()
+                self._base_value = float(self._native_contributions(
+                    np.zeros((1, n_features)))[0, -1])
+            else:
+                # shap (and numba) are only imported by this backend
+                import shap
+                self._explainer = shap.TreeExplainer(self._model)
+                # Base value E(f(x)) of the positive class in log odds. It 
+                # is read now since explainer.expected_value only becomes a
+                # [class 0, class 1] list after a first call to shap_values
+                self._base_value = float(
+                    np.ravel(self._explainer.expected_value)[-1])
+            self.ready.set()
+
+
+    @property
+    def model(self):
+        self._load()
+        return self._model
+
+
+    @property
+    def explainer(self):
+        """shap.TreeExplainer of the model (None with the native backend)"""
+        self._load()
+        return self._explainer
+
+
+    @property
+    def base_value(self) -> float:
+        self._load()
+        return self._base_value
+
+
+    def _native_contributions(self, X) -> np.ndarray:
+        """Per-feature log odds contributions followed by the base value
+        (n_samples x (n_features + 1)), from the LightGBM booster"""
+        if isinstance(X, pd.DataFrame):
+            X = X.to_numpy(dtype=np.float64)
+        return self._model.booster_.predict(X, pred_contrib=True)
+
+
+    def shap_values(self, X:pd.core.frame.DataFrame) -> np.ndarray:
+        """Shap values of the positive class (log odds) of the rows of X,
+        as a n_samples x n_features array"""
+        self._load()
+        if self.backend == "native":
+            return self._native_contributions(X)[:, :-1]
+        return self.explainer.shap_values(X)[1]
+
+
+    def _local_store_path(self, background_data:pd.core.frame.DataFrame,
+                          data_version:str=None):
+        if data_version is None:
+            data_version = data_hash(background_data)
+        filename = f"local_shap_{self.model_version}_{data_version}.npy"
+        return os.path.join(self.cache_dir, filename)
+
+
+    def precompute_local(self, 
+                         background_data:pd.core.frame.DataFrame,
+                         chunk_size:int=10000) -> str:
+        """Compute the shap values of all the customers by chunks and save
+        them in a .npy file that can be memory-mapped (see load_local).
+        Rows are stored in the order of background_data.
+        """
+        filepath = self._local_store_path(background_data)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Write in a temporary file so that a worker never maps a 
+        # partially written store
+        tmp_filepath = filepath + ".tmp"
+        store = np.lib.format.open_memmap(tmp_filepath, mode="w+", 
+                                          dtype=np.float64, 
+                                          shape=background_data.shape)
+        for start in range(0, len(background_data), chunk_size):
+            chunk = background_data.iloc[start:start + chunk_size]
+            store[start:start + len(chunk)] = self.shap_values(chunk)
+        store.flush()
+        del store
+        os.replace(tmp_filepath, filepath)
+        return filepath
+
+
+    def load_local(self, background_data:pd.core.frame.DataFrame,
+                   data_version:str=None) -> bool:
+        """Memory-map the precomputed shap values of background_data if
+        they exist. Returns True if the store was found.
+
+        data_version is the fingerprint of background_data (see 
+        utils.data_hash), computed if not given.
+        """
+        filepath = self._local_store_path(background_data, data_version)
+        if not os.path.exists(filepath):
+            self.local_store = None
+            return False
+        self.local_store = np.load(filepath, mmap_mode="r")
+        return True
+
+
+    def local_shap_values(self, 
+                          background_data:pd.core.frame.DataFrame, 
+                          idx:int) -> np.ndarray:
+        """Shap values of the customer idx, read from the precomputed store
+        or the LRU cache. The tree explainer is only run on a cache miss.
+        """
+        if self.local_store is not None:
+            position = background_data.index.get_loc(idx)
+            if position in self.local_overrides:
+                return self.local_overrides[position]
+            return np.asarray(self.local_store[position])
+
+        key = (idx, self.model_version)
+        values = self.local_cache.get(key)
+        if values is None:
+            values = self.shap_values(background_data.loc[[idx], :])[0]
+            self.local_cache.put(key, values)
+        return values
+
+
+    def local_shap_values_at(self,
+                             background_data:pd.core.frame.DataFrame,
+                             positions:np.ndarray) -> np.ndarray:
+        """Shap values (n_positions x n_features) of the customers at the
+        given row positions of background_data, read from the precomputed
+        store if it is loaded and computed in one call otherwise"""
+        if self.local_store is not None:
+            positions = np.asarray(positions)
+            if not self.local_overrides:
+                return np.asarray(self.local_store[positions])
+            # The rows past the end of the store are all overridden
+            values = np.array(self.local_store[
+                np.minimum(positions, len(self.local_store) - 1)])
+            overridden = np.isin(positions, list(self.local_overrides))
+            for i in np.flatnonzero(overridden):
+                values[i] = self.local_overrides[positions[i]]
+            return values
+        return self.shap_values(background_data.iloc[positions])
+
+
+    def updated(self, 
+                old_data:pd.core.frame.DataFrame,
+                new_data:pd.core.frame.DataFrame,
+                positions:np.ndarray,
+                new_values:np.ndarray=None) -> "ShapExplainer":
+        """Explainer of new_data, the customers of old_data whose rows at 
+        positions were changed or appended (at the end). Only the shap 
+        values of these customers are computed (unless given as 
+        new_values):
+        - the global importances are updated by removing the previous
+          absolute shap values of the changed customers and adding the new
+          ones,
+        - the new shap values replace the cached and precomputed ones of 
+          these customers.
+        The model is shared with this explainer, which is left untouched.
+        """
+        positions = np.asarray(positions)
+        changed = positions[positions < len(old_data)]
+        if new_values is None:
+            new_values = self.shap_values(new_data.iloc[positions])
+
+        explainer = copy.copy(self)
+        if self.global_importance is not None:
+            # No previous values when the customers are only appended
+            old_values = self.local_shap_values_at(old_data, changed) \
+                if len(changed) else np.zeros((0, old_data.shape[1]))
+            importance = self.global_importance.set_index("feature")\
+                             ["shap_values"].reindex(new_data.columns)
+            abs_sum = importance.to_numpy() * len(old_data) \
+                - np.abs(old_values).sum(0) + np.abs(new_values).sum(0)
+            importance = pd.DataFrame({
+                "feature": new_data.columns,
+                "shap_values": abs_sum / max(len(new_data), 1)
+                })
+            explainer.global_importance = importance\
+                .sort_values("shap_values").reset_index(drop=True)
+
+        ids = new_data.index[positions]
+        explainer.local_cache = self.local_cache.without(ids)
+        if self.local_store is not None:
+            explainer.local_overrides = {**self.local_overrides,
+                                         **dict(zip(positions.tolist(), 
+                                                    new_values))}
+        else:
+            # Only the last ones would stay in the cache
+            n = self.local_cache.maxsize
+            for unique_id, values in zip(ids[-n:], new_values[-n:]):
+                explainer.local_cache.put((unique_id, self.model_version), 
+                                          values)
+        return explainer
+
+
+    def fit_global(self, background_data:pd.core.frame.DataFrame,
+                   chunk_size:int=10000,
+                   data_version:str=None):
+        """Compute the mean absolute shap value of every feature once, by 
+        chunks of chunk_size customers.
+
+        The result is sorted and persisted in cache_dir, keyed by the model
+        and dataset hashes (data_version, computed if not given), so that 
+        the next startup only reads it back.
+        """
+        if data_version is None:
+            data_version = data_hash(background_data)
+        filename = f"global_importance_{self.model_version}_" \
+                   f"{data_version}.csv"
+        filepath = os.path.join(self.cache_dir, filename)
+
+        if os.path.exists(filepath):
+            self.global_importance = pd.read_csv(filepath)
+            return self.global_importance
+
+        # Sum the absolute values of the shap values chunk by chunk
+        abs_sum = np.zeros(background_data.shape[1])
+        for start in range(0, len(background_data), chunk_size):
+            chunk = background_data.iloc[start:start + chunk_size]
+            abs_sum += np.abs(self.shap_values(chunk)).sum(0)
 
         # Get the average shap value of each feature and sort them
-        shap_values = pd.DataFrame(
-            shap_values, 
-            index=background_data.index,
-            columns=background_data.columns
-            )
         shap_values = pd.DataFrame({
-            "feature": shap_values.mean(0).index, 
-            "shap_values": shap_values.mean(0).values
+            "feature": background_data.columns, 
+            "shap_values": abs_sum / max(len(background_data), 1)
                     })
         shap_values = shap_values.sort_values("shap_values").reset_index(drop=True)
 
-        # Select only the top max_display features
-        X = shap_values.iloc[-max_display:, :]
+        os.makedirs(self.cache_dir, exist_ok=True)
+        shap_values.to_csv(filepath, index=False)
+        self.global_importance = shap_values
+        return shap_values
+
+    
+    def plot_global(self, max_display:int):
+        # Select only the top max_display features from the precomputed
+        # global importances (see fit_global)
+        X = self.global_importance.iloc[-max_display:, :]
 
         # Plots the barplot of average shap values for the top max_display
         # features
@@ -52,19 +355,18 @@ class ShapExplainer:
     def plot_local(self, 
                    background_data:pd.core.frame.DataFrame, 
                    idx:int, 
-                   max_display:int):
-        # Get the shap values of the sample
-        shap_values = self.explainer(background_data.loc[idx, :]\
-                                     .to_numpy().reshape(1,-1))
+                   max_display:int,
+                   shap_values:np.ndarray=None):
+        # Get the shap values (unless already known) and the features 
+        # values of the sample
+        values = shap_values
+        if values is None:
+            values = self.local_shap_values(background_data, idx)
+        data = background_data.loc[idx, :].to_numpy()
 
         # Get the base score of the model and the sample final shap value
-        raw_base_score = self.explainer.expected_value[1] # E(f(x))
-        raw_customer_score = self.explainer.expected_value[1] \
-                            + shap_values.values[:,:,1].sum() # f(x)
-
-        # Store the shap values and the features values of the sample
-        values = shap_values[0,:,1].values
-        data = shap_values[0,:,1].data
+        raw_base_score = self.base_value # E(f(x))
+        raw_customer_score = raw_base_score + values.sum() # f(x)
 
         # Create a DataFrame with the 2 above arrays
         df_values = pd.DataFrame({"features": background_data.columns, 
@@ -127,4 +429,58 @@ class ShapExplainer:
         # Add lines on the y-axis
         fig.update_yaxes(griddash = "solid")
 
-        return fig
\ No newline at end of file
+        return fig
+
+
+def check_backends(background_data:pd.core.frame.DataFrame,
+                   model_path:str="model.pkl",
+                   n_rows:int=1000,
+                   tolerance:float=1e-6) -> float:
+    """Compare the shap values of the first n_rows customers computed by the
+    "shap" and "native" backends. Returns the maximum absolute difference
+    and raises an AssertionError above tolerance."""
+    X = background_data.iloc[:n_rows]
+    reference = ShapExplainer(model_path, backend="shap")
+    native = ShapExplainer(model_path, backend="native")
+    max_diff = float(np.abs(reference.shap_values(X) 
+                            - native.shap_values(X)).max())
+    base_diff = abs(reference.base_value - native.base_value)
+    assert max(max_diff, base_diff) <= tolerance, \
+        f"The explainer backends differ by {max(max_diff, base_diff):.2e}"
+    return max_diff
+
+
+def check_dtypes(background_data:pd.core.frame.DataFrame,
+                 model_path:str="model.pkl",
+                 n_rows:int=1000,
+                 dtype=np.float32) -> dict:
+    """Compare the scores and the shap values (native backend) of the first
+    n_rows customers computed from their float64 features and from the same
+    features rounded to dtype (see data_store.compact_customers). Returns
+    the maximum absolute differences {"score": ..., "shap": ...}."""
+    X = background_data.iloc[:n_rows].astype(np.float64)
+    X_compact = X.astype(dtype)
+    explainer = ShapExplainer(model_path, backend="native")
+    scores = explainer.model.predict_proba(X)[:, 1]
+    compact_scores = explainer.model.predict_proba(X_compact)[:, 1]
+    return {"score": float(np.abs(scores - compact_scores).max()),
+            "shap": float(np.abs(explainer.shap_values(X) 
+                                 - explainer.shap_values(X_compact)).max())}
+
+
+if __name__ == "__main__":
+    # Offline batch mode: precompute the local shap values of every customer
+    # python shap_plots.py --data data/customers_data.arrow
+    parser = argparse.ArgumentParser(
+        description="Precompute the shap values of all the customers")
+    parser.add_argument("--data", required=True, 
+                        help="Arrow, Parquet or csv file of the customers")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--backend", choices=EXPLAINER_BACKENDS, 
+                        default="native")
+    args = parser.parse_args()
+
+    background_data = features_view(load_customers(args.data))
+    shap_explainer = ShapExplainer(backend=args.backend)
+    shap_explainer.fit_global(background_data)
+    print(shap_explainer.precompute_local(background_data, args.chunk_size))
@@ -0,0 +1,350 @@
+import argparse
+import csv
+import json
+import os
+import joblib
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from data_store import index_col, non_feature_cols
+from aggregations import bin_edges, valid_values
+from scoring import batch_score
+from utils import file_hash, data_hash
+
+# A feature with at most max_categories distinct values is categorical
+# (the same rule as main.py)
+max_categories = 10
+
+# Number of bins of the score histograms from which the quartiles and the
+# whiskers of each category are computed (resolution 1 / score_bins)
+score_bins = 1000
+
+# Size (in bytes) of the blocks read from a csv file
+csv_block_size = 4 << 20
+
+
+def iter_batches(filepath:str, batch_size:int=50000):
+    """Record batches of a local csv, Arrow/Feather or Parquet file, read
+    one after the other without loading the whole file. Every column is
+    read as float64 except SK_ID_CURR (int64)."""
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension == ".parquet":
+        yield from pq.ParquetFile(filepath).iter_batches(batch_size)
+    elif extension in (".arrow", ".feather"):
+        with pa.memory_map(filepath, "r") as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i)
+    else:
+        # The types are fixed from the header so that a column which looks
+        # like integers in the first block is not rejected later
+        with open(filepath, newline="") as f:
+            names = next(csv.reader(f))
+        column_types = {name: pa.float64() for name in names}
+        column_types[index_col] = pa.int64()
+        yield from pa_csv.open_csv(
+            filepath,
+            read_options=pa_csv.ReadOptions(block_size=csv_block_size),
+            convert_options=pa_csv.ConvertOptions(column_types=column_types),
+            )
+
+
+def _hist_quantile(counts:np.ndarray, edges:np.ndarray, q:float) -> float:
+    """Quantile q of the values of a histogram, interpolated in its bin"""
+    cumulative = np.cumsum(counts)
+    position = q * cumulative[-1]
+    i = min(np.searchsorted(cumulative, position, side="left"),
+            len(counts) - 1)
+    before = cumulative[i] - counts[i]
+    fraction = (position - before) / counts[i] if counts[i] else 0.0
+    return float(edges[i] + fraction * (edges[i + 1] - edges[i]))
+
+
+def _read_chunks(filepath:str, n_rows:int, n_columns:int, chunk_size:int):
+    """(first row, rows) of a float64 matrix file by chunks of chunk_size 
+    rows. The chunks are read one after the other rather than memory-
+    mapped, so that the pages already read are not kept in the memory of
+    the process."""
+    with open(filepath, "rb") as f:
+        for start in range(0, n_rows, chunk_size):
+            count = min(chunk_size, n_rows - start) * n_columns
+            yield start, np.fromfile(f, dtype=np.float64, count=count)\
+                           .reshape(-1, n_columns)
+
+
+class _Pass1:
+    """Statistics gathered while the store is written: distinct values of
+    the candidate categorical columns and ranges of every column"""
+    def __init__(self, columns:list) -> None:
+        self.columns = columns
+        self.distinct = {name: set() for name in columns}
+        self.low = np.full(len(columns), np.inf)
+        self.high = np.full(len(columns), -np.inf)
+        self.low_positive = np.full(len(columns), np.inf)
+
+    def update(self, matrix:np.ndarray) -> None:
+        finite = np.isfinite(matrix)
+        self.low = np.minimum(self.low,
+                              np.where(finite, matrix, np.inf).min(0))
+        self.high = np.maximum(self.high,
+                               np.where(finite, matrix, -np.inf).max(0))
+        self.low_positive = np.minimum(
+            self.low_positive,
+            np.where(finite & (matrix > 0), matrix, np.inf).min(0))
+
+        for j, name in enumerate(self.columns):
+            if name not in self.distinct:
+                continue
+            values = matrix[:, j]
+            self.distinct[name].update(
+                np.unique(values[~np.isnan(values)]).tolist())
+            # Continuous: its values are no longer tracked
+            if len(self.distinct[name]) > max_categories:
+                del self.distinct[name]
+
+    def edges(self, j:int, log_scale:bool, nbins:int) -> np.ndarray:
+        """Bin edges of column j, the same as aggregations.bin_edges on all
+        its values"""
+        low = self.low_positive[j] if log_scale else self.low[j]
+        if not np.isfinite(low) or self.high[j] < low:
+            return bin_edges(np.empty(0), log_scale, nbins)
+        return bin_edges(np.array([low, self.high[j]]), log_scale, nbins)
+
+
+def ingest(source:str,
+           store_dir:str="data/store",
+           model_path:str="model.pkl",
+           threshold:float=0.658,
+           batch_size:int=50000,
+           nbins:int=50) -> str:
+    """Build the on-disk store of the customers of source (see
+    CustomerStore) in two streaming passes, the memory used only depending
+    on batch_size (and on 16 bytes per customer for the ids and scores).
+
+    1. The batches of source are appended to the float64 matrix of the
+       features, scored with the model, and the distinct values (up to
+       max_categories) and the ranges of every column are updated.
+    2. The matrix is read back memory-mapped by chunks to count the
+       histograms of the continuous columns (for each TARGET value, on a
+       linear and a log scale) and the statistics of the score for each
+       level of the categorical columns.
+    """
+    model = joblib.load(model_path)
+    os.makedirs(store_dir, exist_ok=True)
+    features_path = os.path.join(store_dir, "features.f64")
+
+    feature_names = explored = stats = None
+    ids, scores = [], []
+    with open(features_path + ".tmp", "wb") as features_file:
+        for batch in iter_batches(source, batch_size):
+            frame = batch.to_pandas()
+            if feature_names is None:
+                feature_names = frame.columns.drop(
+                    [index_col] + non_feature_cols, errors="ignore").tolist()
+                # Columns explored in the dashboard: the features, and the
+                # score if the file has one (as in main.py)
+                explored = feature_names + (["SCORE"] if "SCORE" in
+                                            frame.columns else [])
+                stats = _Pass1(explored)
+
+            matrix = np.ascontiguousarray(
+                frame[feature_names].to_numpy(dtype=np.float64))
+            matrix.tofile(features_file)
+            batch_scores = batch_score(
+                model, pd.DataFrame(matrix, columns=feature_names,
+                                    copy=False))
+            ids.append(frame[index_col].to_numpy(dtype=np.int64))
+            scores.append(batch_scores)
+
+            if len(explored) > len(feature_names):
+                matrix = np.column_stack([matrix, batch_scores])
+            stats.update(matrix)
+
+    if feature_names is None:
+        raise ValueError(f"No customer in {source}")
+    ids, scores = np.concatenate(ids), np.concatenate(scores)
+    np.save(os.path.join(store_dir, "ids.npy"), ids)
+    np.save(os.path.join(store_dir, "scores.npy"), scores)
+    os.replace(features_path + ".tmp", features_path)
+
+    # Fingerprint of the features (see utils.data_hash) versioning the
+    # caches of the app, which then does not read the whole matrix again
+    features = np.memmap(features_path, dtype=np.float64, mode="r",
+                         shape=(len(ids), len(feature_names)))
+    data_version = data_hash(pd.DataFrame(
+        features, index=pd.Index(ids, name=index_col), 
+        columns=feature_names, copy=False))
+    del features
+
+    categorical = [name for name in explored if name in stats.distinct]
+    continuous = [name for name in explored if name not in stats.distinct]
+
+    # Second pass
+    target = scores >= threshold
+    column = {name: j for j, name in enumerate(explored)}
+    edges = {(name, log_scale): stats.edges(column[name], log_scale, nbins)
+             for name in continuous for log_scale in (False, True)}
+    counts = {key: np.zeros((2, nbins), dtype=np.int64) for key in edges}
+    levels = {name: sorted(stats.distinct[name]) for name in categorical}
+    score_edges = np.linspace(0.0, 1.0, score_bins + 1)
+    categories = {name: {"count": np.zeros(len(levels[name]), np.int64),
+                         "score_sum": np.zeros(len(levels[name])),
+                         "target_sum": np.zeros(len(levels[name])),
+                         "hist": np.zeros((len(levels[name]), score_bins),
+                                          np.int64)}
+                  for name in categorical}
+
+    for start, chunk in _read_chunks(features_path, len(ids), 
+                                     len(feature_names), batch_size):
+        chunk_scores = scores[start:start + batch_size]
+        chunk_target = target[start:start + batch_size]
+        for name in explored:
+            values = chunk_scores if column[name] >= len(feature_names) \
+                else chunk[:, column[name]]
+            if name in categories:
+                category = categories[name]
+                for i, level in enumerate(levels[name]):
+                    mask = values == level
+                    category["count"][i] += mask.sum()
+                    category["score_sum"][i] += chunk_scores[mask].sum()
+                    category["target_sum"][i] += chunk_target[mask].sum()
+                    category["hist"][i] += np.histogram(
+                        chunk_scores[mask], bins=score_edges)[0]
+                continue
+            for log_scale in (False, True):
+                valid = valid_values(values, log_scale)
+                key = (name, log_scale)
+                for t in (0, 1):
+                    counts[key][t] += np.histogram(
+                        values[valid & (chunk_target == t)],
+                        bins=edges[key])[0]
+
+    summaries = {}
+    for name in categorical:
+        category = categories[name]
+        rows = []
+        for i, level in enumerate(levels[name]):
+            hist = category["hist"][i]
+            q1, median, q3 = (_hist_quantile(hist, score_edges, q)
+                              for q in (0.25, 0.5, 0.75))
+            iqr = q3 - q1
+            # Whiskers: bins of the most extreme scores within 1.5 IQR
+            inside = np.flatnonzero(
+                (hist > 0)
+                & (score_edges[1:] >= q1 - 1.5 * iqr)
+                & (score_edges[:-1] <= q3 + 1.5 * iqr))
+            rows.append({
+                # Float levels, as in category_summary
+                "level": float(level),
+                "count": int(category["count"][i]),
+                "score_sum": float(category["score_sum"][i]),
+                "defaulter_rate": float(category["target_sum"][i]
+                                        / category["count"][i] * 100),
+                "q1": q1, "median": median, "q3": q3,
+                "lowerfence": float(max(score_edges[inside[0]],
+                                        q1 - 1.5 * iqr)),
+                "upperfence": float(min(score_edges[inside[-1] + 1],
+                                        q3 + 1.5 * iqr)),
+                })
+        summaries[name] = rows
+
+    meta = {
+        "n_rows": int(len(ids)),
+        "columns": feature_names,
+        "continuous": continuous,
+        "categorical": categorical,
+        "model_version": file_hash(model_path),
+        "data_version": data_version,
+        "threshold": threshold,
+        "histograms": {f"{name}|{int(log_scale)}":
+                           {"edges": edges[(name, log_scale)].tolist(),
+                            "counts": counts[(name, log_scale)].tolist()}
+                       for name, log_scale in edges},
+        "categories": summaries,
+        }
+    meta_path = os.path.join(store_dir, "meta.json")
+    with open(meta_path + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(meta_path + ".tmp", meta_path)
+    return store_dir
+
+
+class StoreHistograms:
+    """Histograms precomputed by ingest, with the interface of
+    aggregations.HistogramStore"""
+    def __init__(self, histograms:dict) -> None:
+        self.histograms = histograms
+
+    def get(self, feature:str, log_scale:bool=False) -> dict:
+        histogram = self.histograms[f"{feature}|{int(log_scale)}"]
+        counts = np.asarray(histogram["counts"])
+        return {"edges": np.asarray(histogram["edges"]),
+                "counts": {0: counts[0], 1: counts[1]}}
+
+    def clear(self) -> None:
+        pass
+
+
+class StoreCategories:
+    """Statistics of the categorical features precomputed by ingest, with
+    the interface of aggregations.CategoryStore. The quartiles and the
+    whiskers are approximated to 1 / score_bins."""
+    def __init__(self, categories:dict) -> None:
+        self.summaries = {
+            feature: pd.DataFrame(rows).set_index("level").rename_axis(feature)
+            for feature, rows in categories.items()}
+
+    def get(self, feature:str) -> pd.core.frame.DataFrame:
+        return self.summaries[feature]
+
+    def compute_all(self) -> None:
+        pass
+
+
+class CustomerStore:
+    """Customers stored on disk by ingest (python streaming.py <file>):
+
+    - features.f64: float64 matrix of the features (one row per customer,
+      in the order of the source file), memory-mapped so that reading a
+      customer only reads its row
+    - ids.npy and scores.npy: ids and model scores of the customers
+    - meta.json: columns, types and fingerprint of the features, 
+      histograms and statistics of the categorical features
+    """
+    def __init__(self, store_dir:str="data/store") -> None:
+        with open(os.path.join(store_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.ids = np.load(os.path.join(store_dir, "ids.npy"))
+        self.scores = np.load(os.path.join(store_dir, "scores.npy"))
+        self.features = np.memmap(os.path.join(store_dir, "features.f64"),
+                                  dtype=np.float64, mode="r",
+                                  shape=(self.meta["n_rows"],
+                                         len(self.meta["columns"])))
+        self.model_version = self.meta["model_version"]
+        # None for the stores built before it was recorded
+        self.data_version = self.meta.get("data_version")
+        self.continuous_feat = self.meta["continuous"]
+        self.categorical_feat = self.meta["categorical"]
+        self.histograms = StoreHistograms(self.meta["histograms"])
+        self.category_stats = StoreCategories(self.meta["categories"])
+
+    def frame(self) -> pd.core.frame.DataFrame:
+        """Features of the customers as a DataFrame backed by the memory-
+        mapped matrix (no copy)"""
+        return pd.DataFrame(self.features,
+                            index=pd.Index(self.ids, name=index_col),
+                            columns=self.meta["columns"], copy=False)
+
+
+if __name__ == "__main__":
+    # python streaming.py <csv, Arrow or Parquet file> [data/store]
+    parser = argparse.ArgumentParser(
+        description="Build the on-disk store of the customers by chunks")
+    parser.add_argument("source", help="csv, Arrow or Parquet file")
+    parser.add_argument("destination", nargs="?", default="data/store")
+    parser.add_argument("--batch-size", type=int, default=50000)
+    args = parser.parse_args()
+
+    print(ingest(args.source, args.destination, batch_size=args.batch_size))
@@ -1,21 +1,437 @@
+import copy
+import io
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# The tests load the model and the statistics on demand instead of in the
+# warm-up thread of main.py
+os.environ.setdefault("WARM_UP", "0")
+
 from main import (
     set_value_gauge, 
     update_credit_status, 
+    update_scoring,
     plot_feature_importance_local,
+    plot_feature_importance_global,
     plot_continuous_features,
     plot_box,
     plot_pie,
 )
+from shap_plots import (
+    ExplanationCache, 
+    ShapExplainer, 
+    check_backends, 
+    check_dtypes,
+)
+from scoring import (
+    get_scorer, 
+    batch_score, 
+    CircuitBreaker,
+    LocalScorer, 
+    CheckedScorer,
+    PrecomputedScorer,
+    RemoteScorer,
+)
+from data_store import (
+    write_arrow, 
+    load_customers, 
+    compact_customers, 
+    features_view,
+    CustomerIndex,
+)
+from aggregations import (HistogramStore, category_summary, stratified_sample,
+                          StratifiedSample)
+from scatter_plots import plot_bivariate
+from figure_cache import FigureCache, MemoryBackend, FileBackend
+from bulk import top_contributions
+from metrics import Metrics, SamplingProfiler
+from streaming import ingest, CustomerStore
+from duckdb_store import DuckDBStore, DuckDBHistograms, DuckDBCategories
+from refresh import DataRefresher, apply_updates
+from background import WorkerPoolManager
+from utils import data_hash
+import main
 
 class Tests(unittest.TestCase):
 
+    def test_arrow_store(self):
+        data = main.df.drop(columns=["TARGET"]).iloc[:100]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filepath = os.path.join(tmp_dir, "customers.arrow")
+            write_arrow(data, filepath)
+            result = load_customers(filepath)
+        pd.testing.assert_frame_equal(result, data)
+
+    def test_compact_dtypes(self):
+        data = main.df.drop(columns=["SCORE", "TARGET"])
+        compact = compact_customers(data, ["CODE_GENDER", "AMT_CREDIT"])
+        self.assertEqual(compact["CODE_GENDER"].dtype, np.int8)
+        self.assertEqual(compact["AMT_CREDIT"].dtype, np.float32)
+        self.assertEqual(compact["DAYS_BIRTH"].dtype, np.float32)
+        self.assertLess(compact.memory_usage().sum(), 
+                        data.astype(float).memory_usage().sum() * 0.55)
+        np.testing.assert_array_equal(compact["CODE_GENDER"], 
+                                      data["CODE_GENDER"])
+        np.testing.assert_allclose(compact["AMT_CREDIT"], data["AMT_CREDIT"],
+                                   rtol=1e-6)
+
+        features = features_view(compact, np.float32)
+        self.assertEqual(features.to_numpy().dtype, np.float32)
+        differences = check_dtypes(features_view(data), n_rows=500)
+        self.assertLess(differences["score"], 1e-3)
+        self.assertLess(differences["shap"], 1e-3)
+
+    def test_streaming_store(self):
+        data = main.df.drop(columns=["TARGET"]).iloc[:500]
+        # The store keeps the features as float64
+        reference = data.astype(float).assign(
+            TARGET=(data["SCORE"] >= main.threshold).astype(int))
+        n_unique = data.nunique()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filepath = os.path.join(tmp_dir, "customers.csv")
+            data.to_csv(filepath)
+            ingest(filepath, tmp_dir, batch_size=120)
+            store = CustomerStore(tmp_dir)
+
+            self.assertEqual(store.continuous_feat, 
+                             n_unique[n_unique > 10].index.tolist())
+            self.assertEqual(store.categorical_feat,
+                             n_unique[n_unique <= 10].index.tolist())
+            np.testing.assert_allclose(store.scores, data["SCORE"])
+            pd.testing.assert_series_equal(store.frame().loc[100045], 
+                                           main.features_data.loc[100045])
+            # The fingerprint of the app is recorded at ingest
+            self.assertEqual(store.data_version,
+                             data_hash(features_view(store.frame())))
+
+            expected = HistogramStore(reference).get("AMT_CREDIT", True)
+            result = store.histograms.get("AMT_CREDIT", True)
+            np.testing.assert_allclose(result["edges"], expected["edges"])
+            for target in (0, 1):
+                np.testing.assert_array_equal(result["counts"][target],
+                                              expected["counts"][target])
+
+            expected = category_summary(reference, "CODE_GENDER")
+            result = store.category_stats.get("CODE_GENDER")
+            self.assertEqual(result.index.tolist(), expected.index.tolist())
+            self.assertEqual(result.index.dtype, expected.index.dtype)
+            pd.testing.assert_frame_equal(
+                result[["count", "score_sum", "defaulter_rate"]],
+                expected[["count", "score_sum", "defaulter_rate"]],
+                check_dtype=False)
+            np.testing.assert_allclose(result[["q1", "median", "q3"]],
+                                       expected[["q1", "median", "q3"]],
+                                       atol=0.01)
+
+    def test_duckdb_aggregations(self):
+        data = main.df.iloc[:500]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filepath = os.path.join(tmp_dir, "customers.parquet")
+            data.drop(columns=["SCORE", "TARGET"]).to_parquet(filepath)
+            store = DuckDBStore(filepath, data["SCORE"], main.threshold)
+
+            expected = HistogramStore(data)
+            result = DuckDBHistograms(store)
+            for feature, log_scale in (("AMT_CREDIT", False),
+                                       ("AMT_CREDIT", True),
+                                       ("DAYS_BIRTH", False)):
+                histogram = result.get(feature, log_scale)
+                reference = expected.get(feature, log_scale)
+                np.testing.assert_array_equal(histogram["edges"],
+                                              reference["edges"])
+                for target in (0, 1):
+                    np.testing.assert_array_equal(
+                        histogram["counts"][target],
+                        reference["counts"][target])
+
+            result = DuckDBCategories(store, ["CODE_GENDER"])\
+                        .get("CODE_GENDER")
+            expected = category_summary(data, "CODE_GENDER")
+            pd.testing.assert_frame_equal(result, expected[result.columns],
+                                          check_dtype=False,
+                                          check_index_type=False)
+
+            positions = np.array([3, 10, 42])
+            columns = store.columns(["AMT_CREDIT"], positions)
+            np.testing.assert_array_equal(
+                columns["AMT_CREDIT"],
+                data["AMT_CREDIT"].to_numpy()[positions])
+
+            # A file missing customers of the app is refused
+            store = DuckDBStore(filepath, main.df["SCORE"].iloc[:600], 
+                                main.threshold)
+            with self.assertRaises(ValueError):
+                store.columns(["AMT_CREDIT"])
+
+    def test_data_refresh(self):
+        snapshot = main.snapshot
+        snapshot.histograms.get("AMT_CREDIT")
+        snapshot.histograms.get("AMT_CREDIT", log_scale=True)
+        rows = main.features_data.iloc[[0, 1, 5, 6]].copy()
+        rows.iloc[0] = main.features_data.iloc[3].to_numpy()
+        rows.index = pd.Index([rows.index[0], rows.index[1], 999999, 1000001],
+                              name="SK_ID_CURR")
+        snapshots = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            rows.reset_index().to_csv(os.path.join(tmp_dir, "update.csv"),
+                                      index=False)
+            refresher = DataRefresher(tmp_dir, lambda files, rows: 
+                snapshots.append(apply_updates(snapshot, rows, main.threshold,
+                                               "v2")) or True)
+            self.assertTrue(refresher.poll())
+            self.assertFalse(refresher.poll())
+        result = snapshots[0]
+
+        # The unchanged customer is skipped, the new ones are appended
+        self.assertEqual(len(result.df), len(main.df) + 2)
+        self.assertEqual(result.customer_index.position(1000001), 
+                         len(main.df) + 1)
+        self.assertEqual(result.customer_index.search("99999"), [999999])
+        self.assertEqual(len(snapshot.df), len(main.df))
+        pd.testing.assert_series_equal(result.features_data.iloc[0],
+                                       main.features_data.iloc[3],
+                                       check_names=False)
+
+        # Same scores, histograms and shap values as a full recompute
+        scores = batch_score(main.shap_explainer.model, result.features_data)
+        np.testing.assert_allclose(result.df["SCORE"], scores)
+        self.assertEqual(result.scorer.score(result.features_data.loc[999999]),
+                         scores[-2])
+        expected = HistogramStore(result.df)
+        for log_scale in (False, True):
+            self.assertIn(("AMT_CREDIT", log_scale), result.histograms._cache)
+            for target in (0, 1):
+                np.testing.assert_array_equal(
+                    result.histograms.get("AMT_CREDIT", log_scale)
+                        ["counts"][target],
+                    expected.get("AMT_CREDIT", log_scale)["counts"][target])
+        # The histograms are drawn from the snapshot of the request
+        fig = main.plot_dist(1.0, "AMT_CREDIT", "Linear", result.version,
+                             data=result)
+        np.testing.assert_array_equal(
+            fig["data"][1]["y"][:-1],
+            expected.get("AMT_CREDIT")["counts"][1])
+        shap_values = main.shap_explainer.shap_values(result.features_data)
+        importance = result.explainer.global_importance\
+                                     .set_index("feature")["shap_values"]
+        np.testing.assert_allclose(
+            importance[result.features_data.columns], 
+            np.abs(shap_values).mean(0), atol=1e-12)
+        np.testing.assert_allclose(
+            result.explainer.local_shap_values(result.features_data, 999999),
+            shap_values[-2])
+
+        # Category statistics updated with the changed rows only
+        for feature in main.categorical_feat:
+            pd.testing.assert_frame_equal(
+                result.category_stats.get(feature),
+                category_summary(result.df, feature), 
+                check_dtype=False, rtol=1e-12)
+
+        # New customers only: appended in place, the previous snapshot 
+        # reading the same arrays
+        rows = main.features_data.iloc[[7]].rename(index={
+            main.features_data.index[7]: 2000001})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            appended = apply_updates(result, rows, main.threshold, "v3",
+                                     cache_dir=tmp_dir)
+            # Scores and shap values shared with the other workers
+            self.assertIn(
+                f"refresh_{main.shap_explainer.model_version}_v3.npz",
+                os.listdir(tmp_dir))
+        self.assertEqual(len(result.df), len(main.df) + 2)
+        for values, previous in (
+                (appended.features_data, result.features_data),
+                (appended.df["AMT_CREDIT"], result.df["AMT_CREDIT"]),
+                (appended.df["SCORE"], result.df["SCORE"])):
+            self.assertTrue(np.shares_memory(values.to_numpy(), 
+                                             previous.to_numpy()))
+        self.assertAlmostEqual(appended.df["SCORE"].iat[-1], 
+                               main.df["SCORE"].iat[7])
+
+        # Precomputed shap values are overridden for the changed customers
+        explainer = ShapExplainer(backend="native")
+        explainer.local_store = main.shap_explainer.shap_values(
+            main.features_data)
+        updated = explainer.updated(main.features_data, result.features_data,
+                                    np.array([0, len(main.df) + 1]))
+        np.testing.assert_allclose(
+            updated.local_shap_values_at(result.features_data, 
+                                         [0, 1, len(main.df) + 1]),
+            shap_values[[0, 1, -1]])
+        self.assertIsNot(explainer.local_overrides, updated.local_overrides)
+
+    def test_background_jobs(self):
+        import diskcache
+        calls = []
+        def job(value):
+            calls.append(threading.current_thread().name)
+            return value * 2
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manager = WorkerPoolManager(diskcache.Cache(tmp_dir), 
+                                        max_workers=1)
+            job_fn = manager.make_job_fn(job, False)
+            job_id = manager.call_job_fn("key", job_fn, [21], {})
+            manager._executor().shutdown(wait=True)
+            # Run by a thread of this process, the result shared through
+            # the disk cache
+            self.assertTrue(calls[0].startswith("background-job"))
+            self.assertTrue(manager.job_running(job_id))
+            self.assertEqual(manager.get_result("key", job_id), 42)
+            self.assertFalse(manager.job_running(job_id))
+
+            # A job cancelled before it starts is skipped
+            manager._pid = None
+            blocker = threading.Event()
+            manager.call_job_fn("wait", manager.make_job_fn(
+                lambda: blocker.wait(5), False), [], {})
+            job_id = manager.call_job_fn("cancelled", job_fn, [1], {})
+            manager.terminate_job(job_id)
+            blocker.set()
+            manager._executor().shutdown(wait=True)
+            self.assertEqual(len(calls), 1)
+            self.assertFalse(manager.result_ready("cancelled"))
+            manager.handle.close()
+
+    def test_figure_cache(self):
+        calls = []
+        def plot(feature):
+            calls.append(feature)
+            return {"data": [{"x": [1, 2]}], "layout": {"title": feature}}
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for backend in (MemoryBackend(), FileBackend(tmp_dir)):
+                calls.clear()
+                cache = FigureCache(backend, version="v1")
+                cached_plot = cache.memoize(plot)
+                result1 = cached_plot("AMT_CREDIT")
+                result2 = cached_plot("AMT_CREDIT")
+                self.assertEqual(result1, result2)
+                self.assertEqual(calls, ["AMT_CREDIT"])
+                self.assertEqual((cache.hits, cache.misses), (1, 1))
+                cache.invalidate("v2")
+                cached_plot("AMT_CREDIT")
+                self.assertEqual(len(calls), 2)
+
+            # Expired entries and files above max_files are deleted
+            backend = FileBackend(tmp_dir, max_files=3, check_every=1)
+            cache = FigureCache(backend, version="v1")
+            backend.set("expired", {"value": 1}, ttl=-1)
+            self.assertIsNone(backend.get("expired"))
+            self.assertEqual(os.listdir(backend.version_dir), [])
+            for feature in ("A", "B", "C", "D", "E"):
+                cache.memoize(plot)(feature)
+            self.assertEqual(len(os.listdir(backend.version_dir)), 3)
+            # The previous versions are still used by the other workers 
+            # until they expire
+            v1_dir = backend.version_dir
+            other = FileBackend(tmp_dir, max_files=3, check_every=1)
+            other.use_version("v2")
+            other.set("A", {"value": 1}, ttl=3600)
+            self.assertEqual(len(os.listdir(v1_dir)), 2)
+            self.assertEqual(cache.memoize(plot)("E"), plot("E"))
+            for filename in os.listdir(v1_dir):
+                os.utime(os.path.join(v1_dir, filename), (0, 0))
+            other.trim()
+            self.assertEqual(os.listdir(tmp_dir), 
+                             [os.path.basename(other.version_dir)])
+
+    def test_customer_index(self):
+        index = CustomerIndex(pd.Index([100045, 100020, 200001, 100002]))
+        self.assertEqual(index.position(100020), 1)
+        self.assertIsNone(index.position(1))
+        self.assertIsNone(index.position("abc"))
+        self.assertIn(100045, index)
+        self.assertEqual(index.search("1000"), [100002, 100020, 100045])
+        self.assertEqual(index.search("1000", limit=1), [100002])
+        self.assertEqual(index.search("3"), [])
+
     def test_set_value_gauge(self):
         result1 = set_value_gauge(100045)
         result2 = set_value_gauge(1)
         self.assertLessEqual(result1, 1)
         self.assertGreaterEqual(result1, 0)
         self.assertEqual(result2, 0)
+
+    def test_customer_context_score(self):
+        class CountingScorer:
+            calls = 0
+            def score(self, features):
+                self.calls += 1
+                return 0.5
+        scorer = CountingScorer()
+        data = copy.copy(main.snapshot)
+        data.scorer = scorer
+        backend = main.scoring_backend
+        try:
+            for scoring_backend, calls in (("precomputed", 1), ("remote", 2)):
+                scorer.calls = 0
+                main.scoring_backend = scoring_backend
+                context = main.CustomerContext(data, 100045, 0)
+                context.score, context.score
+                # The scores of the API (or of its fallback) are not kept
+                self.assertEqual(scorer.calls, calls)
+        finally:
+            main.scoring_backend = backend
+    
+    def test_get_scorer(self):
+        self.assertIsInstance(get_scorer("local", None, ""), LocalScorer)
+        self.assertIsInstance(get_scorer("checked", None, ""), CheckedScorer)
+        with self.assertRaises(ValueError):
+            get_scorer("unknown", None, "")
+    
+    def test_batch_score(self):
+        features = main.features_data.iloc[:50]
+        scores = batch_score(main.shap_explainer.model, features, 
+                             chunk_size=20)
+        local_scorer = LocalScorer(main.shap_explainer.model)
+        self.assertEqual(len(scores), 50)
+        self.assertAlmostEqual(scores[3], 
+                               local_scorer.score(features.iloc[3]))
+        self.assertTrue(
+            (main.df["TARGET"] == (main.df["SCORE"] >= main.threshold)).all()
+            )
+    
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(max_failures=2, reset_timeout=60)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+
+        # Half-open: a single trial call until it succeeds or fails
+        breaker = CircuitBreaker(max_failures=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+    def test_remote_scorer_fallback(self):
+        features = main.features_data.loc[100045, :]
+        fallback = PrecomputedScorer(main.df["SCORE"])
+        scorer = RemoteScorer("http://127.0.0.1:9/predict", 
+                              retries=0, 
+                              fallback=fallback,
+                              circuit_breaker=CircuitBreaker(max_failures=1))
+        self.assertEqual(scorer.score(features), fallback.score(features))
+        self.assertEqual(scorer.stats.summary()["errors"], 1)
+        # The circuit is open: the API is not called anymore
+        self.assertEqual(scorer.score(features), fallback.score(features))
+        self.assertEqual(scorer.stats.summary()["calls"], 1)
     
     def test_update_credit_status(self):
         result1 = update_credit_status(100045, 0.1)
@@ -36,12 +452,49 @@ class Tests(unittest.TestCase):
             ("Identifiant incorrect", {"textAlign": "center", "font-size": 15})
             )
 
+    def test_update_scoring(self):
+        result1 = update_scoring(100045)
+        result2 = update_scoring(None)
+        self.assertEqual(len(result1), 5)
+        self.assertEqual(result1[0], set_value_gauge(100045))
+        self.assertEqual(result1[1:3], 
+                         update_credit_status(100045, result1[0]))
+        self.assertEqual(result2, (0, "", {}, "", {}))
+
     def test_plot_feature_importance_local(self):
         result1 = plot_feature_importance_local(100045, 10)
         result2 = plot_feature_importance_local(1, 10)
         self.assertNotEqual(result1, {})
         self.assertEqual(result2, {})
 
+    def test_plot_feature_importance_global(self):
+        result1 = plot_feature_importance_global(5)
+        result2 = plot_feature_importance_global(15)
+        self.assertEqual(len(result1["data"][0]["y"]), 5)
+        self.assertEqual(len(result2["data"][0]["y"]), 15)
+
+    def test_explainer_backends(self):
+        max_diff = check_backends(main.features_data, n_rows=200)
+        self.assertLess(max_diff, 1e-6)
+
+    def test_lazy_explainer(self):
+        explainer = ShapExplainer(backend="native")
+        self.assertFalse(explainer.ready.is_set())
+        self.assertAlmostEqual(explainer.base_value, 
+                               main.shap_explainer.base_value)
+        self.assertTrue(explainer.ready.is_set())
+
+    def test_explanation_cache(self):
+        cache = ExplanationCache(maxsize=2)
+        cache.put((1, "v1"), [0.1])
+        cache.put((2, "v1"), [0.2])
+        cache.get((1, "v1"))
+        cache.put((3, "v1"), [0.3])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get((1, "v1")), [0.1])
+        self.assertIsNone(cache.get((2, "v1")))
+        self.assertIsNone(cache.get((1, "v2")))
+
     def test_plot_continuous_features(self):
         result1 = plot_continuous_features(
             100045, "AMT_INCOME_TOTAL", "AMT_CREDIT", "Linear", "Log")
@@ -60,6 +513,157 @@ class Tests(unittest.TestCase):
         self.assertTupleEqual(result3, ({}, {}, {}))
         self.assertTupleEqual(result4, ({}, {}, {}))
 
+    def test_histogram_store(self):
+        histograms = HistogramStore(main.df, nbins=20)
+        values = main.df["AMT_CREDIT"]
+        result1 = histograms.get("AMT_CREDIT")
+        result2 = histograms.get("AMT_CREDIT", log_scale=True)
+        self.assertEqual(len(result1["edges"]), 21)
+        self.assertEqual(
+            result1["counts"][0].sum() + result1["counts"][1].sum(),
+            values.notna().sum()
+            )
+        self.assertEqual(
+            result2["counts"][0].sum() + result2["counts"][1].sum(),
+            (values > 0).sum()
+            )
+        self.assertIs(histograms.get("AMT_CREDIT"), result1)
+
+    def test_stratified_sample(self):
+        scores = main.df["SCORE"].to_numpy()
+        result1 = stratified_sample(scores, 500)
+        result2 = stratified_sample(scores[:100], 500)
+        self.assertLessEqual(len(result1), 500)
+        self.assertEqual(len(set(result1)), len(result1))
+        self.assertIn(scores.argmin(), result1)
+        self.assertIn(scores.argmax(), result1)
+        self.assertEqual(len(result2), 100)
+        # Rounding each stratum up must not exceed max_points
+        self.assertEqual(len(stratified_sample(scores[:1015], 1003)), 1003)
+
+        # Only the strata of the previous and new scores are drawn again
+        sample = StratifiedSample(scores, 500)
+        np.testing.assert_array_equal(sample.positions, result1)
+        new_scores = np.append(scores, [scores.max() + 1])
+        updated = sample.updated(scores, new_scores, [len(scores)])
+        self.assertLessEqual(len(updated.positions), 500)
+        self.assertIn(len(scores), updated.positions)
+        for i, (picks, new_picks) in enumerate(zip(sample.picks, 
+                                                   updated.picks)):
+            if i != len(sample.picks) - 1:
+                np.testing.assert_array_equal(picks, new_picks)
+
+    def test_plot_bivariate_density(self):
+        result = plot_bivariate(
+            main.df["AMT_INCOME_TOTAL"].to_numpy(),
+            main.df["AMT_CREDIT"].to_numpy(),
+            main.df["SCORE"].to_numpy(),
+            main.df.index.to_numpy(),
+            0, "AMT_INCOME_TOTAL", "AMT_CREDIT", "Linear", "Log",
+            mode="density")
+        self.assertEqual(result.data[0].type, "heatmap")
+        self.assertEqual(result.data[1].x[0], 
+                         main.df["AMT_INCOME_TOTAL"].iloc[0])
+
+    def test_category_summary(self):
+        result = category_summary(main.df, "CODE_GENDER")
+        scores = main.df["SCORE"][main.df["CODE_GENDER"] == 1]
+        targets = main.df["TARGET"][main.df["CODE_GENDER"] == 1]
+        self.assertEqual(result.loc[1, "count"], len(scores))
+        self.assertAlmostEqual(result.loc[1, "score_sum"], scores.sum())
+        self.assertAlmostEqual(result.loc[1, "defaulter_rate"], 
+                               targets.mean() * 100)
+        self.assertAlmostEqual(result.loc[1, "median"], scores.median())
+        self.assertLessEqual(result.loc[1, "lowerfence"], result.loc[1, "q1"])
+        self.assertGreaterEqual(result.loc[1, "upperfence"], 
+                                result.loc[1, "q3"])
+
+    def test_top_contributions(self):
+        values = np.array([[0.1, -0.5, 0.3], [0.0, 0.2, -0.1]])
+        result = top_contributions(values, ["a", "b", "c"], 2)
+        self.assertEqual([c["feature"] for c in result[0]], ["b", "c"])
+        self.assertEqual([c["feature"] for c in result[1]], ["b", "c"])
+        self.assertEqual(result[0][0]["shap_value"], -0.5)
+
+    def test_metrics(self):
+        plot_box(100045, "CODE_GENDER")
+        client = main.server.test_client()
+        client.get("/ready")
+        text = client.get("/metrics").get_data(as_text=True)
+        self.assertIn('dashboard_span_seconds_count{callback="plot_box",'
+                      'span="figure"}', text)
+        self.assertIn('dashboard_request_seconds_count{endpoint="/ready"}', 
+                      text)
+        self.assertIn('dashboard_cache_hit_ratio{cache="figures"}', text)
+
+        metrics = Metrics()
+        traced = metrics.timed(lambda: 1)
+        for _ in range(3):
+            traced()
+        self.assertIn('dashboard_span_seconds_bucket{callback="<lambda>",'
+                      'span="total",le="+Inf"} 3', metrics.render())
+
+    def test_sampling_profiler(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            profiler = SamplingProfiler(0.05, tmp_dir, interval=0.001)
+            profiler.start()
+            start = time.perf_counter()
+            while time.perf_counter() - start < 0.1:
+                pass
+            filepath = profiler.stop("slow", time.perf_counter() - start)
+            with open(filepath) as f:
+                lines = f.read().splitlines()
+            self.assertTrue(any("test_sampling_profiler" in line 
+                                for line in lines))
+            self.assertTrue(all(line.rsplit(" ", 1)[1].isdigit() 
+                                for line in lines))
+
+            profiler.start()
+            self.assertIsNone(profiler.stop("fast", 0.01))
+
+    def test_bulk_score(self):
+        client = main.server.test_client()
+        response = client.post("/bulk/score", 
+                               json={"ids": [100045, 1], "top_k": 3})
+        result = [json.loads(line) 
+                  for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(result), 2)
+        self.assertAlmostEqual(result[0]["SCORE"], 
+                               main.df.loc[100045, "SCORE"])
+        self.assertEqual(len(result[0]["contributions"]), 3)
+        self.assertEqual(result[1]["decision"], "Identifiant incorrect")
+
+        rows = main.features_data.loc[[100045]].reset_index()
+        response = client.post("/bulk/score?format=arrow", json={
+            "rows": json.loads(rows.to_json(orient="records"))})
+        table = pa.ipc.open_stream(response.get_data()).read_all()
+        self.assertAlmostEqual(table["SCORE"][0].as_py(), 
+                               result[0]["SCORE"])
+        self.assertEqual(table["decision"][0].as_py(), result[0]["decision"])
+
+        # Invalid parameters and unreadable files are client errors
+        response = client.post("/bulk/score", 
+                               json={"ids": [100045], "top_k": "five"})
+        self.assertEqual(response.status_code, 400)
+        response = client.post("/bulk/score?chunk_size=x", 
+                               json={"ids": [100045]})
+        self.assertEqual(response.status_code, 400)
+        response = client.post("/bulk/score", data={
+            "file": (io.BytesIO(b"not a parquet file"), "rows.parquet")})
+        self.assertEqual(response.status_code, 400)
+        for body in ([1, 2], {"rows": "abc"}, {"rows": [1, 2]},
+                     {"rows": [{"foo": 1}]}, {"ids": {"a": 1}},
+                     {"ids": [[1, 2]]}):
+            response = client.post("/bulk/score", json=body)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("error", response.get_json())
+        response = client.post("/bulk/score", data={
+            "file": (io.BytesIO(b"AMT_CREDIT\n1000\n"), "rows.csv")})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["X-Unknown-Columns"], "[]")
+        self.assertEqual(int(response.headers["X-Missing-Features"]),
+                         len(main.features_data.columns) - 1)
+
     def test_plot_box(self):
         result1 = plot_box(100045, "CODE_GENDER")
         result2 = plot_box(100045, None)
@@ -0,0 +1,20 @@
+import hashlib
+import pandas as pd
+
+
+def file_hash(filepath:str) -> str:
+    """Short sha256 fingerprint of a file (used to version the model)"""
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()[:16]
+
+
+def data_hash(data:pd.core.frame.DataFrame) -> str:
+    """Short sha256 fingerprint of the content of a DataFrame"""
+    sha = hashlib.sha256(
+        pd.util.hash_pandas_object(data, index=True).to_numpy().tobytes()
+        )
+    sha.update(",".join(data.columns).encode())
+    return sha.hexdigest()[:16]